@@ -14,14 +14,17 @@ import os
 import sys
 import pprint
 import base64
+import json
+import shlex
 import kploycommon
-
-from tabulate import tabulate
-from pyk import toolkit
-from pyk import util
+import kployagent
 
 DEBUG = False    # you can change that to enable debug messages ...
 VERBOSE = False  # ... but leave this one in peace
+PARALLEL = 1     # how many manifests to deploy concurrently, set via `--parallel`
+WATCH = False    # keep watching the app on `stats`, set via `--watch`
+WAIT = False     # wait for ready replicas on `scale`, set via `--wait`
+COMPRESS_LEVEL = kploycommon.EXPORT_COMPRESS_LEVEL # compression level of app archives, set via `--compress-level`
 DEPLOYMENT_DESCRIPTOR = "Kployfile"
 EXPORT_ARCHIVE_FILENAME = "app.kploy"
 SECRETS_FILE_EXT = ".secret"
@@ -42,6 +45,14 @@ else:
   logging.basicConfig(level=logging.INFO, format=FORMAT, datefmt="%Y-%m-%dT%I:%M:%S")
   logging.getLogger("requests").setLevel(logging.WARNING)
 
+def tabulate(*args, **kwargs):
+    """
+    Formats a table, see the `tabulate` package, which is only imported once there's
+    a table to show, so that commands without one don't pay for loading it.
+    """
+    import tabulate as tabulate_pkg
+    return tabulate_pkg.tabulate(*args, **kwargs)
+
 class InvalidWorkspaceError(Exception):
     """
     Error when executing the `push` command: The `source` field in the `Kployfile` file is neither a GitHub username or repo URL.
@@ -58,40 +69,57 @@ def cmd_dryrun(param):
     """
     Looks for a `Kployfile` file in the current directory and tries
     to validate its content, incl. syntax validation and mock execution.
+    Every manifest is checked (kind, apiVersion, unique names, RC selectors matching
+    their pod templates and service selectors matching some RC); the results are cached,
+    so only changed manifests are checked again.
+    Usage: `dryrun [offline]`, where with `offline` it doesn't check the cluster and
+    only validates remotes that have been downloaded before.
     """
     here = os.path.realpath(".")
     kployfile = os.path.join(here, DEPLOYMENT_DESCRIPTOR)
+    offline = (param == "offline")
     if VERBOSE: logging.info("Trying to execute a dry run on %s " %(kployfile))
     try:
-        kploy, _  = util.load_yaml(filename=kployfile)
+        kploy = kploycommon._load_kployfile(kployfile)
         logging.debug(kploy)
         print("Validating application `%s/%s` ..." %(kploy["namespace"], kploy["name"]))
 
-        print("\n  CHECK: Is the Kubernetes cluster up & running and accessible via `%s`?" %(kploy["apiserver"]))
-        pyk_client = kploycommon._connect(api_server=kploy["apiserver"], debug=DEBUG)
-        nodes = pyk_client.execute_operation(method="GET", ops_path="/api/v1/nodes")
-        if VERBOSE: logging.info("Got node list %s " %(util.serialize_tojson(nodes.json())))
-        print("  \o/ ... I found %d node(s) to deploy your wonderful app onto." %(len(nodes.json()["items"])))
+        targets = [] if offline else kploycommon._targets(kploy)
+        for target in targets:
+            print("\n  CHECK: Is the Kubernetes cluster up & running and accessible via `%s`?" %(target["apiserver"]))
+            pyk_client = kploycommon._connect(api_server=target["apiserver"], debug=DEBUG)
+            nodes = pyk_client.execute_operation(method="GET", ops_path="/api/v1/nodes")
+            if VERBOSE: logging.info("Got node list %s " %(json.dumps(nodes.json())))
+            print("  \o/ ... I found %d node(s) to deploy your wonderful app onto." %(len(nodes.json()["items"])))
 
         print("\n  CHECK: Are there RC and service manifests available around here?")
+        problems = []
         try:
             rcs = os.path.join(here, RC_DIR)
             logging.debug("Asserting %s exists" %(os.path.dirname(rcs)))
             assert os.path.exists(rcs)
-            rc_manifests_confirmed = kploycommon._visit(rcs, "RC", cache_remotes=kploy["cache_remotes"])
+            rc_manifests_confirmed = kploycommon._visit(rcs, "RC", cache_remotes=kploy["cache_remotes"], offline=offline, errors=problems)
             print("         I found %s RC manifest(s) in %s" %(int(len(rc_manifests_confirmed)), os.path.dirname(rcs)))
-            if VERBOSE: kploycommon._dump(rc_manifests_confirmed)
+            if VERBOSE: kploycommon._dump([litem["file"] for litem in rc_manifests_confirmed])
 
             services = os.path.join(here, SVC_DIR)
             logging.debug("Asserting %s exists" %(os.path.dirname(services)))
             assert os.path.exists(services)
-            svc_manifests_confirmed = kploycommon._visit(services, "service", cache_remotes=kploy["cache_remotes"])
+            svc_manifests_confirmed = kploycommon._visit(services, "service", cache_remotes=kploy["cache_remotes"], offline=offline, errors=problems)
             print("         I found %s service manifest(s) in %s" %(int(len(svc_manifests_confirmed)), os.path.dirname(services)))
-            if VERBOSE: kploycommon._dump(svc_manifests_confirmed)
+            if VERBOSE: kploycommon._dump([litem["file"] for litem in svc_manifests_confirmed])
             print("  \o/ ... I found both RC and service manifests to deploy your wonderful app!")
         except:
             print("No RC and/or service manifests found to deploy your app. You can use `kploy init` to create missing artefacts.")
             sys.exit(1)
+
+        print("\n  CHECK: Are the RC and service manifests valid?")
+        problems += kploycommon._validate(here, svc_manifests_confirmed, rc_manifests_confirmed)
+        if problems:
+            print(tabulate([[os.path.relpath(path, here), problem] for path, problem in problems], ["MANIFEST", "PROBLEM"], tablefmt="plain"))
+            print("\nI found %d problem(s) with your manifests, fix them and do another `kploy dryrun`." %(len(problems)))
+            sys.exit(1)
+        print("  \o/ ... all %d manifest(s) look good." %(len(rc_manifests_confirmed) + len(svc_manifests_confirmed)))
     except (IOError, IndexError, KeyError) as e:
         print("Something went wrong:\n%s" %(e))
         sys.exit(1)
@@ -106,43 +134,78 @@ def cmd_run(param):
     kployfile = os.path.join(here, DEPLOYMENT_DESCRIPTOR)
     if VERBOSE: logging.info("Trying to run %s " %(kployfile))
     try:
-        kploy, _  = util.load_yaml(filename=kployfile)
+        kploy = kploycommon._load_kployfile(kployfile)
         logging.debug(kploy)
-        pyk_client = kploycommon._connect(api_server=kploy["apiserver"], debug=DEBUG)
-        # set up a Namespace for this app:
-        kploycommon._create_ns(pyk_client, kploy["namespace"], VERBOSE)
-        # set up a Secrets for this app:
-        env = os.path.join(here, ENV_DIR)
-        secrets = {}
-        logging.debug("Visiting %s" %env)
-        for _, _, file_names in os.walk(env):
-            for afile in file_names:
-                if afile.endswith(SECRETS_FILE_EXT):
-                    logging.debug("Got a secret input: %s" %(afile))
-                    key = os.path.splitext(afile)[0]
-                    logging.debug("Secret key: %s" %(key))
-                    with open(os.path.join(env, afile), "r") as sec_file:
-                        raw_data = sec_file.read().strip()
-                    logging.debug("Secret data: %s" %(raw_data))
-                    val = base64.b64encode(raw_data)
-                    logging.debug("Secret base64 encoded data: %s" %(val))
-                    secrets[key] = val
-        kploycommon._create_secrets(pyk_client, kploy["name"], kploy["namespace"], secrets, VERBOSE)
-        # collect Services and RCs ...
+        targets = kploycommon._targets(kploy)
+        # collect Secrets, Services and RCs once ...
         rc_manifests_confirmed, svc_manifests_confirmed = [], []
+        env = os.path.join(here, ENV_DIR)
         services = os.path.join(here, SVC_DIR)
         rcs = os.path.join(here, RC_DIR)
-        svc_manifests_confirmed = kploycommon._visit(services, 'service', cache_remotes=kploy["cache_remotes"])
-        rc_manifests_confirmed = kploycommon._visit(rcs, 'RC', cache_remotes=kploy["cache_remotes"])
-        # ... and deploy them:
-        kploycommon._deploy(pyk_client, kploy["namespace"], here, SVC_DIR, svc_manifests_confirmed, 'service', VERBOSE)
-        kploycommon._deploy(pyk_client, kploy["namespace"], here, RC_DIR, rc_manifests_confirmed, 'RC', VERBOSE)
+        with kploycommon._phase("manifests"):
+            secrets = kploycommon._collect_secrets(env, SECRETS_FILE_EXT)
+            svc_manifests_confirmed = kploycommon._visit(services, 'service', cache_remotes=kploy["cache_remotes"])
+            rc_manifests_confirmed = kploycommon._visit(rcs, 'RC', cache_remotes=kploy["cache_remotes"])
+        # ... and deploy them to all targets, along with a Namespace for this app:
+        def deploy_to(target):
+            pyk_client = kploycommon._connect(api_server=target["apiserver"], debug=DEBUG)
+            with kploycommon._phase("deploy"):
+                errors = kploycommon._deploy(pyk_client, target["namespace"], secrets, svc_manifests_confirmed, rc_manifests_confirmed, VERBOSE, workers=PARALLEL, app=kploy["name"])
+            if errors:
+                raise kploycommon.DeploymentError(errors)
+        results = kploycommon._fan_out(deploy_to, targets)
+        if len(targets) > 1:
+            print(tabulate(kploycommon._fmt_fan_out(results), ["TARGET", "APISERVER", "NAMESPACE", "RESULT"], tablefmt="plain"))
+        kploycommon._check_fan_out(results)
     except (Exception) as e:
         print("Something went wrong deploying your app:\n%s" %(e))
         print("Consider validating your deployment with `kploy dryrun` first!")
         sys.exit(1)
     print(80*"=")
-    print("\nOK, I've deployed `%s/%s`.\nUse `kploy list` and `kploy stats` to check how it's doing." %(kploy["namespace"], kploy["name"]))
+    if len(targets) > 1:
+        print("\nOK, I've deployed `%s` to %d targets.\nUse `kploy list` and `kploy stats` to check how it's doing." %(kploy["name"], len(targets)))
+    else:
+        print("\nOK, I've deployed `%s/%s`.\nUse `kploy list` and `kploy stats` to check how it's doing." %(kploy["namespace"], kploy["name"]))
+
+def cmd_apply(param):
+    """
+    Looks for a `Kployfile` file in the current directory and incrementally deploys it.
+    Other than `run`, it only sends requests for services and RCs that are missing or whose
+    manifests have changed since they were last deployed, so you can apply an app over
+    and over again. Resources of the app that don't have a manifest anymore are listed
+    for pruning and only removed if you do a `kploy apply prune`.
+    """
+    here = os.path.realpath(".")
+    kployfile = os.path.join(here, DEPLOYMENT_DESCRIPTOR)
+    if VERBOSE: logging.info("Trying to apply %s " %(kployfile))
+    try:
+        kploy = kploycommon._load_kployfile(kployfile)
+        logging.debug(kploy)
+        pyk_client = kploycommon._connect(api_server=kploy["apiserver"], debug=DEBUG)
+        # make sure there's a Namespace and Secrets for this app:
+        kploycommon._create_ns(pyk_client, kploy["namespace"], VERBOSE)
+        env = os.path.join(here, ENV_DIR)
+        secrets = kploycommon._collect_secrets(env, SECRETS_FILE_EXT)
+        plan_list, errors = [], []
+        for action, res_name in kploycommon._sync_secrets(pyk_client, kploy["namespace"], secrets, VERBOSE, workers=PARALLEL):
+            plan_list.append([res_name, "secret", action])
+        # plan and apply Services and RCs, with one list operation per resource kind:
+        for dir_name, resource_name in [(SVC_DIR, "service"), (RC_DIR, "RC")]:
+            manifests_confirmed = kploycommon._visit(os.path.join(here, dir_name), resource_name, cache_remotes=kploy["cache_remotes"])
+            live_index = kploycommon._list_guarded(pyk_client, kploy["namespace"], kploycommon.RESOURCE_COLLECTIONS[resource_name])
+            plan = kploycommon._plan(live_index, manifests_confirmed, kploy["name"])
+            for action, res_name, _ in plan:
+                plan_list.append([res_name, resource_name, action])
+            errors += kploycommon._apply(pyk_client, kploy["namespace"], plan, resource_name, VERBOSE, workers=PARALLEL, prune=(param == "prune"), live_index=live_index, app=kploy["name"])
+        print(tabulate(plan_list, ["NAME", "TYPE", "ACTION"], tablefmt="plain"))
+        if errors:
+            raise kploycommon.DeploymentError(errors)
+    except (Exception) as e:
+        print("Something went wrong applying your app:\n%s" %(e))
+        print("Consider validating your deployment with `kploy dryrun` first!")
+        sys.exit(1)
+    print(80*"=")
+    print("\nOK, I've applied `%s/%s`.\nUse `kploy list` and `kploy stats` to check how it's doing." %(kploy["namespace"], kploy["name"]))
 
 def cmd_list(param):
     """
@@ -152,49 +215,61 @@ def cmd_list(param):
     kployfile = os.path.join(here, DEPLOYMENT_DESCRIPTOR)
     if VERBOSE: logging.info("Listing resource status of app based on %s " %(kployfile))
     try:
-        kploy, _  = util.load_yaml(filename=kployfile)
-        print("Resources of app `%s/%s`:\n" %(kploy["namespace"], kploy["name"]))
-        pyk_client = kploycommon._connect(api_server=kploy["apiserver"], debug=DEBUG)
+        kploy = kploycommon._load_kployfile(kployfile)
+        targets = kploycommon._targets(kploy)
         rc_manifests_confirmed, svc_manifests_confirmed = [], []
         services = os.path.join(here, SVC_DIR)
         rcs = os.path.join(here, RC_DIR)
         svc_list = kploycommon._visit(services, 'service', cache_remotes=True)
         rc_list = kploycommon._visit(rcs, 'RC', cache_remotes=True)
-        res_list = []
-        # gather Services status:
-        print("[Services and RCs]\n")
-        for svc in svc_list:
-            svc_manifest, _  = util.load_yaml(filename=os.path.join(here, SVC_DIR, svc))
-            svc_name = svc_manifest["metadata"]["name"]
-            svc_path = "".join(["/api/v1/namespaces/", kploy["namespace"], "/services/", svc_name])
-            svc_URL = "".join([kploy["apiserver"], svc_path])
-            svc_status = kploycommon._check_status(pyk_client, svc_path)
-            res_list.append([svc_name, os.path.join(SVC_DIR, svc), "service", svc_status, svc_URL])
-        # gather RC status:
-        for rc in rc_list:
-            rc_manifest, _  = util.load_yaml(filename=os.path.join(here, RC_DIR, rc))
-            rc_name = rc_manifest["metadata"]["name"]
-            rc_path = "".join(["/api/v1/namespaces/", kploy["namespace"], "/replicationcontrollers/", rc_name])
-            rc_URL = "".join([kploy["apiserver"], rc_path])
-            rc_status = kploycommon._check_status(pyk_client, rc_path)
-            res_list.append([rc_name, os.path.join(RC_DIR, rc), "RC", rc_status, rc_URL])
-        print(tabulate(res_list, ["NAME", "MANIFEST", "TYPE", "STATUS", "URL"], tablefmt="plain"))
-        # gather Secrets status:
-        print("\n" + 80*"=")
-        print("[Secrets]")
-        sec_list = []
-        secret_path = "".join(["/api/v1/namespaces/", kploy["namespace"], "/secrets/kploy-secrets"])
-        sec_URL = "".join([kploy["apiserver"], secret_path])
-        secret = pyk_client.describe_resource(secret_path)
-        if secret.status_code == 200:
-            print("URL: %s" %(sec_URL))
-            secret_data = secret.json()["data"]
-            for k, v in secret_data.iteritems():
-                sec_list.append([k, base64.b64decode(v)])
-            print(tabulate(sec_list, ["KEY", "VALUE"], tablefmt="plain"))
-        else:
-            print("No env data deployed.")
-        print("\n" + 80*"=")
+        def list_on(target):
+            pyk_client = kploycommon._connect(api_server=target["apiserver"], debug=DEBUG)
+            agent = kployagent.connect(here, target) # if the agent is running, ask it rather than the API server
+            res_list = []
+            # gather Services and RCs status, with one list operation per resource kind:
+            for dir_name, res_collection, resource_name, manifest_list in [
+                (SVC_DIR, "services", "service", svc_list),
+                (RC_DIR, "replicationcontrollers", "RC", rc_list)]:
+                live_list = kployagent.query_or(agent, res_collection, lambda: kploycommon._list_guarded(pyk_client, target["namespace"], res_collection).values())
+                live_index = dict([(item["metadata"]["name"], item) for item in live_list])
+                for litem in manifest_list:
+                    res_name = litem["name"]
+                    res_path = "".join(["/api/v1/namespaces/", target["namespace"], "/", res_collection, "/", res_name])
+                    res_URL = "".join([target["apiserver"], res_path])
+                    res_status = "online" if res_name in live_index else "offline"
+                    res_list.append([res_name, os.path.join(dir_name, litem["file"]), resource_name, res_status, res_URL])
+            # gather Secrets status, there's one Secret per shard of the env data:
+            secrets = kployagent.query_or(agent, "secrets", lambda: kploycommon._list_guarded(pyk_client, target["namespace"], "secrets").values())
+            secrets = [secret for secret in secrets if kploycommon._is_secret_name(secret["metadata"]["name"])]
+            secrets.sort(key=lambda secret: (len(secret["metadata"]["name"]), secret["metadata"]["name"])) # in shard order
+            sec_URLs = ["".join([target["apiserver"], "/api/v1/namespaces/", target["namespace"], "/secrets/", secret["metadata"]["name"]]) for secret in secrets]
+            sec_list = None
+            if secrets:
+                sec_list = [[k, base64.b64decode(v)] for secret in secrets for k, v in sorted((secret.get("data") or {}).iteritems())]
+            return res_list, sec_URLs, sec_list
+        results = kploycommon._fan_out(list_on, targets)
+        for target, result, e in results:
+            if e is not None:
+                continue
+            res_list, sec_URLs, sec_list = result
+            if len(targets) > 1:
+                print("Resources of app `%s/%s` on target %s:\n" %(target["namespace"], target["name"], target["target"]))
+            else:
+                print("Resources of app `%s/%s`:\n" %(target["namespace"], target["name"]))
+            print("[Services and RCs]\n")
+            print(tabulate(res_list, ["NAME", "MANIFEST", "TYPE", "STATUS", "URL"], tablefmt="plain"))
+            print("\n" + 80*"=")
+            print("[Secrets]")
+            if sec_list is not None:
+                for sec_URL in sec_URLs:
+                    print("URL: %s" %(sec_URL))
+                print(tabulate(sec_list, ["KEY", "VALUE"], tablefmt="plain"))
+            else:
+                print("No env data deployed.")
+            print("\n" + 80*"=")
+        if len(targets) > 1:
+            print(tabulate(kploycommon._fmt_fan_out(results), ["TARGET", "APISERVER", "NAMESPACE", "RESULT"], tablefmt="plain"))
+        kploycommon._check_fan_out(results)
     except (Exception) as e:
         print("Something went wrong:\n%s" %(e))
         print("Consider validating your deployment with `kploy dryrun` first!")
@@ -231,6 +306,7 @@ def cmd_init(param):
         ikploy["namespace"] = "default"
         ikploy["source"] = "CHANGE_ME"
         if VERBOSE: logging.info("%s" %(ikploy))
+        from pyk import util
         util.serialize_yaml_tofile(kployfile, ikploy)
         print(80*"=")
         print("\nOK, I've set up the `%s`, the app deployment descriptor from scratch and created necessary directories." %(DEPLOYMENT_DESCRIPTOR))
@@ -244,78 +320,136 @@ def cmd_destroy(param):
     kployfile = os.path.join(here, DEPLOYMENT_DESCRIPTOR)
     if VERBOSE: logging.info("Trying to destroy app based on %s " %(kployfile))
     try:
-        kploy, _  = util.load_yaml(filename=kployfile)
+        kploy = kploycommon._load_kployfile(kployfile)
         logging.debug(kploy)
-        pyk_client = kploycommon._connect(api_server=kploy["apiserver"], debug=DEBUG)
-        # delete all services and RCs:
+        targets = kploycommon._targets(kploy)
+        # delete all services and RCs ...
         rc_manifests_confirmed, svc_manifests_confirmed = [], []
         services = os.path.join(here, SVC_DIR)
         rcs = os.path.join(here, RC_DIR)
         svc_manifests_confirmed = kploycommon._visit(services, 'service', cache_remotes=True)
         rc_manifests_confirmed = kploycommon._visit(rcs, 'RC', cache_remotes=True)
-        kploycommon._destroy(pyk_client, kploy["namespace"], here, SVC_DIR, svc_manifests_confirmed, 'service', VERBOSE)
-        kploycommon._destroy(pyk_client, kploy["namespace"], here, RC_DIR, rc_manifests_confirmed, 'RC', VERBOSE)
-        # delete secrets:
-        secret_path = "".join(["/api/v1/namespaces/", kploy["namespace"], "/secrets/kploy-secrets"])
-        pyk_client.delete_resource(resource_path=secret_path)
-        # delete the namespace:
-        ns_path = "".join(["/api/v1/namespaces/", kploy["namespace"]])
-        pyk_client.delete_resource(resource_path=ns_path)
+        # ... as well as the secrets and the namespace, on all targets:
+        def destroy_on(target):
+            pyk_client = kploycommon._connect(api_server=target["apiserver"], debug=DEBUG)
+            kploycommon._destroy(pyk_client, target["namespace"], svc_manifests_confirmed, rc_manifests_confirmed, VERBOSE, workers=max(PARALLEL, kploycommon._workers(kploycommon.DESTROY_WORKERS)))
+        results = kploycommon._fan_out(destroy_on, targets)
+        if len(targets) > 1:
+            print(tabulate(kploycommon._fmt_fan_out(results), ["TARGET", "APISERVER", "NAMESPACE", "RESULT"], tablefmt="plain"))
+        kploycommon._check_fan_out(results)
     except (Exception) as e:
         print("Something went wrong destroying your app:\n%s" %(e))
         print("Consider validating your deployment with `kploy dryrun` first!")
         sys.exit(1)
     print(80*"=")
-    print("\nOK, I've destroyed `%s/%s`\n" %(kploy["namespace"], kploy["name"]))
+    if len(targets) > 1:
+        print("\nOK, I've destroyed `%s` on %d targets\n" %(kploy["name"], len(targets)))
+    else:
+        print("\nOK, I've destroyed `%s/%s`\n" %(kploy["namespace"], kploy["name"]))
 
 def cmd_stats(param):
     """
     Shows cluster utilization and provides summary of the pods' state, from the point of view of your app.
+    With `--watch` it keeps showing the pods' state, updating it as it changes.
     """
     here = os.path.realpath(".")
     kployfile = os.path.join(here, DEPLOYMENT_DESCRIPTOR)
     if VERBOSE: logging.info("Providing stats for your app based on %s " %(kployfile))
     try:
-        kploy, _  = util.load_yaml(filename=kployfile)
-        print("Runtime stats for app `%s/%s`:" %(kploy["namespace"], kploy["name"]))
-        pyk_client = kploycommon._connect(api_server=kploy["apiserver"], debug=DEBUG)
-        # provide container summary:
-        print("\n[Your app's pods]\n")
-        guarded_pods_path = "".join(["/api/v1/namespaces/", kploy["namespace"], "/pods?labelSelector=guard%3Dpyk"])
-        pods = pyk_client.execute_operation(method="GET", ops_path=guarded_pods_path)
-        pods_list = pods.json()["items"]
-        if not pods_list:
-            print "No pods are online. "
+        kploy = kploycommon._load_kployfile(kployfile)
+        targets = kploycommon._targets(kploy)
+        if WATCH: # keep the pods table up to date until interrupted
+            if len(targets) > 1:
+                print("Sorry, I can only watch one target at a time, but the app has %d." %(len(targets)))
+                sys.exit(1)
+            target = targets[0]
+            print("Runtime stats for app `%s/%s`:" %(target["namespace"], target["name"]))
+            pyk_client = kploycommon._connect(api_server=target["apiserver"], debug=DEBUG)
+            guarded_pods_path = "".join(["/api/v1/namespaces/", target["namespace"], "/pods?labelSelector=guard%3Dpyk"])
+            shown = []
+            def show_pods(pod_table):
+                pod_details = [[
+                    pod["metadata"]["name"],
+                    pod["status"].get("hostIP"),
+                    pod["status"].get("phase"),
+                    "".join([target["apiserver"], pod["metadata"]["selfLink"]])
+                ] for _, pod in sorted(pod_table.items())]
+                if pod_details == shown: # nothing to see here
+                    return
+                shown[:] = pod_details
+                sys.stdout.write("\033[2J\033[H") # clear the screen
+                print("Runtime stats for app `%s/%s`, watching for changes (Ctrl-C to stop):" %(target["namespace"], target["name"]))
+                print("\n[Your app's pods]\n")
+                if pod_details:
+                    print(tabulate(pod_details, ["NAME", "HOST", "STATUS", "URL"], tablefmt="plain"))
+                else:
+                    print("No pods are online. ")
+                sys.stdout.flush()
+            try:
+                kploycommon._follow(pyk_client, guarded_pods_path, show_pods)
+            except KeyboardInterrupt:
+                print("")
             return
-        pod_details = []
-        used_nodes = []
-        for pod in pods_list:
-            if pod["status"]["hostIP"] not in used_nodes:
-                used_nodes.append(pod["status"]["hostIP"])
-            pod_details.append([
-                pod["metadata"]["name"],
-                pod["status"]["hostIP"],
-                pod["status"]["phase"],
-                "".join([kploy["apiserver"], pod["metadata"]["selfLink"]])
-            ])
-        print(tabulate(pod_details, ["NAME", "HOST", "STATUS", "URL"], tablefmt="plain"))
-        print("\n" + 80*"=")
-        # provide utilization info:
-        print("[Nodes used by your app]\n")
-        nodes = pyk_client.execute_operation(method="GET", ops_path="/api/v1/nodes")
-        nodes_list = nodes.json()["items"]
-        node_ips = []
-        for node in nodes_list:
-            if node["metadata"]["name"] in used_nodes:
-                node_ips.append([
-                    node["metadata"]["name"],
-                    node["status"]["nodeInfo"]["osImage"],
-                    node["status"]["nodeInfo"]["containerRuntimeVersion"],
-                    node["status"]["capacity"]["pods"] + ", " + node["status"]["capacity"]["cpu"] + ", " + node["status"]["capacity"]["memory"],
-                    "".join([kploy["apiserver"], node["metadata"]["selfLink"]])
+        def stats_on(target):
+            pyk_client = kploycommon._connect(api_server=target["apiserver"], debug=DEBUG)
+            agent = kployagent.connect(here, target) # if the agent is running, ask it rather than the API server
+            guarded_pods_path = "".join(["/api/v1/namespaces/", target["namespace"], "/pods?labelSelector=guard%3Dpyk"])
+            pods_list = kployagent.query_or(agent, "pods", lambda: kploycommon._list_resources(pyk_client, guarded_pods_path)["items"])
+            pod_details = []
+            used_nodes = set()
+            for pod in pods_list:
+                host = pod["spec"].get("nodeName") or pod["status"].get("hostIP")
+                if host:
+                    used_nodes.add(host)
+                pod_details.append([
+                    pod["metadata"]["name"],
+                    pod["status"].get("hostIP"),
+                    pod["status"]["phase"],
+                    "".join([target["apiserver"], pod["metadata"]["selfLink"]])
                 ])
-        print(tabulate(node_ips, ["IP", "HOST OS", "CONTAINER RUNTIME", "CAPACITY (PODS, CPU, MEM)", "URL"], tablefmt="plain"))
-        print("\n" + 80*"=")
+            # utilization info, only fetching the nodes the app uses:
+            node_index = {}
+            for host in sorted(used_nodes):
+                nodes_list = kployagent.query_or(agent, "nodes", lambda: None, "address", host)
+                if nodes_list is None: # no agent or it can't tell, ask the API server
+                    node_index = kploycommon._get_nodes(pyk_client, used_nodes)
+                    break
+                node_index.update(kploycommon._index_nodes(nodes_list))
+            node_ips = []
+            for node_name in sorted(used_nodes):
+                node = node_index.get(node_name)
+                if node:
+                    node_ips.append([
+                        node["metadata"]["name"],
+                        node["status"]["nodeInfo"]["osImage"],
+                        node["status"]["nodeInfo"]["containerRuntimeVersion"],
+                        node["status"]["capacity"]["pods"] + ", " + node["status"]["capacity"]["cpu"] + ", " + node["status"]["capacity"]["memory"],
+                        "".join([target["apiserver"], node["metadata"]["selfLink"]])
+                    ])
+            return pod_details, node_ips
+        results = kploycommon._fan_out(stats_on, targets)
+        for target, result, e in results:
+            if e is not None:
+                continue
+            pod_details, node_ips = result
+            if len(targets) > 1:
+                print("Runtime stats for app `%s/%s` on target %s:" %(target["namespace"], target["name"], target["target"]))
+            else:
+                print("Runtime stats for app `%s/%s`:" %(target["namespace"], target["name"]))
+            # provide container summary:
+            print("\n[Your app's pods]\n")
+            if not pod_details:
+                print "No pods are online. "
+                continue
+            print(tabulate(pod_details, ["NAME", "HOST", "STATUS", "URL"], tablefmt="plain"))
+            print("\n" + 80*"=")
+            # provide utilization info:
+            print("[Nodes used by your app]\n")
+            print(tabulate(node_ips, ["NODE", "HOST OS", "CONTAINER RUNTIME", "CAPACITY (PODS, CPU, MEM)", "URL"], tablefmt="plain"))
+            print("\n" + 80*"=")
+        if len(targets) > 1:
+            print(tabulate(kploycommon._fmt_fan_out(results), ["TARGET", "APISERVER", "NAMESPACE", "RESULT"], tablefmt="plain"))
+        kploycommon._check_fan_out(results)
     except (Exception) as e:
         print("Something went wrong:\n%s" %(e))
         print("Consider validating your deployment with `kploy dryrun` first!")
@@ -330,10 +464,10 @@ def cmd_export(param):
     kployfile = os.path.join(here, DEPLOYMENT_DESCRIPTOR)
     if VERBOSE: logging.info("Exporting app based on content from %s " %(here))
     try:
-        kploy, _  = util.load_yaml(filename=kployfile)
+        kploy = kploycommon._load_kployfile(kployfile)
         if not param:
             param = EXPORT_ARCHIVE_FILENAME
-        archive_filename, archive_file = kploycommon._export_init(here, DEPLOYMENT_DESCRIPTOR, param)
+        archive_filename, archive_file = kploycommon._export_init(here, DEPLOYMENT_DESCRIPTOR, param, compress_level=COMPRESS_LEVEL)
         print("Adding content of app `%s/%s` to %s" %(kploy["namespace"], kploy["name"], archive_filename))
         rc_manifests_confirmed, svc_manifests_confirmed = [], []
         services = os.path.join(here, SVC_DIR)
@@ -342,10 +476,10 @@ def cmd_export(param):
         rc_list = kploycommon._visit(rcs, 'RC', cache_remotes=True)
         res_list = []
         for svc in svc_list:
-            svc_file_name = os.path.join(SVC_DIR, svc)
+            svc_file_name = os.path.join(SVC_DIR, svc["file"])
             kploycommon._export_add(archive_file, svc_file_name)
         for rc in rc_list:
-            rc_file_name = os.path.join(RC_DIR, rc)
+            rc_file_name = os.path.join(RC_DIR, rc["file"])
             kploycommon._export_add(archive_file, rc_file_name)
         kploycommon._export_done(archive_file)
     except (Exception) as e:
@@ -366,21 +500,30 @@ def cmd_debug(pod_name):
     kployfile = os.path.join(here, DEPLOYMENT_DESCRIPTOR)
     print("Trying to take Pod %s offline for debugging ..." %(pod_name))
     try:
-        kploy, _  = util.load_yaml(filename=kployfile)
+        kploy = kploycommon._load_kployfile(kployfile)
         logging.debug(kploy)
         pyk_client = kploycommon._connect(api_server=kploy["apiserver"], debug=DEBUG)
+        from pyk import toolkit
+        agent = kployagent.connect(here, kploy) # if the agent is running, it knows which RC the Pod belongs to
+        owners = [kployagent._owner_keys(pod) for pod in kployagent.query_or(agent, "pods", lambda: [], "name", pod_name)]
         pod_path = "".join(["/api/v1/namespaces/", kploy["namespace"], "/pods/", pod_name])
-        pod = pyk_client.describe_resource(pod_path)
-        resource = pod.json()
-        resource["metadata"]["labels"] = {}
-        logging.debug("Removed guard label from Pod, now labeled with: %s" %(resource["metadata"]["labels"]))
-        pyk_client.execute_operation(method='PUT', ops_path=pod_path, payload=util.serialize_tojson(resource))
+        res = kploycommon._patch_resource(pyk_client, pod_path, [{"op": "remove", "path": "/metadata/labels"}], patch_type=kploycommon.JSON_PATCH)
+        if res.status_code != 200:
+            raise toolkit.ResourceCRUDException("Can't remove the labels of Pod %s: %d %s" %(pod_name, res.status_code, res.reason))
+        logging.debug("Removed all labels, incl. the guard label, from Pod %s" %(pod_name))
         # now we just need to make sure that the newly created Pod is again owned by kploy:
-        rc_name = pod_name[0:pod_name.rfind("-")] # NOTE: this is a hack, it assumes a certain generator pattern; need to figure a better way to find a Pod's RC
-        logging.debug("Generating RC name from Pod: %s" %(rc_name))
+        if owners and owners[0]:
+            rc_name = owners[0][0]
+        else:
+            rc_name = pod_name[0:pod_name.rfind("-")] # NOTE: this is a hack, it assumes a certain generator pattern; need to figure a better way to find a Pod's RC
+            logging.debug("Generating RC name from Pod: %s" %(rc_name))
         rc_path = "".join(["/api/v1/namespaces/", kploy["namespace"], "/replicationcontrollers/", rc_name])
-        rc = pyk_client.describe_resource(rc_path)
-        kploycommon._own_pods_of_rc(pyk_client, rc, kploy["namespace"], rc_path, VERBOSE)
+        rcs = kployagent.query_or(agent, "replicationcontrollers", lambda: [], "name", rc_name)
+        if rcs:
+            kploycommon._own_pods(pyk_client, kploy["namespace"], rcs[0]["spec"]["selector"], rcs[0]["spec"]["replicas"], rc_path, VERBOSE)
+        else:
+            rc = pyk_client.describe_resource(rc_path)
+            kploycommon._own_pods_of_rc(pyk_client, rc, kploy["namespace"], rc_path, VERBOSE)
     except (Exception) as e:
         print("Something went wrong when taking the Pod offline:\n%s" %(e))
         sys.exit(1)
@@ -389,8 +532,10 @@ def cmd_debug(pod_name):
 
 def cmd_scale(scale_def):
     """
-    Enables you to scale an RC up or down by setting the number of replicas.
-    Usage: `scale rc=replica_count`, for example, `scale webserver-rc=10`.
+    Enables you to scale RCs up or down by setting the number of replicas.
+    Usage: `scale rc=replica_count ...`, for example, `scale webserver-rc=10` or `scale webserver-rc=10 db-rc=3`.
+    You can also read the `rc=replica_count` pairs from a file, for example, `scale @spike.txt`.
+    With `--wait` it waits until the RCs have as many ready replicas as requested.
     """
     if not scale_def:
         print("Sorry, I need a scale definition in order to do my work. Do a `kploy list` first to glean the RC name you want to scale, e.g. `webserver-rc`.")
@@ -399,35 +544,52 @@ def cmd_scale(scale_def):
     here = os.path.realpath(".")
     kployfile = os.path.join(here, DEPLOYMENT_DESCRIPTOR)
     try:
-        rc_name = scale_def.split("=")[0]
-        replica_count = int(scale_def.split("=")[1])
+        scale_defs = kploycommon._parse_scale_defs(scale_def)
+        if not scale_defs:
+            raise ValueError("there are no `rc=replica_count` pairs in it")
     except (Exception) as e:
         print("Can't parse scale definition `%s` due to: %s" %(scale_def, e))
         print("The scale definition should look as follows: `rc=replica_count`, for example, `scale webserver-rc=10`.")
         sys.exit(1)
-    print("Trying to scale RC %s to %d replicas" %(rc_name, replica_count))
+    for rc_name, replica_count in scale_defs:
+        print("Trying to scale RC %s to %d replicas" %(rc_name, replica_count))
     try:
-        kploy, _  = util.load_yaml(filename=kployfile)
+        kploy = kploycommon._load_kployfile(kployfile)
         logging.debug(kploy)
         pyk_client = kploycommon._connect(api_server=kploy["apiserver"], debug=DEBUG)
-        rc_path = "".join(["/api/v1/namespaces/", kploy["namespace"], "/replicationcontrollers/", rc_name])
-        rc = pyk_client.describe_resource(rc_path)
-        resource = rc.json()
-        old_replica_count = resource["spec"]["replicas"]
-        if VERBOSE: logging.info("Scaling RC from %d to %d replicas" %(old_replica_count, replica_count))
-        logging.debug("RC about to be scaled: %s" %(resource))
-        resource["spec"]["replicas"] = replica_count
-        pyk_client.execute_operation(method='PUT', ops_path=rc_path, payload=util.serialize_tojson(resource))
-        # and make sure that the newly created Pods are owned by kploy (on scale up)
-        if replica_count > old_replica_count:
-            logging.debug("Scaling up, trying to own new Pods")
-            rc = pyk_client.describe_resource(rc_path)
-            kploycommon._own_pods_of_rc(pyk_client, rc, kploy["namespace"], rc_path, VERBOSE)
+        kploycommon._scale(pyk_client, kploy["namespace"], scale_defs, VERBOSE, wait=WAIT, workers=max(PARALLEL, kploycommon._workers(kploycommon.SCALE_WORKERS)))
     except (Exception) as e:
         print("Something went wrong when scaling RC:\n%s" %(e))
         sys.exit(1)
     print(80*"=")
-    print("OK, I've scaled RC %s to %d replicas. You can do a `kploy stats` now to verify it." %(rc_name, replica_count))
+    if len(scale_defs) > 1:
+        print("OK, I've scaled %d RCs. You can do a `kploy stats` now to verify it." %(len(scale_defs)))
+    else:
+        print("OK, I've scaled RC %s to %d replicas. You can do a `kploy stats` now to verify it." %(scale_defs[0]))
+
+def cmd_agent(param):
+    """
+    Runs the kploy agent for the app until you stop it with Ctrl-C. The agent keeps track of
+    the app's pods, RCs, services and secrets as well as the cluster's nodes, with one watch
+    per kind, and while it is running `list`, `stats` and `debug` get their data from it
+    rather than from the API server.
+    """
+    here = os.path.realpath(".")
+    kployfile = os.path.join(here, DEPLOYMENT_DESCRIPTOR)
+    try:
+        kploy = kploycommon._load_kployfile(kployfile)
+        logging.debug(kploy)
+        pyk_client = kploycommon._connect(api_server=kploy["apiserver"], debug=DEBUG)
+        if kployagent.connect(here) is not None:
+            print("There's an agent running for this app already, see %s" %(os.path.join(here, kployagent.AGENT_SOCKET)))
+            sys.exit(1)
+        print("Agent for app `%s/%s` listening on %s (Ctrl-C to stop)" %(kploy["namespace"], kploy["name"], os.path.join(here, kployagent.AGENT_SOCKET)))
+        kployagent.serve(here, pyk_client, kploy["apiserver"], kploy["namespace"])
+    except KeyboardInterrupt:
+        print("")
+    except (Exception) as e:
+        print("Something went wrong running the agent:\n%s" %(e))
+        sys.exit(1)
 
 def cmd_push(param):
     """
@@ -445,7 +607,7 @@ def cmd_push(param):
     cmd_export(archivefile)
     if VERBOSE: logging.info("Trying to upload %s" %(archivefile))
     try:
-        kploy, _ = util.load_yaml(filename=kployfile)
+        kploy = kploycommon._load_kployfile(kployfile)
         logging.debug(kploy)
         if kploy["source"].startswith(VALID_WORKSPACE_PREFIXES):
             print("Using %s as the app's workspace" %(kploy["source"]))
@@ -489,7 +651,7 @@ def cmd_pull(param):
     archivefile = os.path.join(here, "".join([".", EXPORT_ARCHIVE_FILENAME]))
     app_link = KAR_BASE_URL
     try:
-        kploy, _ = util.load_yaml(filename=kployfile)
+        kploy = kploycommon._load_kployfile(kployfile)
         logging.debug(kploy)
         if kploy["source"].startswith(VALID_WORKSPACE_PREFIXES):
             print("Using %s as the app's workspace" %(kploy["source"]))
@@ -534,11 +696,64 @@ def cmd_pull(param):
         print("\nYou can now `kploy pull $ID` to download and init an app.")
         print("\nWARNING: a `kploy pull $ID` will overwrite whatever you had locally.\n")
 
-def main():
+def cmd_shell(param):
+    """
+    Runs kploy commands one after the other, read line by line from the terminal or,
+    in scripts, from stdin, for example `printf "run\\nlist\\n" | kploy shell`.
+    Each line is a kploy command line without the `kploy`, such as `scale --wait web-rc=3`.
+    As all commands run in the same process, the connection to the API server, the
+    Kployfile and the manifest index are set up once rather than for each command.
+    The HTTP settings, such as `--http-pool`, are the ones given on the `kploy shell`
+    command line; commands that try to change them are refused.
+    Type `exit` or Ctrl-D to leave; the shell exits with 1 if any command failed.
+    """
+    interactive = sys.stdin.isatty()
+    if interactive:
+        try:
+            import readline # gives the prompt line editing and history
+        except ImportError:
+            pass
+    failed = False
+    while True:
+        try:
+            line = raw_input("kploy> ") if interactive else sys.stdin.readline()
+        except EOFError:
+            line = ""
+        if not line:
+            if interactive:
+                print("")
+            break
+        argv = shlex.split(line, comments=True)
+        if not argv:
+            continue
+        if argv[0] in ("exit", "quit"):
+            break
+        if argv[0] == "shell":
+            print("Sorry, I'm running a shell already.")
+            continue
+        try:
+            main(argv, shell=True)
+        except SystemExit as e: # commands exit on errors, the shell carries on
+            if e.code:
+                failed = True
+        except KeyboardInterrupt:
+            print("")
+            failed = True
+    if failed:
+        sys.exit(1)
+
+def main(argv=None, shell=False):
+    """
+    Runs a kploy command line, by default the one kploy was invoked with, or one
+    entered in the `shell`.
+    """
+    global VERBOSE, PARALLEL, WATCH, WAIT, COMPRESS_LEVEL
     try:
         cmds = {
             "dryrun" : cmd_dryrun,
             "run" : cmd_run,
+            "apply" : cmd_apply,
+            "agent" : cmd_agent,
             "list": cmd_list,
             "init": cmd_init,
             "destroy": cmd_destroy,
@@ -547,7 +762,8 @@ def main():
             "debug": cmd_debug,
             "scale": cmd_scale,
             "push" : cmd_push,
-            "pull" : cmd_pull
+            "pull" : cmd_pull,
+            "shell" : cmd_shell
         }
 
         parser = argparse.ArgumentParser(
@@ -555,12 +771,30 @@ def main():
             epilog="Examples: `kploy init`, `kploy run`, `kploy list`, or to learn its usage: `kploy explain run`, `kploy explain list`, etc.")
         parser.add_argument("command", nargs="*", help="Currently supported commands are: %s and if you want to learn about a command, prepend `explain`, like: explain list " %(kploycommon._fmt_cmds(cmds)))
         parser.add_argument("-v", "--verbose", help="let me tell you every little dirty secret", action="store_true")
-        args = parser.parse_args()
+        parser.add_argument("-p", "--parallel", help="deploy up to N manifests concurrently on `run`, defaults to 1", type=int, default=1, metavar="N")
+        parser.add_argument("-w", "--watch", help="keep showing the state of the app's pods on `stats`", action="store_true")
+        parser.add_argument("--wait", help="wait until the RCs have as many ready replicas as requested on `scale`", action="store_true")
+        parser.add_argument("-z", "--compress-level", help="compression level (0-9) of app archives on `export` and `push`, defaults to %d" %(COMPRESS_LEVEL), type=int, choices=range(10), metavar="LEVEL")
+        parser.add_argument("--http-pool", help="keep up to N connections per host alive, defaults to as many as `--http-concurrency`", type=int, metavar="N")
+        parser.add_argument("--http-timeout", help="give up on requests after SEC seconds, defaults to %d" %(kploycommon.HTTP_TIMEOUT_IN_SEC), type=float, metavar="SEC")
+        parser.add_argument("--no-keep-alive", help="close connections after each request", action="store_true")
+        parser.add_argument("--http-concurrency", help="have at most N requests in flight per host, defaults to %d" %(kploycommon.HTTP_HOST_CONCURRENCY), type=int, metavar="N")
+        parser.add_argument("--profile", help="trace all requests kploy makes into FILE (Chrome trace-event format) and show the slowest ones", metavar="FILE")
+        args = parser.parse_args(argv)
         if len(args.command) == 0:
             parser.print_help()
             sys.exit(0)
-        if args.verbose:
-            VERBOSE = True
+        VERBOSE = args.verbose
+        PARALLEL = max(1, args.parallel)
+        WATCH = args.watch
+        WAIT = args.wait
+        COMPRESS_LEVEL = kploycommon.EXPORT_COMPRESS_LEVEL if args.compress_level is None else args.compress_level
+        http_settings = [args.http_pool, args.http_timeout, args.no_keep_alive or None, args.http_concurrency]
+        if not shell:
+            kploycommon._configure_http(pool_size=args.http_pool, timeout=args.http_timeout, keep_alive=not args.no_keep_alive, host_concurrency=args.http_concurrency)
+        elif any(setting is not None for setting in http_settings): # the session is shared by all commands of the shell
+            print("Sorry, HTTP settings can only be given on the `kploy shell` command line.")
+            sys.exit(1)
         logging.debug("Got command %s" %(args))
         if args.command[0] == "explain":
             cmd = args.command[1]
@@ -568,11 +802,23 @@ def main():
         else:
             cmd = args.command[0]
             param = None
-            if len(args.command) == 2: # we have an additional parameter for the command
-                param = args.command[1]
+            if len(args.command) >= 2: # we have additional parameters for the command
+                param = " ".join(args.command[1:])
             logging.debug("Executing command %s with param %s" %(cmd, param))
+            if args.profile:
+                kploycommon._start_profile()
             if cmd in cmds.keys():
-                cmds[cmd](param)
+                try:
+                    with kploycommon._phase(cmd):
+                        cmds[cmd](param)
+                finally:
+                    if args.profile:
+                        slowest, per_phase = kploycommon._write_profile(args.profile)
+                        print(80*"=")
+                        print("Profile written to %s, the slowest requests were:\n" %(args.profile))
+                        print(tabulate(slowest, ["PHASE", "METHOD", "PATH", "STATUS", "MS", "BYTES"], tablefmt="plain"))
+                        print("\nTime spent per phase:\n")
+                        print(tabulate(per_phase, ["PHASE", "REQUESTS", "REQUESTS (ms)", "WAITING (ms)", "TOTAL (ms)"], tablefmt="plain"))
     except (Exception) as e:
         print("Something went wrong:\n%s" %(e))
         sys.exit(1)
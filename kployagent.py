@@ -0,0 +1,291 @@
+"""
+The kploy agent: keeps an up-to-date, indexed copy of an app's resources in memory
+and serves it to the kploy CLI over a Unix socket, so that read commands such as
+`list` and `stats` don't have to go to the API server.
+
+@since: 2026-10-18
+@status: beta
+"""
+
+import os
+import json
+import logging
+import socket
+import threading
+import SocketServer
+
+import kploycommon
+
+AGENT_SOCKET = ".kploy/agent.sock" # where the agent listens, relative to the app's directory
+AGENT_SYNC_TIMEOUT_IN_SEC = 10 # how long a query waits for the agent to have listed a kind
+AGENT_QUERY_TIMEOUT_IN_SEC = 5
+AGENT_RETRY_BACKOFF_IN_SEC = 1 # how long to wait before re-listing a kind after an error
+
+class AgentError(Exception):
+    """
+    Error when querying the agent: it can't answer the query, for example, because
+    it hasn't been able to list the resources of a kind yet.
+    """
+    pass
+
+def _owner_keys(pod):
+    """
+    The names of the RCs a pod belongs to, taken from its owner references or, if it
+    has none, derived from its generated name.
+    """
+    owners = [ref["name"] for ref in pod["metadata"].get("ownerReferences") or [] if ref.get("kind") == "ReplicationController"]
+    if not owners and pod["metadata"].get("generateName"):
+        owners = [pod["metadata"]["generateName"].rstrip("-")]
+    return owners
+
+def _address_keys(node):
+    """
+    Index keys of a node by address: its name and all of its addresses.
+    """
+    return [node["metadata"]["name"]] + [address["address"] for address in node["status"].get("addresses", [])]
+
+class Informer(threading.Thread):
+    """
+    Keeps the resources of a collection, such as the guarded pods of a namespace,
+    in memory: lists them once and then consumes the watch stream from that point on,
+    re-listing if the watch can't be resumed. Resources are indexed by name and by
+    the keys the `indexers` (a dict of index name to a function returning the keys of
+    a resource) return for them.
+    """
+
+    def __init__(self, pyk_client, kind, resources_path, indexers):
+        threading.Thread.__init__(self, name="informer-" + kind)
+        self.daemon = True
+        self.pyk_client = pyk_client
+        self.kind = kind
+        self.resources_path = resources_path
+        self.indexers = indexers
+        self.synced = threading.Event()
+        self.stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._items = {} # name -> resource
+        self._indices = dict([(index, {}) for index in indexers]) # index -> key -> set of names
+
+    def run(self):
+        resource_version = None
+        while not self.stopped.is_set():
+            try:
+                if resource_version is None:
+                    res = self.pyk_client.execute_operation(method="GET", ops_path=self.resources_path)
+                    if res.status_code != 200:
+                        raise AgentError("listing %s failed: %d %s" %(self.kind, res.status_code, res.reason))
+                    resources = res.json()
+                    self._replace(resources["items"])
+                    resource_version = resources["metadata"]["resourceVersion"]
+                    self.synced.set()
+                    logging.debug("Listed %d %s" %(len(resources["items"]), self.kind))
+                for event_type, item in kploycommon._watch(self.pyk_client, self.resources_path, resource_version, kploycommon.WATCH_TIMEOUT_IN_SEC):
+                    if self.stopped.is_set():
+                        return
+                    if event_type == "ERROR": # most likely our resource version expired
+                        resource_version = None
+                        break
+                    resource_version = item["metadata"]["resourceVersion"]
+                    if event_type == "DELETED":
+                        self._remove(item["metadata"]["name"])
+                    else:
+                        self._put(item)
+            except (Exception) as e:
+                if self.stopped.is_set():
+                    return
+                logging.info("Lost track of %s, listing them again: %s" %(self.kind, e))
+                self.synced.clear()
+                resource_version = None
+                self.stopped.wait(AGENT_RETRY_BACKOFF_IN_SEC)
+
+    def stop(self):
+        """
+        Stops keeping track of the resources, at the latest once the current watch ends.
+        """
+        self.stopped.set()
+
+    def _replace(self, items):
+        with self._lock:
+            self._items = {}
+            self._indices = dict([(index, {}) for index in self.indexers])
+            for item in items:
+                self._add(item)
+
+    def _put(self, item):
+        with self._lock:
+            self._discard(item["metadata"]["name"])
+            self._add(item)
+
+    def _remove(self, name):
+        with self._lock:
+            self._discard(name)
+
+    def _add(self, item):
+        name = item["metadata"]["name"]
+        self._items[name] = item
+        for index, indexer in self.indexers.iteritems():
+            for key in indexer(item):
+                self._indices[index].setdefault(key, set()).add(name)
+
+    def _discard(self, name):
+        item = self._items.pop(name, None)
+        if item is None:
+            return
+        for index, indexer in self.indexers.iteritems():
+            for key in indexer(item):
+                names = self._indices[index].get(key)
+                if names is not None:
+                    names.discard(name)
+                    if not names:
+                        del self._indices[index][key]
+
+    def query(self, index=None, key=None):
+        """
+        Returns the resources, sorted by name: all of them, the one named `key` if the
+        `index` is `name`, or those with the `key` in the `index`.
+        """
+        if not self.synced.wait(AGENT_SYNC_TIMEOUT_IN_SEC):
+            raise AgentError("I don't know about the %s yet" %(self.kind))
+        with self._lock:
+            if index is None:
+                names = self._items.keys()
+            elif index == "name":
+                names = [key] if key in self._items else []
+            elif index in self._indices:
+                names = self._indices[index].get(key, ())
+            else:
+                raise AgentError("there's no %s index for %s" %(index, self.kind))
+            return [self._items[name] for name in sorted(names)]
+
+class AgentHandler(SocketServer.StreamRequestHandler):
+    """
+    Serves queries, one JSON object per line, and answers each with one JSON object per line:
+    `{"op": "info"}` tells which app the agent serves and
+    `{"op": "query", "kind": "nodes", "index": "address", "key": "10.0.0.1"}` returns resources,
+    see `Informer.query`.
+    """
+
+    def handle(self):
+        for line in iter(self.rfile.readline, ""):
+            try:
+                request = json.loads(line)
+                if request.get("op") == "info":
+                    response = {"apiserver": self.server.apiserver, "namespace": self.server.namespace}
+                elif request.get("op") == "query":
+                    informer = self.server.informers.get(request.get("kind"))
+                    if informer is None:
+                        raise AgentError("I don't keep track of %s" %(request.get("kind")))
+                    response = {"items": informer.query(request.get("index"), request.get("key"))}
+                else:
+                    raise AgentError("unknown operation %s" %(request.get("op")))
+            except (Exception) as e:
+                response = {"error": str(e)}
+            self.wfile.write(json.dumps(response) + "\n")
+            self.wfile.flush()
+
+class AgentServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """
+    The agent: one informer per kind of resource an app has, served over a Unix socket.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, pyk_client, apiserver, namespace):
+        SocketServer.UnixStreamServer.__init__(self, socket_path, AgentHandler)
+        self.apiserver = apiserver
+        self.namespace = namespace
+        ns_path = "".join(["/api/v1/namespaces/", namespace])
+        self.informers = {
+            "pods": Informer(pyk_client, "pods", ns_path + "/pods?labelSelector=guard%3Dpyk", {}),
+            "replicationcontrollers": Informer(pyk_client, "replicationcontrollers", ns_path + "/replicationcontrollers?labelSelector=guard%3Dpyk", {}),
+            "services": Informer(pyk_client, "services", ns_path + "/services?labelSelector=guard%3Dpyk", {}),
+            "secrets": Informer(pyk_client, "secrets", ns_path + "/secrets?labelSelector=guard%3Dpyk", {}),
+            "nodes": Informer(pyk_client, "nodes", "/api/v1/nodes", {"address": _address_keys})
+        }
+
+    def start_informers(self):
+        for informer in self.informers.values():
+            informer.start()
+
+    def stop_informers(self):
+        for informer in self.informers.values():
+            informer.stop()
+
+def serve(app_dir, pyk_client, apiserver, namespace):
+    """
+    Runs the agent for an app until interrupted. Refuses to start if another agent
+    is serving the app already; a socket left behind by an agent that's gone is removed.
+    """
+    socket_path = os.path.join(app_dir, AGENT_SOCKET)
+    if os.path.exists(socket_path):
+        if connect(app_dir) is not None:
+            raise AgentError("There's an agent running for this app already, see %s" %(socket_path))
+        os.remove(socket_path)
+    if not os.path.exists(os.path.dirname(socket_path)):
+        os.makedirs(os.path.dirname(socket_path))
+    server = AgentServer(socket_path, pyk_client, apiserver, namespace)
+    try:
+        server.start_informers()
+        server.serve_forever()
+    finally:
+        server.stop_informers()
+        server.server_close()
+        os.remove(socket_path)
+
+class AgentClient(object):
+    """
+    Queries the agent of an app over its Unix socket.
+    """
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+
+    def request(self, request):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(AGENT_QUERY_TIMEOUT_IN_SEC + AGENT_SYNC_TIMEOUT_IN_SEC)
+        try:
+            sock.connect(self.socket_path)
+            sock.sendall(json.dumps(request) + "\n")
+            response = json.loads(sock.makefile("rb").readline())
+        finally:
+            sock.close()
+        if "error" in response:
+            raise AgentError(response["error"])
+        return response
+
+    def query(self, kind, index=None, key=None):
+        """
+        Returns resources of a kind, see `Informer.query`.
+        """
+        return self.request({"op": "query", "kind": kind, "index": index, "key": key})["items"]
+
+def connect(app_dir, target=None):
+    """
+    Returns a client for the agent of the app in `app_dir` if one is running and, if
+    a target (see `kploycommon._targets`) is given, serves that target. Otherwise returns
+    None, so that the caller talks to the API server directly.
+    """
+    socket_path = os.path.join(app_dir, AGENT_SOCKET)
+    if not os.path.exists(socket_path):
+        return None
+    agent = AgentClient(socket_path)
+    try:
+        info = agent.request({"op": "info"})
+    except (socket.error, ValueError, AgentError) as e:
+        logging.debug("Can't reach the agent at %s: %s" %(socket_path, e))
+        return None
+    if target is not None and (info["apiserver"], info["namespace"]) != (target["apiserver"], target["namespace"]):
+        return None
+    return agent
+
+def query_or(agent, kind, fallback, index=None, key=None):
+    """
+    Asks the agent, if there is one (see `connect`), for resources of a kind, see `Informer.query`.
+    If there's no agent or it can't answer, for example, since it hasn't listed the kind yet
+    or isn't allowed to, returns what `fallback()` returns instead, which asks the API server.
+    """
+    if agent:
+        try:
+            return agent.query(kind, index, key)
+        except (socket.error, ValueError, AgentError) as e:
+            logging.debug("The agent can't tell about %s, asking the API server: %s" %(kind, e))
+    return fallback()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+"""
+The kploy benchmarks: runs kploy commands against the in-process fake API server
+(see `kployfake.py`) for apps of different sizes and reports wall time, number
+of requests and bytes transferred per command. No cluster or network needed:
+
+    $ python kploybench.py --sizes 10,100,1000 --latency 0.002
+
+@since: 2026-10-18
+@status: beta
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import yaml
+import kploy
+import kploycommon
+
+from StringIO import StringIO
+from time import time
+from tabulate import tabulate
+from kployfake import FakeAPIServer
+
+BENCH_NAMESPACE = "kploy-bench"
+BENCH_SIZES = "10,100,1000"
+BENCH_COMMANDS = ["run", "list", "stats", "scale", "destroy"]
+
+
+def _create_app(app_dir, api_server, size):
+    """
+    Creates an app with `size` manifests, half of them services and half of them RCs,
+    with one replica each, in `app_dir`.
+    """
+    os.makedirs(os.path.join(app_dir, kploy.RC_DIR))
+    os.makedirs(os.path.join(app_dir, kploy.SVC_DIR))
+    kployfile = {
+        "apiserver": api_server,
+        "author": "kploy",
+        "cache_remotes": False,
+        "name": "bench-%d" %(size),
+        "namespace": BENCH_NAMESPACE,
+        "source": "kploy"
+    }
+    with open(os.path.join(app_dir, kploy.DEPLOYMENT_DESCRIPTOR), "w") as f:
+        yaml.safe_dump(kployfile, f, default_flow_style=False)
+    for i in range(size):
+        name = "app-%04d" %(i / 2)
+        if i % 2 == 0:
+            manifest = {
+                "apiVersion": "v1",
+                "kind": "ReplicationController",
+                "metadata": {"name": name + "-rc"},
+                "spec": {
+                    "replicas": 1,
+                    "selector": {"app": name},
+                    "template": {
+                        "metadata": {"labels": {"app": name}},
+                        "spec": {"containers": [{"name": "web", "image": "nginx:1.9", "ports": [{"containerPort": 80}]}]}
+                    }
+                }
+            }
+            manifest_file = os.path.join(app_dir, kploy.RC_DIR, name + "-rc.yaml")
+        else:
+            manifest = {
+                "apiVersion": "v1",
+                "kind": "Service",
+                "metadata": {"name": name + "-svc"},
+                "spec": {
+                    "selector": {"app": name},
+                    "ports": [{"port": 80, "targetPort": 80}]
+                }
+            }
+            manifest_file = os.path.join(app_dir, kploy.SVC_DIR, name + "-svc.yaml")
+        with open(manifest_file, "w") as f:
+            yaml.safe_dump(manifest, f, default_flow_style=False)
+
+def _run_command(server, cmd, param):
+    """
+    Runs a kploy command in the current directory, swallowing its output,
+    and returns a result row: wall time, requests, bytes in/out and status.
+    """
+    server.cluster.reset_stats()
+    status = "OK"
+    stdout, sys.stdout = sys.stdout, StringIO()
+    start = time()
+    try:
+        getattr(kploy, "cmd_" + cmd)(param)
+    except SystemExit as e:
+        if e.code:
+            status = "FAILED"
+    except Exception as e:
+        status = "FAILED: %s" %(e)
+    finally:
+        elapsed = time() - start
+        sys.stdout = stdout
+    cluster = server.cluster
+    return [cmd, "%.3f" %(elapsed), cluster.requests, cluster.bytes_in, cluster.bytes_out, status]
+
+def bench(sizes, commands, latency, nodes):
+    """
+    Runs the `commands` for each app size in `sizes` against a fresh fake
+    API server and returns the result rows.
+    """
+    rows = []
+    here = os.getcwd()
+    for size in sizes:
+        server = FakeAPIServer(node_count=nodes, latency=latency).start()
+        app_dir = tempfile.mkdtemp(prefix="kploy-bench-")
+        try:
+            _create_app(app_dir, server.url, size)
+            os.chdir(app_dir)
+            for cmd in commands:
+                param = "app-0000-rc=3" if cmd == "scale" else None
+                row = _run_command(server, cmd, param)
+                print(tabulate([[size] + row], tablefmt="plain"))
+                rows.append([size] + row)
+        finally:
+            os.chdir(here)
+            kploycommon._http_session().close() # drop kept-alive connections to this server
+            shutil.rmtree(app_dir, ignore_errors=True)
+            server.stop()
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks kploy commands against an in-process fake Kubernetes API server",
+        epilog="Example: `python kploybench.py --sizes 10,100 --latency 0.005 --parallel 8`")
+    parser.add_argument("--sizes", help="comma-separated app sizes in manifests, defaults to %s" %(BENCH_SIZES), default=BENCH_SIZES)
+    parser.add_argument("--commands", help="comma-separated commands to run, in order, defaults to %s" %(",".join(BENCH_COMMANDS)), default=",".join(BENCH_COMMANDS))
+    parser.add_argument("--latency", help="latency in seconds the fake API server adds to each request, defaults to 0", type=float, default=0.0, metavar="SEC")
+    parser.add_argument("--nodes", help="number of nodes in the fake cluster, defaults to 3", type=int, default=3, metavar="N")
+    parser.add_argument("-p", "--parallel", help="value of kploy's `--parallel`, defaults to 1", type=int, default=1, metavar="N")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    kploy.PARALLEL = max(1, args.parallel)
+    sizes = [int(size) for size in args.sizes.split(",")]
+    commands = [cmd.strip() for cmd in args.commands.split(",")]
+    rows = bench(sizes, commands, args.latency, args.nodes)
+    print(80*"=")
+    print(tabulate(rows, ["SIZE", "COMMAND", "WALL (s)", "REQUESTS", "BYTES IN", "BYTES OUT", "STATUS"], tablefmt="plain"))
+
+if __name__ == "__main__":
+    main()
@@ -7,16 +7,108 @@ The kploy commons (utility) functions.
 """
 
 import os
-import logging
 import sys
+
+ENGINE = os.environ.get("KPLOY_ENGINE", "threads") # with `gevent`, concurrent work runs on greenlets rather than threads
+if ENGINE == "gevent": # must happen before the network and threading libraries are used
+    try:
+        from gevent import monkey
+        monkey.patch_all()
+    except ImportError:
+        sys.stderr.write("The gevent engine needs gevent, do a `pip install gevent`. Falling back to threads.\n")
+        ENGINE = "threads"
+
+import logging
+import base64
+import collections
+import contextlib
+import copy
+import functools
+import hashlib
+import json
+import re
+import shutil
+import tempfile
+import threading
 import zipfile
-from time import sleep
+import zlib
+from time import time, sleep, localtime
 
-import requests
-from pyk import toolkit
-from pyk import util
+PODS_UP_TIMEOUT_IN_SEC = 60 # how long to wait for an RC's pods to show up while owning them
+PODS_DOWN_TIMEOUT_IN_SEC = 60 # how long to wait for the pods of scaled down RCs to go away on destroy
+WATCH_TIMEOUT_IN_SEC = 300 # how long a watch lasts before it is renewed
+LABEL_WORKERS = 10 # how many resources to label concurrently
+NODE_FETCH_WORKERS = 10 # how many nodes to fetch concurrently
+DESTROY_WORKERS = 10 # how many resources to scale down or delete concurrently
+SCALE_WORKERS = 10 # how many RCs to scale concurrently
+PATCH_RETRIES = 5 # how often to try a patch on conflicts and transient errors
+PATCH_BACKOFF_IN_SEC = 0.1 # initial backoff between patch attempts, doubles with each retry
+PATCH_RETRY_STATUS_CODES = (409, 429, 500, 503, 504)
+MERGE_PATCH = "application/merge-patch+json"
+JSON_PATCH = "application/json-patch+json"
+DIGEST_ANNOTATION = "kploy.net/last-applied-digest" # digest of the manifest a resource was last deployed from
+LAST_APPLIED_ANNOTATION = "kploy.net/last-applied-manifest" # the (stamped) manifest a resource was last deployed from, as JSON
+DEPENDS_ON_ANNOTATION = "kploy.net/depends-on" # names of the services and RCs of the app a resource depends on
+SECRET_DIGESTS_ANNOTATION = "kploy.net/secret-digests" # digests of the keys of a Secret, as a JSON object
+APP_LABEL = "kploy.net/app" # the app a resource was deployed by, see `_app_label`
+SECRETS_NAME = "kploy-secrets" # name of the app's (first) Secret, see `_secret_name`
+SECRET_SHARD_SIZE = 900 * 1024 # in bytes, how much base64-encoded data to put in one Secret, below the API server's 1MB object limit
+SECRET_ANNOTATION_SIZE = 200 * 1024 # in bytes, how big the digests annotation of one Secret may get, below the 256kB annotations limit
+SECRET_CHUNK_SIZE = 64 * 1024 # in bytes
+RESOURCE_KINDS = {
+    "service": "Service",
+    "RC": "ReplicationController"
+}
+DNS_LABEL = re.compile(r"^[a-z0-9]([-a-z0-9]{0,61}[a-z0-9])?$") # what resource names must look like
+LABEL_VALUE = re.compile(r"^([A-Za-z0-9]([-A-Za-z0-9_.]{0,61}[A-Za-z0-9])?)?$") # what label values must look like
+RESOURCE_COLLECTIONS = {
+    "service": "services",
+    "RC": "replicationcontrollers"
+}
+CACHE_DIR = ".kploy/cache" # where kploy keeps local state, relative to the app's directory
+MANIFEST_INDEX_FILENAME = "manifests.json"
+REMOTES_DIR = "remotes" # content-addressed cache of remotes, within the cache directory
+REMOTE_INDEX_FILENAME = "remotes.json"
+REMOTE_FETCH_WORKERS = 8 # how many remotes to download concurrently
+PARSE_WORKERS = None # how many processes parse manifests, `None` means one per CPU
+PARSE_POOL_MIN_FILES = 100 # how many manifests need parsing at least before it's done in processes
+VALIDATION_INDEX_FILENAME = "validation.json"
+VALIDATION_RULES_VERSION = "1" # bump when the checks in `_check_manifest` change, so cached results are dropped
+HTTP_POOL_SIZE = None # how many connections to keep alive per host, `None` means as many as requests in flight, see `HTTP_HOST_CONCURRENCY`
+HTTP_TIMEOUT_IN_SEC = 30
+HTTP_KEEP_ALIVE = True
+HTTP_HOST_CONCURRENCY = 100 # how many requests to have in flight per host at most
+EXPORT_COMPRESS_LEVEL = 6 # zlib compression level for app archives, 0 means no compression
+UPLOAD_CHUNK_SIZE = 64 * 1024 # in bytes
+DOWNLOAD_CHUNK_SIZE = 64 * 1024 # in bytes
+DOWNLOAD_RETRIES = 5 # how often to try resuming an interrupted app download
+DOWNLOAD_SEGMENT_SIZE = 4 * 1024 * 1024 # in bytes, app archives bigger than this are downloaded in segments
+DOWNLOAD_WORKERS = 4 # how many segments of an app archive to download concurrently
+EXTRACT_CHUNK_SIZE = 64 * 1024 # in bytes
+PROFILE_TOP_CALLS = 10 # how many of the slowest calls the profile summary shows
 
-PODS_UP_DELAY_IN_SEC = 5 # how long to wait before trying to own RC's pods
+class DeploymentError(Exception):
+    """
+    Error when deploying resources: one or more manifests could not be deployed.
+    Holds the list of `(manifest file, error)` pairs in `errors`.
+    """
+    def __init__(self, errors):
+        self.errors = errors
+        Exception.__init__(self, "\n".join(["%s: %s" %(file_name, e) for file_name, e in errors]))
+
+class TeardownError(DeploymentError):
+    """
+    Error when destroying an app: one or more resources could not be destroyed.
+    Holds the list of `(resource, error)` pairs in `errors`.
+    """
+    pass
+
+class ScaleError(DeploymentError):
+    """
+    Error when scaling RCs: one or more RCs could not be scaled.
+    Holds the list of `(RC name, error)` pairs in `errors`.
+    """
+    pass
 
 def _fmt_cmds(cmds):
     """
@@ -28,25 +120,112 @@ def _fmt_cmds(cmds):
         fk += "`" + k + "`, "
     return fk
 
+class ClusterConnectionError(Exception):
+    """
+    Error when talking to the Kubernetes cluster: the API server can't be reached.
+    """
+    pass
+
+_clients = {} # API server -> client
+
 def _connect(api_server, debug):
     """
-    Tries to connect to cluster and ping it.
-    If successful it returns the Pyk client.
+    Returns the Pyk client for a cluster. No request is made here: whether the cluster
+    is reachable turns out with the first operation, which raises a `ClusterConnectionError`
+    if it is not. Clients are created once per API server and share the HTTP session.
     """
-    try:
-        pyk_client = toolkit.KubeHTTPClient(kube_version="1.1", api_server=api_server, debug=debug)
-        pyk_client.execute_operation(method="GET", ops_path="/api/v1")
-    except:
-        print("\nCan't connect to the Kubernetes cluster at %s\nCheck the `apiserver` setting in your Kployfile, your Internet connection or maybe it's a VPN issue?" %(api_server))
-        sys.exit(1)
-    return pyk_client
+    import kployhttp # the network libraries are only imported when kploy talks to a cluster
+    if api_server not in _clients:
+        _clients[api_server] = kployhttp.KployHTTPClient(kube_version="1.1", api_server=api_server, debug=debug)
+    return _clients[api_server]
 
-def _visit(dir_name, resource_name, cache_remotes=False):
+def _targets(kploy):
     """
-    Walks a given directory and returns list of resource manifest files (in YAML format).
-    It will also dereference and download remotes (manifest files that end in a `.url`).
+    Returns the targets of an app: for each entry in the `targets` list of the Kployfile,
+    a copy of the Kployfile's settings with the target's `apiserver` and `namespace`
+    (either defaults to the top-level setting). Without a `targets` list, the app has
+    a single target, the top-level `apiserver` and `namespace`. Each target's `target`
+    field holds its `name` or, if it has none, `namespace@apiserver`.
     """
-    flist = []
+    targets = []
+    for entry in kploy.get("targets") or [{}]:
+        target = dict(kploy)
+        target.pop("targets", None)
+        target["apiserver"] = entry.get("apiserver", kploy.get("apiserver"))
+        target["namespace"] = entry.get("namespace", kploy.get("namespace"))
+        target["target"] = entry.get("name") or "@".join([target["namespace"], target["apiserver"]])
+        targets.append(target)
+    return targets
+
+def _fan_out(func, targets):
+    """
+    Calls `func(target)` for all targets concurrently, if there are several, each in
+    a phase named after the target. Returns a list of `(target, result, error)` triples,
+    in the order of the targets, where `error` is the exception `func` raised, if any.
+    """
+    def call_one(target):
+        try:
+            return (target, func(target), None)
+        except (Exception) as e:
+            logging.debug("Failed on target %s: %s" %(target["target"], e))
+            return (target, None, e)
+    def call(target):
+        with _phase(target["target"]):
+            return call_one(target)
+    if len(targets) == 1:
+        return [call_one(targets[0])]
+    return _pmap(call, targets, len(targets))
+
+def _check_fan_out(results):
+    """
+    Checks the results of `_fan_out`: raises the error of a failed single target as is,
+    and if there are several targets, a `DeploymentError` with all failed targets.
+    """
+    failed = [(target["target"], e) for target, _, e in results if e is not None]
+    if failed and len(results) == 1:
+        raise results[0][2]
+    if failed:
+        raise DeploymentError(failed)
+
+def _fmt_fan_out(results):
+    """
+    Formats the results of `_fan_out` as rows of target, API server, namespace and
+    result (`OK`, or `FAILED` with the first line of the error).
+    """
+    rows = []
+    for target, _, e in results:
+        result = "OK" if e is None else "FAILED: %s" %(str(e).split("\n")[0])
+        rows.append([target["target"], target["apiserver"], target["namespace"], result])
+    return rows
+
+def _configure_http(pool_size=None, timeout=None, keep_alive=None, host_concurrency=None):
+    """
+    Configures the HTTP session shared by all requests kploy makes: how many connections
+    to keep per host, the request timeout in seconds, if connections are kept alive and
+    how many requests to have in flight per host at most. Must be called before the first request.
+    """
+    global HTTP_POOL_SIZE, HTTP_TIMEOUT_IN_SEC, HTTP_KEEP_ALIVE, HTTP_HOST_CONCURRENCY
+    if pool_size:
+        HTTP_POOL_SIZE = pool_size
+    if timeout:
+        HTTP_TIMEOUT_IN_SEC = timeout
+    if keep_alive is not None:
+        HTTP_KEEP_ALIVE = keep_alive
+    if host_concurrency:
+        HTTP_HOST_CONCURRENCY = host_concurrency
+
+def _visit(dir_name, resource_name, cache_remotes=False, offline=False, errors=None):
+    """
+    Walks a given directory and returns list of resource manifest records, one for
+    each manifest file (in YAML format) found. A record is a dict with the `file` name,
+    its `path`, the parsed `manifest`, its `kind` and `name` as well as the `digest`
+    of the file content. Records come from the manifest index, see `_load_manifest`.
+    It will also dereference and download remotes (manifest files that end in a `.url`),
+    see `_fetch_remotes`, and include the downloaded manifests; `offline`, it only includes
+    remotes downloaded before. Files that aren't valid YAML are added as `(path, error)`
+    pairs to `errors`, if given, and left out, otherwise it raises a `DeploymentError` with all of them.
+    """
+    flist, remote_ref_file_names = [], []
     logging.debug("Visiting %s" %dir_name)
     for _, _, file_names in os.walk(dir_name):
         for afile in file_names:
@@ -57,10 +236,325 @@ def _visit(dir_name, resource_name, cache_remotes=False):
                 else:
                     logging.debug("Ignoring unknown file %s for now" %(afile))
             else: # we have a remote, for example, `abc.yaml.url`
-                remote_ref_file_name = os.path.join(dir_name, afile)
-                file_name = _download_remote(remote_ref_file_name, do_cache=cache_remotes)
-                logging.debug("Skipping remote %s manifest %s" %(resource_name, file_name))
-    return flist
+                remote_ref_file_names.append(os.path.join(dir_name, afile))
+    if offline:
+        remote_file_names = [_deref_remote(remote_ref_file_name) for remote_ref_file_name in remote_ref_file_names]
+        for file_name in [file_name for file_name in remote_file_names if not os.path.exists(file_name)]:
+            logging.info("Skipping remote %s, I don't have it locally" %(file_name))
+        remote_file_names = [file_name for file_name in remote_file_names if os.path.exists(file_name)]
+    else:
+        remote_file_names = _fetch_remotes(dir_name, remote_ref_file_names, cache_remotes)
+    for file_name in remote_file_names:
+        afile = os.path.basename(file_name)
+        logging.debug("Got remote %s manifest %s" %(resource_name, afile))
+        if afile not in flist:
+            flist.append(afile)
+    index = _index(_cache_dir(dir_name), MANIFEST_INDEX_FILENAME)
+    read = _read_manifests(index, [os.path.join(dir_name, afile) for afile in flist])
+    mlist, parse_errors = [], []
+    for afile in flist:
+        try:
+            mlist.append(_load_manifest(index, dir_name, afile, read.get(os.path.join(dir_name, afile))))
+        except (ValueError) as e:
+            parse_errors.append((os.path.join(dir_name, afile), e))
+    _save_index(index)
+    if parse_errors and errors is None:
+        raise DeploymentError(parse_errors)
+    if parse_errors:
+        errors += parse_errors
+    return mlist
+
+def _cache_dir(dir_name):
+    """
+    Determines the cache directory of the app a manifest directory, such as `rcs/`, belongs to.
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(dir_name.rstrip(os.sep))), CACHE_DIR)
+
+_kployfiles = {} # Kployfile -> ((mtime, size), parsed Kployfile)
+
+def _load_kployfile(file_name):
+    """
+    Returns the parsed Kployfile, parsing the file only if it changed since the last call,
+    so that commands run one after the other in the same process (see `kploy shell`)
+    parse it once.
+    """
+    from pyk import util
+    st = os.stat(file_name)
+    cached = _kployfiles.get(file_name)
+    if not cached or cached[0] != (st.st_mtime, st.st_size):
+        kploy, _ = util.load_yaml(filename=file_name)
+        cached = _kployfiles[file_name] = ((st.st_mtime, st.st_size), kploy)
+    return copy.deepcopy(cached[1])
+
+_indices = {} # index file -> index, loaded once per process
+
+def _index(cache_dir, index_filename):
+    """
+    Loads an index, a JSON object kept in a file in the cache directory.
+    For example, the manifest index maps manifest file paths to manifest records, see `_visit`.
+    """
+    index_file_name = os.path.join(cache_dir, index_filename)
+    if index_file_name not in _indices:
+        entries = {}
+        if os.path.exists(index_file_name):
+            try:
+                with open(index_file_name, "r") as index_file:
+                    entries = json.load(index_file)
+            except (IOError, ValueError) as e:
+                logging.debug("Ignoring unreadable index %s: %s" %(index_file_name, e))
+        _indices[index_file_name] = {"file": index_file_name, "entries": entries, "dirty": False}
+    return _indices[index_file_name]
+
+def _save_index(index):
+    """
+    Writes an index back to disk, if it has changed.
+    """
+    if not index["dirty"]:
+        return
+    try:
+        _write_atomically(index["file"], json.dumps(index["entries"]))
+        index["dirty"] = False
+    except (IOError, OSError) as e:
+        logging.debug("Can't write index %s: %s" %(index["file"], e))
+
+_umask = os.umask(0) # mkstemp creates files only the owner can read, see `_write_atomically`
+os.umask(_umask)
+
+def _write_atomically(file_name, content):
+    """
+    Writes content to a file via a temporary file of its own and a rename, so that readers
+    never see a partially written file, even if several threads write the same file.
+    """
+    dir_name = os.path.dirname(file_name) or "."
+    try:
+        os.makedirs(dir_name)
+    except OSError:
+        if not os.path.isdir(dir_name):
+            raise
+    fd, tmp_file_name = tempfile.mkstemp(dir=dir_name, prefix=os.path.basename(file_name) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            tmp_file.write(content)
+        os.chmod(tmp_file_name, 0o666 & ~_umask)
+        os.rename(tmp_file_name, file_name)
+    except:
+        os.remove(tmp_file_name)
+        raise
+
+def _is_indexed(index, file_name):
+    """
+    Checks if the manifest index has an up-to-date record of a manifest file, that is,
+    one with the file's current mtime and size.
+    """
+    st = os.stat(file_name)
+    entry = index["entries"].get(file_name)
+    return entry is not None and entry["mtime"] == st.st_mtime and entry["size"] == st.st_size
+
+def _read_manifest(file_name_and_digest):
+    """
+    Reads a manifest file, given along with the digest it was last indexed with, if any.
+    Returns a `(digest, manifest, error)` triple: the manifest is only parsed if the
+    digest differs, otherwise it's `None`, and the error is a message if the file isn't
+    a valid YAML mapping. Runs in worker processes, see `_read_manifests`.
+    """
+    import yaml
+    file_name, known_digest = file_name_and_digest
+    with open(file_name, "rb") as manifest_file:
+        content = manifest_file.read()
+    digest = hashlib.sha256(content).hexdigest()
+    if digest == known_digest:
+        return (digest, None, None)
+    logging.debug("Parsing manifest %s" %(file_name))
+    try:
+        res_manifest = yaml.safe_load(content) or {}
+    except (yaml.YAMLError) as e:
+        mark = getattr(e, "problem_mark", None)
+        where = " at line %d, column %d" %(mark.line + 1, mark.column + 1) if mark else ""
+        return (digest, None, "isn't valid YAML: %s%s" %(getattr(e, "problem", None) or e, where))
+    if not isinstance(res_manifest, dict):
+        return (digest, None, "isn't a YAML mapping")
+    return (digest, res_manifest, None)
+
+def _read_manifests(index, file_names):
+    """
+    Reads the manifest files that changed since they were indexed, see `_read_manifest`,
+    with a pool of `PARSE_WORKERS` processes, as parsing YAML is CPU-bound. Only worth
+    it for at least `PARSE_POOL_MIN_FILES` files on more than one CPU (and not with the
+    gevent engine), otherwise nothing is read here and `_load_manifest` reads the files one
+    by one. Returns a dict of file names to what `_read_manifest` returned.
+    """
+    stale = [file_name for file_name in file_names if not _is_indexed(index, file_name)]
+    if len(stale) < PARSE_POOL_MIN_FILES or ENGINE == "gevent":
+        return {}
+    import multiprocessing
+    workers = PARSE_WORKERS or multiprocessing.cpu_count()
+    if workers < 2:
+        return {}
+    args = [(file_name, (index["entries"].get(file_name) or {}).get("digest")) for file_name in stale]
+    pool = multiprocessing.Pool(workers)
+    try:
+        results = pool.map(_read_manifest, args, chunksize=max(1, len(args) / (4 * workers)))
+    finally:
+        pool.close()
+        pool.join()
+    return dict(zip(stale, results))
+
+def _load_manifest(index, dir_name, afile, read=None):
+    """
+    Returns the manifest record of a manifest file, parsing the file only if needed.
+    A cached record is used as long as the file's mtime and size are unchanged, or,
+    if they changed, as long as the content digest is unchanged. If the file has been
+    read already, see `_read_manifests`, `read` holds the result. Raises a `ValueError`
+    if the file isn't a valid YAML mapping.
+    """
+    file_name = os.path.join(dir_name, afile)
+    st = os.stat(file_name)
+    entry = index["entries"].get(file_name)
+    if entry and entry["mtime"] == st.st_mtime and entry["size"] == st.st_size:
+        logging.debug("Using indexed manifest %s" %(file_name))
+    else:
+        digest, res_manifest, error = read or _read_manifest((file_name, entry["digest"] if entry else None))
+        if error:
+            raise ValueError(error)
+        if res_manifest is not None:
+            metadata = res_manifest.get("metadata") or {}
+            entry = {
+                "kind": res_manifest.get("kind"),
+                "name": metadata.get("name"),
+                "digest": digest,
+                "manifest": res_manifest
+            }
+        entry["mtime"] = st.st_mtime
+        entry["size"] = st.st_size
+        index["entries"][file_name] = entry
+        index["dirty"] = True
+    record = dict(entry)
+    record["file"] = afile
+    record["path"] = file_name
+    record["manifest"] = copy.deepcopy(entry["manifest"])
+    return record
+
+def _validate(app_dir, svc_list, rc_list):
+    """
+    Validates the manifest records of an app's services and RCs, see `_visit`, without
+    talking to a cluster: each manifest on its own, see `_check_manifest`, with the results
+    kept in the validation index per manifest digest, so unchanged manifests aren't checked
+    again, and then all manifests together, see `_check_app`. Returns a list of
+    `(manifest file, problem)` pairs.
+    """
+    index = _index(os.path.join(app_dir, CACHE_DIR), VALIDATION_INDEX_FILENAME)
+    entries, problems = {}, []
+    for resource_name, alist in [("service", svc_list), ("RC", rc_list)]:
+        for litem in alist:
+            key = ":".join([VALIDATION_RULES_VERSION, resource_name, litem["digest"]])
+            if key not in index["entries"]:
+                logging.debug("Checking manifest %s" %(litem["path"]))
+                index["entries"][key] = _check_manifest(litem["manifest"], resource_name)
+                index["dirty"] = True
+            entries[key] = index["entries"][key]
+            problems += [(litem["path"], problem) for problem in entries[key]]
+    if len(entries) != len(index["entries"]): # forget about manifests that are gone
+        index["entries"] = entries
+        index["dirty"] = True
+    _save_index(index)
+    return problems + _check_app(svc_list, rc_list)
+
+def _check_manifest(res_manifest, resource_name):
+    """
+    Checks a service or RC manifest on its own: its `kind` and `apiVersion`, its name,
+    that an RC's selector matches the labels of its pod template, which has containers
+    with names and images, and that a service has ports. Returns a list of problems.
+    """
+    problems = []
+    if res_manifest.get("kind") != RESOURCE_KINDS[resource_name]:
+        problems.append("kind is %s, expected %s" %(res_manifest.get("kind"), RESOURCE_KINDS[resource_name]))
+    if res_manifest.get("apiVersion") != "v1":
+        problems.append("apiVersion is %s, expected v1" %(res_manifest.get("apiVersion")))
+    metadata = res_manifest.get("metadata")
+    res_name = metadata.get("name") if isinstance(metadata, dict) else None
+    if not res_name:
+        problems.append("metadata.name is missing")
+    elif not isinstance(res_name, basestring) or not DNS_LABEL.match(res_name):
+        problems.append("metadata.name %s isn't a DNS label: at most 63 lowercase letters, digits and `-`" %(res_name))
+    spec = res_manifest.get("spec")
+    if not isinstance(spec, dict):
+        problems.append("spec is missing")
+        return problems
+    if resource_name == "RC":
+        selector = spec.get("selector")
+        template = spec.get("template") if isinstance(spec.get("template"), dict) else {}
+        labels = _template_labels(res_manifest)
+        if not isinstance(selector, dict) or not selector:
+            problems.append("spec.selector is missing")
+        elif any(labels.get(k) != v for k, v in selector.iteritems()):
+            problems.append("spec.selector %s doesn't match the pod template's labels %s" %(_fmt_labels(selector), _fmt_labels(labels)))
+        replicas = spec.get("replicas", 1)
+        if not isinstance(replicas, int) or replicas < 0:
+            problems.append("spec.replicas is %s, expected a number of at least 0" %(replicas))
+        pod_spec = template.get("spec") if isinstance(template.get("spec"), dict) else {}
+        containers = pod_spec.get("containers")
+        if not isinstance(containers, list) or not containers:
+            problems.append("spec.template.spec.containers is missing")
+        else:
+            for i, container in enumerate(containers):
+                if not isinstance(container, dict) or not container.get("name") or not container.get("image"):
+                    problems.append("spec.template.spec.containers[%d] needs a name and an image" %(i))
+    else:
+        ports = spec.get("ports")
+        if not isinstance(ports, list) or not ports:
+            problems.append("spec.ports is missing")
+        else:
+            for i, port in enumerate(ports):
+                if not isinstance(port, dict) or not isinstance(port.get("port"), int):
+                    problems.append("spec.ports[%d] needs a port number" %(i))
+    return problems
+
+def _check_app(svc_list, rc_list):
+    """
+    Checks the service and RC manifests of an app together: names must be unique per
+    kind and the selector of a service, if it has one, must match the pods of some RC.
+    Returns a list of `(manifest file, problem)` pairs.
+    """
+    problems = []
+    for resource_name, alist in [("service", svc_list), ("RC", rc_list)]:
+        litems = {} # resource name -> manifest records
+        for litem in alist:
+            if litem["name"]:
+                litems.setdefault(litem["name"], []).append(litem)
+        for res_name, same_name in sorted(litems.iteritems()):
+            for litem in same_name[1:]:
+                problems.append((litem["path"], "the %s name %s is used by %s already" %(resource_name, res_name, same_name[0]["file"])))
+    pods_with = {} # label, as `key=value` -> indices of the RCs whose pods have it
+    for i, litem in enumerate(rc_list):
+        for k, v in _template_labels(litem["manifest"]).iteritems():
+            pods_with.setdefault("%s=%s" %(k, v), set()).add(i)
+    for litem in svc_list:
+        spec = litem["manifest"].get("spec")
+        selector = spec.get("selector") if isinstance(spec, dict) else None
+        if not isinstance(selector, dict) or not selector:
+            continue
+        matching = None
+        for k, v in selector.iteritems():
+            rcs = pods_with.get("%s=%s" %(k, v), set())
+            matching = rcs if matching is None else matching & rcs
+        if not matching:
+            problems.append((litem["path"], "spec.selector %s doesn't match the pods of any RC" %(_fmt_labels(selector))))
+    return problems
+
+def _template_labels(res_manifest):
+    """
+    Returns the labels of the pod template of an RC manifest, an empty dict if it has none.
+    """
+    labels = res_manifest
+    for field in ["spec", "template", "metadata", "labels"]:
+        labels = labels.get(field) if isinstance(labels, dict) else None
+    return labels if isinstance(labels, dict) else {}
+
+def _fmt_labels(labels):
+    """
+    Formats labels or a selector like a label selector: `app=web,tier=frontend`.
+    """
+    return ",".join(["%s=%s" %(k, v) for k, v in sorted(labels.iteritems())])
 
 def _dump(alist):
     """
@@ -69,108 +563,771 @@ def _dump(alist):
     for litem in alist:
         logging.info("-> %s" %litem)
 
-def _deploy(pyk_client, namespace, here, dir_name, alist, resource_name, verbose):
+def _workers(threads):
     """
-    Deploys resources based on manifest files. Currently the following resources are supported:
-    replication controllers, services.
+    Returns how many workers to use for a batch of independent requests: `threads` with
+    threads, while with the gevent engine, where workers cost next to nothing, as many as
+    there may be requests in flight per host, see `HTTP_HOST_CONCURRENCY`.
     """
-    for litem in alist:
-        file_name = os.path.join(os.path.join(here, dir_name), litem)
-        if verbose: logging.info("Deploying %s %s" %(resource_name, file_name))
-        if resource_name == "service":
-            _, res_path = pyk_client.create_svc(manifest_filename=file_name, namespace=namespace)
-        elif resource_name == "RC":
-            _, res_path = pyk_client.create_rc(manifest_filename=file_name, namespace=namespace)
-        if verbose: logging.info("Now trying to own %s" %(res_path))
-        _own_resource(pyk_client, res_path, verbose)
-        res = pyk_client.describe_resource(res_path)
-        logging.debug(res.json())
-        # now make sure that a RC's pods are also owned:
+    if ENGINE == "gevent":
+        return max(threads, HTTP_HOST_CONCURRENCY)
+    return threads
+
+def _pmap(func, alist, workers=1):
+    """
+    Applies `func` to each item of the list, using a pool of `workers` threads (or
+    greenlets, with the gevent engine) if more than one worker is requested.
+    Results keep the order of the list.
+    """
+    from multiprocessing.pool import ThreadPool
+    if workers <= 1 or len(alist) <= 1:
+        return [func(litem) for litem in alist]
+    func = _in_phase(func)
+    if ENGINE == "gevent": # greenlets are cheap, no need for a pool of threads
+        import gevent.pool
+        return gevent.pool.Pool(min(workers, len(alist))).map(func, alist)
+    pool = ThreadPool(min(workers, len(alist)))
+    try:
+        return pool.map(func, alist)
+    finally:
+        pool.close()
+        pool.join()
+
+def _schedule(tasks, workers=1):
+    """
+    Runs a graph of tasks, using up to `workers` concurrent workers. `tasks` is a dict of
+    task name to `(func, dependencies, after)`, where `func` takes no arguments, `dependencies`
+    is a list of names of tasks that must have succeeded before it can start and `after`
+    a list of names of tasks that must have finished, successfully or not. Tasks are
+    started as soon as they can, in the order they were given in if there is a choice
+    (that is, pass an `OrderedDict`). If a task fails, all tasks that depend on it, directly
+    or indirectly, are skipped; tasks that merely run after it are not. Returns a list of
+    `(task name, error)` pairs for the failed and skipped tasks.
+    """
+    from multiprocessing.pool import ThreadPool
+    followers = dict([(name, []) for name in tasks]) # task -> tasks that wait for it
+    for name, (_, dependencies, after) in tasks.iteritems():
+        for predecessor in set(dependencies + after): # once, even if it's named several times
+            if predecessor not in tasks:
+                raise DeploymentError([(name, "depends on %s, which is not part of the app" %(predecessor))])
+            followers[predecessor].append(name)
+    _check_acyclic(tasks, followers)
+    waiting_for = dict([(name, set(dependencies + after)) for name, (_, dependencies, after) in tasks.iteritems()])
+    finished = [] # (task name, error or None), filled by the workers
+    cond = threading.Condition()
+    @_in_phase
+    def run(name):
+        error = None
+        try:
+            tasks[name][0]()
+        except (Exception) as e:
+            logging.debug("Task %s failed: %s" %(name, e))
+            error = e
+        with cond:
+            finished.append((name, error))
+            cond.notify()
+    def finish(name, failed_task):
+        # a task is done: returns the tasks that can start now, skipping the ones that
+        # depend on it if it failed (or was skipped, because `failed_task` failed)
+        ready = []
+        for follower in followers[name]:
+            if follower not in waiting_for: # skipped already, because of another failed task
+                continue
+            if failed_task is not None and name in tasks[follower][1]:
+                errors.append((follower, "skipped, because %s failed" %(failed_task)))
+                del waiting_for[follower]
+                ready += finish(follower, failed_task)
+            else:
+                waiting_for[follower].discard(name)
+                if not waiting_for[follower]:
+                    ready.append(follower)
+        return ready
+    errors = []
+    pool = ThreadPool(max(1, workers))
+    try:
+        running = 0
+        for name in tasks:
+            if not waiting_for[name]:
+                pool.apply_async(run, (name,))
+                running += 1
+        while running:
+            with cond:
+                while not finished:
+                    cond.wait(1) # with a timeout, so that we stay interruptible
+                name, error = finished.pop(0)
+            running -= 1
+            if error is not None:
+                errors.append((name, error))
+            for follower in finish(name, name if error is not None else None):
+                pool.apply_async(run, (follower,))
+                running += 1
+    finally:
+        pool.close()
+        pool.join()
+    return errors
+
+def _check_acyclic(tasks, followers):
+    """
+    Makes sure a graph of tasks, see `_schedule`, has no cycles, raising a `DeploymentError` otherwise.
+    """
+    in_degree = dict([(name, len(set(dependencies + after))) for name, (_, dependencies, after) in tasks.iteritems()])
+    ready = [name for name in tasks if in_degree[name] == 0]
+    while ready:
+        name = ready.pop()
+        for follower in followers[name]:
+            in_degree[follower] -= 1
+            if in_degree[follower] == 0:
+                ready.append(follower)
+    cyclic = [name for name in tasks if in_degree[name] > 0]
+    if cyclic:
+        raise DeploymentError([(name, "is part of a dependency cycle") for name in cyclic])
+
+def _deploy(pyk_client, namespace, secrets, svc_list, rc_list, verbose, workers=1, app=None):
+    """
+    Deploys an app: its namespace, secrets and the services and RCs based on manifest
+    records, see `_visit`. The deployment is a graph of tasks, see `_schedule`: the secrets
+    and services depend on the namespace, the RCs depend on the namespace and the secrets
+    and run after all services, successful or not, so that the services show up in the
+    environment of the RCs' pods. Up to `workers` independent tasks run concurrently. Using
+    the `kploy.net/depends-on` annotation a manifest can name the services and RCs of the app
+    it depends on instead (comma-separated), which lets RCs start before unrelated services
+    are done; a name refers to the service of that name if there is one, otherwise to the
+    RC, but never to the manifest itself, so an RC `web` can depend on its service `web`.
+    Resources are labeled with the name of the `app`, see `_stamp_manifest`. Since the pod
+    template of an RC is guarded, see `_guard_manifest`, its pods are owned as they are created. Rather than aborting on the first failure, it returns a list of
+    `(manifest file or task, error)` pairs, where tasks that depend on a failed one are skipped.
+    """
+    tasks = collections.OrderedDict()
+    tasks["namespace"] = (lambda: _create_ns(pyk_client, namespace, verbose), [], [])
+    tasks["secrets"] = (lambda: _sync_secrets(pyk_client, namespace, secrets, verbose, workers), ["namespace"], [])
+    names = {"service": {}, "RC": {}} # kind -> resource name -> task names, that is, manifest files
+    for resource_name, alist in [("service", svc_list), ("RC", rc_list)]:
+        for litem in alist:
+            names[resource_name].setdefault(litem["name"], []).append(litem["path"])
+    for resource_name, alist in [("service", svc_list), ("RC", rc_list)]:
+        for litem in alist:
+            hints = ((litem["manifest"].get("metadata") or {}).get("annotations") or {}).get(DEPENDS_ON_ANNOTATION)
+            dependencies, after = set(["namespace", "secrets"] if resource_name == "RC" else ["namespace"]), []
+            if hints:
+                for hint in [hint.strip() for hint in hints.split(",") if hint.strip()]:
+                    svc_paths = [path for path in names["service"].get(hint, []) if path != litem["path"]]
+                    rc_paths = [path for path in names["RC"].get(hint, []) if path != litem["path"]]
+                    if svc_paths or rc_paths:
+                        dependencies.update(svc_paths or rc_paths)
+                    elif hint not in names["service"] and hint not in names["RC"]: # unless it's the manifest itself
+                        dependencies.add(hint)
+            elif resource_name == "RC": # a service that fails shouldn't hold back the RCs
+                after = [svc["path"] for svc in svc_list]
+            tasks[litem["path"]] = (functools.partial(_deploy_manifest, pyk_client, namespace, litem, resource_name, verbose, app), sorted(dependencies), after)
+    return _schedule(tasks, workers)
+
+def _deploy_manifest(pyk_client, namespace, litem, resource_name, verbose, app=None):
+    """
+    Deploys a single resource based on its manifest record. The resource is owned
+    from the start: the `guard=pyk` label is added to the manifest before creating it.
+    """
+    file_name = litem["path"]
+    if verbose: logging.info("Deploying %s %s" %(resource_name, file_name))
+    res_manifest = _stamp_manifest(litem, resource_name, app)
+    res = _create_resource(pyk_client, namespace, res_manifest, resource_name)
+    logging.info("From %s I created the %s %s at %s" %(file_name, resource_name, res_manifest["metadata"]["name"], res.json()["metadata"]["selfLink"]))
+
+def _stamp_manifest(litem, resource_name, app=None):
+    """
+    Prepares the manifest of a manifest record for deployment: guards it, see `_guard_manifest`,
+    labels it with the `app` it belongs to, see `_app_label`, and annotates it with the digest of the manifest file, so that later on we can tell
+    if the resource is up to date, see `_plan`, and with the manifest itself, so that an
+    update can remove what was taken out of the manifest, see `_three_way_patch`. The record
+    itself is not changed, so it can be deployed to several targets at the same time.
+    """
+    res_manifest = _guard_manifest(copy.deepcopy(litem["manifest"]), resource_name)
+    if app is not None:
+        _add_label(res_manifest["metadata"], APP_LABEL, _app_label(app))
+    _add_annotation(res_manifest["metadata"], DIGEST_ANNOTATION, litem["digest"])
+    _add_annotation(res_manifest["metadata"], LAST_APPLIED_ANNOTATION, json.dumps(res_manifest, sort_keys=True, separators=(",", ":")))
+    return res_manifest
+
+def _three_way_patch(live, res_manifest):
+    """
+    Creates a merge patch that takes a live resource to a (stamped) manifest, see
+    `_stamp_manifest`, based on the manifest the resource was last deployed from rather
+    than on the live resource itself: fields that were removed from the manifest are
+    removed from the resource, while fields the manifest never had, such as the ones
+    the API server fills in, are left alone. For resources deployed without the last
+    manifest, the patch is the manifest itself, which can't remove anything.
+    """
+    last_applied = ((live or {}).get("metadata", {}).get("annotations") or {}).get(LAST_APPLIED_ANNOTATION)
+    if not last_applied:
+        return res_manifest
+    return _diff_manifests(json.loads(last_applied), res_manifest)
+
+def _diff_manifests(original, modified):
+    """
+    Creates a JSON merge patch (RFC 7386) that turns `original` into `modified`.
+    """
+    patch = {}
+    for k in original:
+        if k not in modified:
+            patch[k] = None
+    for k, v in modified.iteritems():
+        if isinstance(v, dict) and isinstance(original.get(k), dict):
+            diff = _diff_manifests(original[k], v)
+            if diff:
+                patch[k] = diff
+        elif k not in original or original[k] != v:
+            patch[k] = v
+    return patch
+
+def _guard_manifest(res_manifest, resource_name):
+    """
+    Labels a manifest with `guard=pyk` (in memory). For RCs the pod template is labeled
+    as well, so that the RC's pods are owned as soon as they are created.
+    """
+    _add_label(res_manifest["metadata"], "guard", "pyk")
+    if resource_name == "RC":
+        _add_label(res_manifest["spec"]["template"]["metadata"], "guard", "pyk")
+    return res_manifest
+
+def _app_label(app):
+    """
+    Returns the value of the `kploy.net/app` label for an app name: the name itself
+    if it's a valid label value, otherwise a digest of it.
+    """
+    if LABEL_VALUE.match(app):
+        return app
+    return hashlib.sha256(app.encode("utf-8")).hexdigest()[:63]
+
+def _add_label(metadata, key, value):
+    """
+    Adds a label to the metadata of a resource.
+    """
+    labels = metadata.get("labels") or {}
+    labels[key] = value
+    metadata["labels"] = labels
+
+def _add_annotation(metadata, key, value):
+    """
+    Adds an annotation to the metadata of a resource.
+    """
+    annotations = metadata.get("annotations") or {}
+    annotations[key] = value
+    metadata["annotations"] = annotations
+
+def _resource_path(namespace, resource_name, res_name=None):
+    """
+    Creates the path of a resource, or if no name is given, of the resource's collection:
+    ("myns", "RC", "webserver-rc") -> /api/v1/namespaces/myns/replicationcontrollers/webserver-rc
+    """
+    res_path = "".join(["/api/v1/namespaces/", namespace, "/", RESOURCE_COLLECTIONS[resource_name]])
+    if res_name:
+        res_path = "".join([res_path, "/", res_name])
+    return res_path
+
+def _create_resource(pyk_client, namespace, res_manifest, resource_name):
+    """
+    Creates a resource from a manifest with a single POST.
+    """
+    from pyk import toolkit
+    from pyk import util
+    create_path = _resource_path(namespace, resource_name)
+    res = pyk_client.execute_operation(method="POST", ops_path=create_path, payload=util.serialize_tojson(res_manifest))
+    if "selfLink" not in res.json().get("metadata", {}):
+        raise toolkit.ResourceCRUDException("".join(["Sorry, can not create the ", resource_name, ": ", res_manifest["metadata"]["name"], ". Maybe it exists already?"]))
+    return res
+
+def _destroy(pyk_client, namespace, svc_list, rc_list, verbose, workers=None):
+    """
+    Destroys the services and RCs of an app based on manifest records, see `_visit`,
+    along with its secrets and namespace, using up to `workers` concurrent workers:
+    services are deleted while the RCs are scaled down to 0, then it watches the pods
+    of the RCs until they are gone and deletes the RCs. Resources that don't exist are
+    skipped. Only if all of that worked out, the namespace is deleted (unless it's `default`).
+    Raises a `TeardownError` with the `(name, error)` pairs of all resources it could not destroy.
+    """
+    workers = workers or _workers(DESTROY_WORKERS)
+    def scale_down(rc_path):
+        if verbose: logging.info("Scaling down RC %s to 0" %(rc_path))
+        res = _patch_resource(pyk_client, rc_path, {"spec": {"replicas": 0}})
+        if res.status_code == 200:
+            return res.json()["spec"]["selector"]
+        if res.status_code != 404: # unless the RC is already gone
+            errors.append((rc_path, "%d %s" %(res.status_code, res.reason)))
+    def destroy_one(task):
+        resource_name, res_path = task
         if resource_name == "RC":
-            _own_pods_of_rc(pyk_client, res, namespace, res_path, verbose)
+            return scale_down(res_path)
+        _delete_resource(pyk_client, res_path, verbose, errors)
+    errors = []
+    svc_paths = [_resource_path(namespace, "service", litem["name"]) for litem in svc_list]
+    rc_paths = [_resource_path(namespace, "RC", litem["name"]) for litem in rc_list]
+    with _phase("scale down"):
+        selectors = _pmap(destroy_one, [("service", res_path) for res_path in svc_paths] + [("RC", res_path) for res_path in rc_paths], workers)
+    selectors = [selector for selector in selectors if selector]
+    with _phase("pods"):
+        _wait_for_pods_gone(pyk_client, namespace, selectors, verbose)
+    with _phase("RCs"):
+        _pmap(lambda rc_path: _delete_resource(pyk_client, rc_path, verbose, errors), rc_paths, workers)
+    with _phase("secrets"):
+        try:
+            secret_names = [res_name for res_name in _list_guarded(pyk_client, namespace, "secrets", missing_ok=True) if _is_secret_name(res_name)]
+        except (Exception) as e:
+            errors.append(("secrets", e))
+            secret_names = []
+        _pmap(lambda res_name: _delete_resource(pyk_client, "".join(["/api/v1/namespaces/", namespace, "/secrets/", res_name]), verbose, errors), secret_names, workers)
+    if errors:
+        raise TeardownError(errors)
+    if namespace != "default":
+        with _phase("namespace"):
+            _delete_resource(pyk_client, "".join(["/api/v1/namespaces/", namespace]), verbose, errors)
+        if errors:
+            raise TeardownError(errors)
+
+def _delete_resource(pyk_client, resource_path, verbose, errors):
+    """
+    Deletes a resource; one that doesn't exist counts as deleted. Failures are
+    added as `(resource path, error)` pairs to `errors`.
+    """
+    if verbose: logging.info("Deleting %s" %(resource_path))
+    res = pyk_client.execute_operation(method="DELETE", ops_path=resource_path)
+    if res.status_code not in (200, 404):
+        errors.append((resource_path, "%d %s" %(res.status_code, res.reason)))
 
-def _destroy(pyk_client, namespace, here, dir_name, alist, resource_name, verbose):
+def _wait_for_pods_gone(pyk_client, namespace, selectors, verbose):
+    """
+    Waits until there are no pods left that match any of the label `selectors` (dicts),
+    that is, until the pods of RCs that have been scaled down to 0 are gone. Lists the
+    pods of the namespace once and then watches them, for at most `PODS_DOWN_TIMEOUT_IN_SEC`.
     """
-    Destroys resources based on manifest files. Currently the following resources are supported:
-    replication controllers, services.
+    if not selectors:
+        return
+    pods_path = "".join(["/api/v1/namespaces/", namespace, "/pods"])
+    def matches(pod):
+        labels = pod["metadata"].get("labels") or {}
+        return any(all(labels.get(k) == v for k, v in selector.iteritems()) for selector in selectors)
+    deadline = time() + PODS_DOWN_TIMEOUT_IN_SEC
+    resource_version = None
+    remaining = set()
+    while True:
+        if resource_version is None: # (re-)list to get in sync with the pods
+            pods = _list_resources(pyk_client, pods_path)
+            remaining = set([pod["metadata"]["name"] for pod in pods["items"] if matches(pod)])
+            resource_version = pods["metadata"]["resourceVersion"]
+        if not remaining or time() >= deadline:
+            break
+        if verbose: logging.info("Waiting for %d pod(s) to terminate" %(len(remaining)))
+        with _span("wait for pods to terminate"):
+            for event_type, pod in _watch(pyk_client, pods_path, resource_version, deadline - time()):
+                if event_type == "ERROR": # most likely our resource version expired
+                    resource_version = None
+                    break
+                resource_version = pod["metadata"]["resourceVersion"]
+                if event_type == "DELETED":
+                    remaining.discard(pod["metadata"]["name"])
+                elif matches(pod):
+                    remaining.add(pod["metadata"]["name"])
+                if not remaining:
+                    break
+    if remaining:
+        logging.info("Gave up waiting for %d pod(s) to terminate after %d sec" %(len(remaining), PODS_DOWN_TIMEOUT_IN_SEC))
+
+def _plan(live_index, alist, app):
     """
+    Plans how to get from the live resources of a kind, as returned by `_list_guarded`,
+    to the resources described by manifest records. Returns a list of `(action, name, item)`
+    triples, where the action is `create`, `update` or `unchanged` (the item being the
+    manifest record) or `prune` (the item being the live resource, which has no manifest).
+    A resource is up to date if it was last deployed from a manifest with the same digest.
+    Only resources labeled as deployed by the `app`, see `_stamp_manifest`, are pruned,
+    so that apps can share a namespace.
+    """
+    plan = []
+    names = set()
     for litem in alist:
-        file_name = os.path.join(os.path.join(here, dir_name), litem)
-        if file_name.endswith(".url"):
-            file_name = _deref_remote(file_name)
-        if verbose: logging.info("Trying to destroy %s %s" %(resource_name, file_name))
-        res_manifest, _  = util.load_yaml(filename=file_name)
-        res_name = res_manifest["metadata"]["name"]
-        if resource_name == "service":
-            res_path = "".join(["/api/v1/namespaces/", namespace, "/services/", res_name])
-        elif resource_name == "RC":
-            res_path = "".join(["/api/v1/namespaces/", namespace, "/replicationcontrollers/", res_name])
-            res = pyk_client.describe_resource(res_path)
-            if res.status_code == 404:  # the replication controller is already gone
-                break                   # ... don't try to scale down
-            else:
-                resource = res.json()
-                resource["spec"]["replicas"] = 0
-                if verbose: logging.info("Scaling down RC %s to 0" %(res_path))
-                pyk_client.execute_operation(method='PUT', ops_path=res_path, payload=util.serialize_tojson(resource))
-        else: return None
-        pyk_client.delete_resource(resource_path=res_path)
+        names.add(litem["name"])
+        live = live_index.get(litem["name"])
+        if live is None:
+            plan.append(("create", litem["name"], litem))
+        elif (live["metadata"].get("annotations") or {}).get(DIGEST_ANNOTATION) != litem["digest"]:
+            plan.append(("update", litem["name"], litem))
+        else:
+            plan.append(("unchanged", litem["name"], litem))
+    for res_name in sorted(live_index.keys()):
+        if res_name not in names and (live_index[res_name]["metadata"].get("labels") or {}).get(APP_LABEL) == _app_label(app):
+            plan.append(("prune", res_name, live_index[res_name]))
+    return plan
 
-def _check_status(pyk_client, resource_path):
+def _apply(pyk_client, namespace, plan, resource_name, verbose, workers=1, prune=False, live_index=None, app=None):
     """
-    Checks the status of a resources.
+    Carries out a plan, see `_plan`, sending requests only for resources that are not
+    up to date: creates missing resources of the `app`, updates changed ones with a merge patch against
+    the live resources in `live_index`, see `_three_way_patch`, and, if asked to, deletes
+    the ones without a manifest, RCs only once their pods are gone. Returns a list of
+    `(resource name, error)` pairs, like `_deploy`.
     """
-    res = pyk_client.describe_resource(resource_path)
-    logging.debug(res.json())
-    if res.status_code == 200: return "online"
-    else: return "offline"
+    from pyk import toolkit
+    live_index = live_index or {}
+    def apply_one(step):
+        action, res_name, item = step
+        res_path = _resource_path(namespace, resource_name, res_name)
+        try:
+            if action == "create":
+                if verbose: logging.info("Creating %s %s" %(resource_name, res_name))
+                _create_resource(pyk_client, namespace, _stamp_manifest(item, resource_name, app), resource_name)
+            elif action == "update":
+                if verbose: logging.info("Updating %s %s" %(resource_name, res_name))
+                res = _patch_resource(pyk_client, res_path, _three_way_patch(live_index.get(res_name), _stamp_manifest(item, resource_name, app)))
+                if res.status_code != 200:
+                    raise toolkit.ResourceCRUDException("Sorry, can not update the %s %s: %d %s" %(resource_name, res_name, res.status_code, res.reason))
+            elif action == "prune" and prune:
+                if verbose: logging.info("Pruning %s %s" %(resource_name, res_name))
+                if resource_name == "RC": # scale down first, so that the pods go away, too
+                    res = _patch_resource(pyk_client, res_path, {"spec": {"replicas": 0}})
+                    if res.status_code != 200:
+                        raise toolkit.ResourceCRUDException("Sorry, can not scale down the %s %s: %d %s" %(resource_name, res_name, res.status_code, res.reason))
+                    _wait_for_pods_gone(pyk_client, namespace, [res.json()["spec"]["selector"]], verbose)
+                pyk_client.delete_resource(resource_path=res_path)
+        except (Exception) as e:
+            logging.debug("Failed to %s %s %s: %s" %(action, resource_name, res_name, e))
+            return (res_name, e)
+    steps = [step for step in plan if step[0] in ("create", "update", "prune")]
+    return [error for error in _pmap(apply_one, steps, workers) if error]
+
+def _list_guarded(pyk_client, namespace, res_collection, missing_ok=False):
+    """
+    Lists all resources of a kind, such as `services`, that are owned by kploy
+    (labeled with `guard=pyk`) with a single request. Returns them indexed by name.
+    Raises if they can't be listed, unless `missing_ok` and the namespace doesn't exist.
+    """
+    from pyk import toolkit
+    guarded_path = "".join(["/api/v1/namespaces/", namespace, "/", res_collection, "?labelSelector=guard%3Dpyk"])
+    res = pyk_client.execute_operation(method="GET", ops_path=guarded_path)
+    if res.status_code == 404 and missing_ok:
+        return {}
+    if res.status_code != 200:
+        raise toolkit.ResourceCRUDException("Sorry, can not list the %s: %d %s" %(res_collection, res.status_code, res.reason))
+    return dict([(item["metadata"]["name"], item) for item in res.json()["items"]])
+
+def _get_nodes(pyk_client, node_names, workers=None):
+    """
+    Retrieves the nodes with the given names (or IPs), fetching them one by one and
+    concurrently, rather than the entire list of nodes in the cluster. If some of them
+    can't be found by name, it falls back to a single list of all nodes. Returns the nodes
+    indexed by name as well as by their addresses.
+    """
+    workers = workers or _workers(NODE_FETCH_WORKERS)
+    def get_one(node_name):
+        res = pyk_client.describe_resource("".join(["/api/v1/nodes/", node_name]))
+        if res.status_code == 200:
+            return res.json()
+    nodes_list = [node for node in _pmap(get_one, sorted(node_names), workers) if node]
+    if len(nodes_list) < len(node_names):
+        logging.debug("Not all nodes found by name, listing all nodes")
+        nodes_list = _list_resources(pyk_client, "/api/v1/nodes")["items"]
+    return _index_nodes(nodes_list)
+
+def _index_nodes(nodes_list):
+    """
+    Indexes nodes by name as well as by their addresses.
+    """
+    node_index = {}
+    for node in nodes_list:
+        node_index[node["metadata"]["name"]] = node
+        for address in node["status"].get("addresses", []):
+            node_index.setdefault(address["address"], node)
+    return node_index
 
 def _own_resource(pyk_client, resource_path, verbose):
     """
     Labels a resource with `guard=pyk` so that it can be
     selected with `?labelSelector=guard%3Dpyk`.
     """
-    res = pyk_client.describe_resource(resource_path)
-    resource = res.json()
-    if "labels" in resource["metadata"]:
-        labels = resource["metadata"]["labels"]
-    else:
-        labels = {}
-    labels["guard"] = "pyk"
-    resource["metadata"]["labels"] = labels
-    logging.debug("Owning resource, now labeled with: %s" %(resource["metadata"]["labels"]))
-    pyk_client.execute_operation(method='PUT', ops_path=resource_path, payload=util.serialize_tojson(resource))
+    from pyk import toolkit
+    failed = _label_resources(pyk_client, [resource_path], {"guard": "pyk"}, verbose)
+    if failed:
+        raise toolkit.ResourceCRUDException("Sorry, can not own %s: %s" %(failed[0]))
+
+def _label_resources(pyk_client, resource_paths, labels, verbose, workers=None):
+    """
+    Labels a number of resources concurrently. Each resource costs one small merge patch,
+    without fetching it first. Returns a list of `(resource path, error)` pairs for the
+    resources that could not be labeled.
+    """
+    workers = workers or _workers(LABEL_WORKERS)
+    patch = {"metadata": {"labels": labels}}
+    def label_one(resource_path):
+        if verbose: logging.info("Labeling %s with %s" %(resource_path, labels))
+        res = _patch_resource(pyk_client, resource_path, patch)
+        if res.status_code != 200:
+            return (resource_path, "%d %s" %(res.status_code, res.reason))
+    return [error for error in _pmap(label_one, resource_paths, workers) if error]
+
+def _patch_resource(pyk_client, resource_path, patch, patch_type=MERGE_PATCH):
+    """
+    Patches a resource with a merge patch (or the `patch_type` given), retrying with
+    exponential backoff on conflicts and transient server errors.
+    """
+    from pyk import util
+    payload = util.serialize_tojson(patch)
+    for attempt in range(PATCH_RETRIES):
+        res = pyk_client.execute_operation(method="PATCH", ops_path=resource_path, payload=payload, headers={"Content-Type": patch_type})
+        if res.status_code not in PATCH_RETRY_STATUS_CODES:
+            break
+        logging.debug("Got a %s HTTP status code patching %s, retrying" %(res.status_code, resource_path))
+        with _span("backoff"):
+            sleep(PATCH_BACKOFF_IN_SEC * 2**attempt)
+    return res
 
 def _own_pods_of_rc(pyk_client, rc, namespace, rc_path, verbose):
     """
-    Owns all pods a certain RC manages by labeling them with `guard=pyk`.
+    Owns all pods a certain RC manages by labeling them with `guard=pyk`, see `_own_pods`.
+    """
+    rc = rc.json()
+    _own_pods(pyk_client, namespace, rc["spec"]["selector"], rc["spec"]["replicas"], rc_path, verbose)
+
+def _own_pods(pyk_client, namespace, selector, replicas, rc_path, verbose):
+    """
+    Owns the pods an RC manages, that is, the pods matching its label `selector` (a dict),
+    by labeling them with `guard=pyk`. Pods that exist already are owned right away
+    (those that are guarded already cost nothing), then it watches for new pods of the
+    RC and owns them as they show up, until `replicas` pods are owned or
+    `PODS_UP_TIMEOUT_IN_SEC` have passed.
+    """
+    pods_of_rc_path = "".join(["/api/v1/namespaces/", namespace, "/pods?labelSelector=", _label_selector(selector)])
+    owned = set()
+    def own(pods):
+        unowned = []
+        for pod in pods:
+            if pod["metadata"].get("deletionTimestamp"): # on its way out, don't bother
+                continue
+            if pod["metadata"]["name"] in owned:
+                continue
+            if (pod["metadata"].get("labels") or {}).get("guard") != "pyk":
+                unowned.append(pod["metadata"]["selfLink"])
+            owned.add(pod["metadata"]["name"])
+        for pod_path, error in _label_resources(pyk_client, unowned, {"guard": "pyk"}, verbose):
+            logging.info("Can't own pod %s: %s" %(pod_path, error))
+            owned.discard(pod_path.split("/")[-1])
+    deadline = time() + PODS_UP_TIMEOUT_IN_SEC
+    resource_version = None
+    while True:
+        if resource_version is None: # (re-)list to get in sync with the pods of the RC
+            pods = _list_resources(pyk_client, pods_of_rc_path)
+            own(pods["items"])
+            resource_version = pods["metadata"]["resourceVersion"]
+        if len(owned) >= replicas or time() >= deadline:
+            break
+        if verbose: logging.info("Watching for %d more pod(s) of RC %s" %(replicas - len(owned), rc_path))
+        with _span("wait for pods of %s" %(rc_path.split("/")[-1])):
+            for event_type, pod in _watch(pyk_client, pods_of_rc_path, resource_version, deadline - time()):
+                if event_type == "ERROR": # most likely our resource version expired
+                    resource_version = None
+                    break
+                resource_version = pod["metadata"]["resourceVersion"]
+                if event_type == "DELETED":
+                    owned.discard(pod["metadata"]["name"])
+                else:
+                    own([pod])
+                if len(owned) >= replicas:
+                    break
+    if len(owned) < replicas:
+        logging.info("Gave up waiting for pods of RC %s after %d sec, owned %d of %d" %(rc_path, PODS_UP_TIMEOUT_IN_SEC, len(owned), replicas))
+
+def _scale(pyk_client, namespace, scale_defs, verbose, wait=False, workers=None):
+    """
+    Scales a number of RCs concurrently, using up to `workers` workers. `scale_defs` is a list
+    of `(RC name, replica count)` pairs. Each RC is scaled through its `scale` subresource
+    with a small merge patch, then its pods are owned, see `_own_pods`. With `wait`, it also
+    waits until the RCs have as many ready replicas as requested, see `_wait_for_replicas`.
+    Raises a `ScaleError` with the `(RC name, error)` pairs of all RCs it could not scale.
+    """
+    workers = workers or _workers(SCALE_WORKERS)
+    def scale_one(scale_def):
+        rc_name, replica_count = scale_def
+        rc_path = _resource_path(namespace, "RC", rc_name)
+        if verbose: logging.info("Scaling RC %s to %d replicas" %(rc_path, replica_count))
+        try:
+            res = _patch_resource(pyk_client, rc_path + "/scale", {"spec": {"replicas": replica_count}})
+            if res.status_code != 200:
+                return (rc_name, "%d %s" %(res.status_code, res.reason))
+            selector = res.json()["status"]["selector"]
+            if not isinstance(selector, dict): # autoscaling/v1 has it as a string, extensions/v1beta1 as a map
+                selector = _parse_label_selector(selector)
+            if replica_count > 0:
+                _own_pods(pyk_client, namespace, selector, replica_count, rc_path, verbose)
+        except (Exception) as e:
+            logging.debug("Failed to scale RC %s: %s" %(rc_path, e))
+            return (rc_name, e)
+    errors = [error for error in _pmap(scale_one, scale_defs, workers) if error]
+    if wait:
+        failed = set([rc_name for rc_name, _ in errors])
+        errors += _wait_for_replicas(pyk_client, namespace, dict([(rc_name, replica_count) for rc_name, replica_count in scale_defs if rc_name not in failed]), verbose)
+    if errors:
+        raise ScaleError(errors)
+
+def _wait_for_replicas(pyk_client, namespace, replica_counts, verbose):
     """
-    if verbose: logging.info("Waiting %d sec before looking for pods of RC %s" %(PODS_UP_DELAY_IN_SEC, rc_path))
-    sleep(PODS_UP_DELAY_IN_SEC)
-    pods_list = _get_pods_of_rc(pyk_client, rc.json(), namespace)
-    for pod in pods_list:
-        logging.debug("Now trying to own %s" %(pod["metadata"]["selfLink"]))
-        _own_resource(pyk_client, pod["metadata"]["selfLink"], verbose)
+    Waits until RCs have the number of ready replicas given in `replica_counts` (a dict of
+    RC name to replica count), for at most `PODS_UP_TIMEOUT_IN_SEC`. Lists the RCs of the
+    namespace once and then watches them. Returns `(RC name, error)` pairs for the RCs that
+    didn't get there in time.
+    """
+    if not replica_counts:
+        return []
+    rcs_path = _resource_path(namespace, "RC")
+    def is_ready(rc):
+        status = rc.get("status") or {}
+        replica_count = replica_counts[rc["metadata"]["name"]]
+        return status.get("replicas", 0) == replica_count and status.get("readyReplicas", status.get("replicas", 0)) == replica_count
+    deadline = time() + PODS_UP_TIMEOUT_IN_SEC
+    resource_version = None
+    pending = set(replica_counts.keys())
+    while True:
+        if resource_version is None: # (re-)list to get in sync with the RCs
+            rcs = _list_resources(pyk_client, rcs_path)
+            pending = set(replica_counts.keys())
+            for rc in rcs["items"]:
+                if rc["metadata"]["name"] in replica_counts and is_ready(rc):
+                    pending.discard(rc["metadata"]["name"])
+            resource_version = rcs["metadata"]["resourceVersion"]
+        if not pending or time() >= deadline:
+            break
+        if verbose: logging.info("Waiting for the replicas of %d RC(s) to be ready" %(len(pending)))
+        with _span("wait for replicas"):
+            for event_type, rc in _watch(pyk_client, rcs_path, resource_version, deadline - time()):
+                if event_type == "ERROR": # most likely our resource version expired
+                    resource_version = None
+                    break
+                resource_version = rc["metadata"]["resourceVersion"]
+                if rc["metadata"]["name"] in replica_counts and event_type != "DELETED":
+                    if is_ready(rc):
+                        pending.discard(rc["metadata"]["name"])
+                    else:
+                        pending.add(rc["metadata"]["name"])
+                if not pending:
+                    break
+    return [(rc_name, "replicas not ready after %d sec" %(PODS_UP_TIMEOUT_IN_SEC)) for rc_name in sorted(pending)]
 
-def _get_pods_of_rc(pyk_client, rc, namespace):
+def _parse_scale_defs(scale_defs):
+    """
+    Parses scale definitions, `rc=replica_count` pairs separated by whitespace or commas,
+    into a list of `(RC name, replica count)` pairs. A definition `@file` reads the pairs
+    from a file instead, one or more per line; lines starting with `#` are ignored.
+    Raises a `ValueError` for definitions it can't make sense of.
     """
-    Retrieves a list of all pods a certain RC manages.
+    pairs = []
+    for scale_def in scale_defs.replace(",", " ").split():
+        if scale_def.startswith("@"):
+            with open(scale_def[1:]) as scale_file:
+                pairs += _parse_scale_defs(" ".join([line for line in scale_file if not line.strip().startswith("#")]))
+            continue
+        rc_name, sep, replica_count = scale_def.partition("=")
+        if not sep or not rc_name or not replica_count.isdigit():
+            raise ValueError("`%s` is not of the form `rc=replica_count`" %(scale_def))
+        pairs.append((rc_name, int(replica_count)))
+    return pairs
+
+def _parse_label_selector(selector):
+    """
+    Parses a label selector in its string form into a dict: a=b,c=d -> {"a": "b", "c": "d"}
+    """
+    labels = {}
+    for term in selector.split(","):
+        if term.strip():
+            k, _, v = term.partition("=")
+            labels[k.strip()] = v.lstrip("=").strip()
+    return labels
+
+def _label_selector(labels):
+    """
+    Creates an URL-encoded label selector from a dict of labels: {"a": "b", "c": "d"} -> a%3Db,c%3Dd
     """
-    pods_selectors = rc["spec"]["selector"]
     sel = ""
-    for k, v in pods_selectors.iteritems():
+    for k, v in labels.iteritems():
         sel += "".join([k, "%3D", v , ","])
     if sel.endswith(","):
         sel = sel[:-1]
-    pods_of_rc_path = "".join(["/api/v1/namespaces/", namespace, "/pods?labelSelector=", sel])
-    pods = pyk_client.execute_operation(method="GET", ops_path=pods_of_rc_path)
-    pods_list = pods.json()["items"]
-    return pods_list
+    return sel
+
+def _follow(pyk_client, resources_path, on_change):
+    """
+    Keeps a table (a dict of name to resource) of a collection of resources up to date:
+    lists the resources once, then consumes the watch stream from that point on, calling
+    `on_change(table)` initially and every time the table changes. An expired watch is
+    renewed from the last seen resource version, and if that's too old it lists again.
+    Runs until interrupted.
+    """
+    table = {}
+    resource_version = None
+    while True:
+        if resource_version is None:
+            res = _list_resources(pyk_client, resources_path)
+            table = dict([(item["metadata"]["name"], item) for item in res["items"]])
+            resource_version = res["metadata"]["resourceVersion"]
+            on_change(table)
+        for event_type, item in _watch(pyk_client, resources_path, resource_version, WATCH_TIMEOUT_IN_SEC):
+            if event_type == "ERROR": # most likely our resource version expired
+                resource_version = None
+                break
+            resource_version = item["metadata"]["resourceVersion"]
+            if event_type == "DELETED":
+                table.pop(item["metadata"]["name"], None)
+            else:
+                table[item["metadata"]["name"]] = item
+            on_change(table)
+
+def _list_resources(pyk_client, resources_path):
+    """
+    Lists a collection of resources with a single request, returning the list (with its
+    `items` and `metadata`). Raises if they can't be listed, say, since the namespace
+    doesn't exist or we're not allowed to.
+    """
+    from pyk import toolkit
+    res = pyk_client.execute_operation(method="GET", ops_path=resources_path)
+    if res.status_code != 200:
+        raise toolkit.ResourceCRUDException("Sorry, can not list %s: %d %s" %(resources_path, res.status_code, res.reason))
+    return res.json()
+
+def _watch(pyk_client, resources_path, resource_version, timeout):
+    """
+    Watches a collection of resources, starting after a certain resource version,
+    and yields `(event type, object)` pairs as they come in. Ends when the API server
+    closes the watch, which it does at the latest after `timeout` seconds. If the
+    resource version is too old to start from, it yields an `ERROR` event with the
+    API server's status, like the API server does for watches that expire on the way,
+    and for any other failure to start the watch it raises.
+    """
+    import requests
+    from pyk import toolkit
+    if timeout <= 0:
+        return
+    sep = "&" if "?" in resources_path else "?"
+    watch_path = "".join([resources_path, sep, "watch=true&resourceVersion=", resource_version, "&timeoutSeconds=", str(int(timeout) + 1)])
+    res = pyk_client.execute_operation(method="GET", ops_path=watch_path, stream=True, timeout=timeout + 10)
+    try:
+        if res.status_code == 410: # gone, the caller has to list again
+            try:
+                status = res.json()
+            except ValueError:
+                status = {"kind": "Status", "code": res.status_code, "message": res.reason}
+            yield ("ERROR", status)
+            return
+        if res.status_code != 200:
+            raise toolkit.ResourceCRUDException("Sorry, can not watch %s: %d %s" %(resources_path, res.status_code, res.reason))
+        for line in res.iter_lines():
+            if line:
+                event = json.loads(line)
+                logging.debug("Got %s event for %s" %(event["type"], event["object"].get("metadata", {}).get("name")))
+                yield (event["type"], event["object"])
+    except requests.exceptions.RequestException as e:
+        logging.debug("Watch on %s ended: %s" %(resources_path, e))
+    finally:
+        res.close()
 
 def _create_ns(pyk_client, namespace, verbose):
     """
     Creates a new namespace, unless it's `default`.
     """
+    from pyk import util
     if namespace == "default":
         return
     else:
@@ -184,32 +1341,231 @@ def _create_ns(pyk_client, namespace, verbose):
         if verbose: logging.info("Created namespace: %s" %(ns))
         pyk_client.execute_operation(method='POST', ops_path="/api/v1/namespaces", payload=util.serialize_tojson(ns))
 
-def _download_remote(remote_ref_file_name, do_cache=False):
+def _fetch_remotes(dir_name, remote_ref_file_names, cache_remotes):
     """
-    Resolves a remote reference file by downloading its content.
+    Resolves remote reference files by downloading their content, concurrently and
+    over a shared HTTP session. Returns the list of (real) manifest file names.
+    The `cache_remotes` setting is a freshness policy: `False` means revalidate
+    remotes on every run, `True` means re-use local copies forever and a number
+    is the time in seconds a local copy is considered fresh.
     """
-    remote_content = ""
-    real_file_name = _deref_remote(remote_ref_file_name)
-    if do_cache: # re-use local copies of remotes
-        if not os.path.exists(real_file_name): # download remote if we don't have it locally yet
-            print "Downloading %s since I do not have it locally" %real_file_name
-            _download_by_URL(remote_ref_file_name, real_file_name)
-        else: # don't download if there is already a local copy (use cached version)
-            logging.debug("Using cached version")
-    else: # always download remotes
-        _download_by_URL(remote_ref_file_name, real_file_name)
-    return real_file_name
+    if not remote_ref_file_names:
+        return []
+    remotes_dir = os.path.join(_cache_dir(dir_name), REMOTES_DIR)
+    index = _index(remotes_dir, REMOTE_INDEX_FILENAME)
+    if cache_remotes is True:
+        ttl = None
+    else:
+        ttl = float(cache_remotes or 0)
+    file_names = _pmap(lambda remote_ref_file_name: _download_remote(remote_ref_file_name, index, remotes_dir, ttl),
+                       remote_ref_file_names, _workers(REMOTE_FETCH_WORKERS))
+    _save_index(index)
+    return file_names
 
-def _download_by_URL(remote_ref_file_name, real_file_name):
+def _download_remote(remote_ref_file_name, index, remotes_dir, ttl):
     """
-    Downloads the content of a file by URL.
+    Resolves a remote reference file by downloading its content, unless the local copy is
+    still fresh (younger than `ttl` seconds, `None` meaning forever). Remote content is
+    kept in a content-addressed cache, together with the `ETag` and `Last-Modified` headers
+    that are used to make conditional requests, so unchanged remotes are not downloaded again.
     """
+    real_file_name = _deref_remote(remote_ref_file_name)
     with open(remote_ref_file_name, "r") as remote_ref_file:
         res_URL = remote_ref_file.read().strip()
-        remote_content = requests.get(res_URL).text
+    entry = index["entries"].get(res_URL)
+    cached_file_name = os.path.join(remotes_dir, entry["digest"]) if entry else None
+    if entry and os.path.exists(real_file_name) and (ttl is None or time() - entry["fetched"] < ttl):
+        logging.debug("Using cached version of %s" %(res_URL))
+        return real_file_name
+    headers = {}
+    if entry and os.path.exists(cached_file_name):
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+    elif ttl is None:
+        print "Downloading %s since I do not have it locally" %real_file_name
+    res = _http_session().get(res_URL, headers=headers, timeout=HTTP_TIMEOUT_IN_SEC)
+    if res.status_code == 304:
+        logging.debug("Remote %s has not changed" %(res_URL))
+        with open(cached_file_name, "rb") as cached_file:
+            remote_content = cached_file.read()
+    elif res.status_code == 200:
+        remote_content = res.content
         logging.debug(remote_content)
-    with open(real_file_name, "w") as real_file:
-        real_file.write(remote_content)
+        digest = hashlib.sha256(remote_content).hexdigest()
+        cached_file_name = os.path.join(remotes_dir, digest)
+        if not os.path.exists(cached_file_name):
+            _write_atomically(cached_file_name, remote_content)
+        entry = {
+            "digest": digest,
+            "etag": res.headers.get("ETag"),
+            "last_modified": res.headers.get("Last-Modified")
+        }
+    else:
+        raise IOError("Can't download remote %s, got a %s HTTP status code" %(res_URL, res.status_code))
+    entry["fetched"] = time()
+    index["entries"][res_URL] = entry
+    index["dirty"] = True
+    if not _has_content(real_file_name, remote_content):
+        _write_atomically(real_file_name, remote_content)
+    return real_file_name
+
+def _has_content(file_name, content):
+    """
+    Checks if a file exists and has exactly the given content.
+    """
+    if not os.path.exists(file_name) or os.path.getsize(file_name) != len(content):
+        return False
+    with open(file_name, "rb") as f:
+        return f.read() == content
+
+_session = None
+_session_lock = threading.Lock()
+
+def _http_session():
+    """
+    Returns the HTTP session shared by all requests kploy makes, to the API server,
+    the registry and remotes alike, keeping up to `HTTP_POOL_SIZE` connections per host alive,
+    by default as many as there may be requests in flight, so that none are thrown away.
+    The session is created by the first thread that needs it.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = _new_http_session()
+    return _session
+
+def _new_http_session():
+    """
+    Creates an HTTP session as configured, see `_configure_http`.
+    """
+    import requests
+    import kployhttp
+    session = kployhttp.KploySession()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=HTTP_POOL_SIZE or HTTP_HOST_CONCURRENCY)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    if not HTTP_KEEP_ALIVE:
+        session.headers["Connection"] = "close"
+    return session
+
+def _count_chunks(chunks, counter):
+    """
+    Passes chunks through, adding up their size in `counter[0]`.
+    """
+    for chunk in chunks:
+        counter[0] += len(chunk)
+        yield chunk
+
+_trace = None # the trace events recorded while profiling, None if not profiling
+_trace_start = 0
+_phases = threading.local() # the stack of phases the command is in, per thread, see `_phase`
+
+def _start_profile():
+    """
+    Starts recording trace events for all requests, waits and phases.
+    """
+    global _trace, _trace_start
+    _trace = []
+    _trace_start = time()
+
+def _phase_stack():
+    """
+    Returns the stack of phases of the current thread.
+    """
+    if not hasattr(_phases, "stack"):
+        _phases.stack = []
+    return _phases.stack
+
+def _current_phase():
+    """
+    Returns the phase the command is in, such as `run/services`.
+    """
+    return "/".join(_phase_stack()) or "-"
+
+@contextlib.contextmanager
+def _phase(name):
+    """
+    Marks a phase of a command, for example `with _phase("services"): ...`. Phases nest
+    and every request made during a phase, also from workers, see `_in_phase`, is attributed to it.
+    """
+    _phase_stack().append(name)
+    phase = _current_phase()
+    start = time()
+    try:
+        yield
+    finally:
+        _record(phase, "phase", start, time(), {"phase": phase})
+        _phase_stack().pop()
+
+def _in_phase(func):
+    """
+    Wraps a function that is handed to a worker so that it runs in the phase the
+    wrapping thread is in.
+    """
+    stack = list(_phase_stack())
+    @functools.wraps(func)
+    def in_phase(*args, **kwargs):
+        _phases.stack = list(stack)
+        return func(*args, **kwargs)
+    return in_phase
+
+@contextlib.contextmanager
+def _span(name):
+    """
+    Marks time spent waiting rather than sending requests, for example on a watch or
+    backing off, so that it shows up in the profile.
+    """
+    phase = _current_phase()
+    start = time()
+    try:
+        yield
+    finally:
+        _record(name, "wait", start, time(), {"phase": phase})
+
+def _record(name, category, start, end, args):
+    """
+    Records a complete trace event, in Chrome trace-event format, if profiling.
+    """
+    if _trace is None:
+        return
+    _trace.append({
+        "name": name,
+        "cat": category,
+        "ph": "X",
+        "ts": int((start - _trace_start) * 1000000),
+        "dur": int((end - start) * 1000000),
+        "pid": os.getpid(),
+        "tid": threading.current_thread().ident,
+        "args": args
+    })
+
+def _write_profile(file_name, top=PROFILE_TOP_CALLS):
+    """
+    Stops recording, writes the recorded trace events to a file in Chrome trace-event
+    format (load it in `chrome://tracing`) and returns a summary: the `top` slowest
+    requests as rows of phase, method, path, status, latency in ms and bytes, and per
+    phase the number of requests, the time spent in requests and waiting and the wall
+    time in ms.
+    """
+    global _trace
+    trace, _trace = _trace, None
+    with open(file_name, "w") as trace_file:
+        json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, trace_file)
+    calls = [event for event in trace if event["cat"] == "http"]
+    calls.sort(key=lambda event: event["dur"], reverse=True)
+    slowest = [[event["args"]["phase"], event["args"]["method"], event["args"]["path"], event["args"]["status"],
+                event["dur"] / 1000, event["args"]["sent"] + event["args"]["received"]] for event in calls[:top]]
+    phases = {}
+    for event in trace:
+        totals = phases.setdefault(event["args"]["phase"], {"requests": 0, "http": 0, "wait": 0, "phase": 0})
+        if event["cat"] == "http":
+            totals["requests"] += 1
+        totals[event["cat"]] += event["dur"]
+    per_phase = [[phase, totals["requests"], totals["http"] / 1000, totals["wait"] / 1000, totals["phase"] / 1000]
+                 for phase, totals in sorted(phases.iteritems())]
+    return slowest, per_phase
 
 def _deref_remote(remote_ref_file_name):
     """
@@ -219,13 +1575,62 @@ def _deref_remote(remote_ref_file_name):
     logging.debug(real_file_name)
     return real_file_name
 
-def _export_init(here, deployment_descriptor, archive_filename):
+class _LeveledZipFile(zipfile.ZipFile):
     """
-    Creates the archive file to export the app into.
+    A zip file for writing, whose files are DEFLATE-compressed with a given level (1 to 9);
+    `zipfile` itself always uses zlib's default level.
+    """
+
+    def __init__(self, filename, compress_level):
+        zipfile.ZipFile.__init__(self, filename, mode='w', compression=zipfile.ZIP_DEFLATED)
+        self.compress_level = compress_level
+
+    def write(self, filename, arcname=None, compress_type=None):
+        """
+        Adds a file, streaming it chunk by chunk: the local header is written first and
+        patched with the CRC and sizes once the compressed data is written.
+        """
+        if os.path.isdir(filename):
+            return zipfile.ZipFile.write(self, filename, arcname, compress_type)
+        st = os.stat(filename)
+        zinfo = zipfile.ZipInfo(os.path.normpath(arcname or filename).lstrip(os.sep), localtime(st.st_mtime)[0:6])
+        zinfo.external_attr = (st.st_mode & 0xFFFF) << 16L # Unix attributes
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        zinfo.CRC, zinfo.file_size, zinfo.compress_size, zinfo.header_offset = 0, 0, 0, self.fp.tell()
+        self.fp.write(zinfo.FileHeader())
+        compressor = zlib.compressobj(self.compress_level, zlib.DEFLATED, -15) # a raw DEFLATE stream, as zip wants it
+        crc = 0
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+                zinfo.file_size += len(chunk)
+                crc = zlib.crc32(chunk, crc)
+                compressed = compressor.compress(chunk)
+                zinfo.compress_size += len(compressed)
+                self.fp.write(compressed)
+        compressed = compressor.flush()
+        zinfo.compress_size += len(compressed)
+        self.fp.write(compressed)
+        zinfo.CRC = crc & 0xffffffff
+        if max(zinfo.file_size, zinfo.compress_size, zinfo.header_offset) > zipfile.ZIP64_LIMIT:
+            raise zipfile.LargeZipFile("%s is too big for a zip file without ZIP64 extensions" %(filename))
+        end = self.fp.tell()
+        self.fp.seek(zinfo.header_offset)
+        self.fp.write(zinfo.FileHeader()) # same size as before, now with the CRC and sizes
+        self.fp.seek(end)
+        self.filelist.append(zinfo)
+        self.NameToInfo[zinfo.filename] = zinfo
+
+def _export_init(here, deployment_descriptor, archive_filename, compress_level=EXPORT_COMPRESS_LEVEL):
+    """
+    Creates the archive file to export the app into. The archive is DEFLATE-compressed
+    with the given level (0 to 9), unless the level is 0 in which case files are stored as-is.
     """
     kployfile = deployment_descriptor
     logging.debug("Trying to create app archive %s" %(archive_filename))
-    archive_file = zipfile.ZipFile(archive_filename, mode='w')
+    if compress_level:
+        archive_file = _LeveledZipFile(archive_filename, compress_level)
+    else:
+        archive_file = zipfile.ZipFile(archive_filename, mode='w', compression=zipfile.ZIP_STORED)
     logging.debug("Trying to add deployment descriptor %s" %(kployfile))
     archive_file.write(kployfile)
     return (archive_filename, archive_file)
@@ -245,74 +1650,427 @@ def _export_done(archive_file):
 
 def _init_from_archive(archive_filename):
     """
-    Creates a deployment from a given archive file.
+    Creates a deployment from a given archive file. Files are extracted chunk by chunk
+    and via a temporary file, so they are never partially written. Files that are already
+    there with the same size and CRC32 as in the archive are left alone. If any file in the
+    archive would end up outside of the current directory, nothing is extracted.
     """
     if zipfile.is_zipfile(archive_filename):
         archive_file = zipfile.ZipFile(archive_filename, mode='r')
-        files = archive_file.namelist()
-        logging.debug("Found the following in the archive: %s" %(files))
-        for file in files:
-            try:
-                data = archive_file.read(file)
-                with open(file, "w") as f:
-                    f.write(data)
-                logging.debug("Created %s" %(file))
-            except KeyError:
-                logging.debug("Did not find %s in archive" %(file))
-
-def _create_secrets(pyk_client, app_name, namespace, secrets, verbose):
-    """
-    Creates a Secret with a number of entries.
-    """
-    secret = {}
-    secret["kind"] = "Secret"
-    secret["apiVersion"] = "v1"
-    secret["metadata"] = {}
-    secret["metadata"]["name"] = "kploy-secrets"
-    secret["metadata"]["labels"] = {}
-    secret["metadata"]["labels"]["guard"] = "pyk"
-    secret["type"] = "Opaque"
-    secret["data"] = {}
-    for k, v in secrets.iteritems():
-        secret["data"][k] = v
-    if verbose: logging.info("Created secret: %s" %(secret))
+        try:
+            logging.debug("Found the following in the archive: %s" %(archive_file.namelist()))
+            for file_name in archive_file.namelist():
+                if not _is_within(file_name, "."):
+                    raise IOError("Refusing to extract %s from %s, it's outside of the app's directory" %(file_name, archive_filename))
+            for info in archive_file.infolist():
+                file_name = info.filename
+                dir_name = os.path.dirname(file_name)
+                if dir_name and not os.path.exists(dir_name):
+                    os.makedirs(dir_name)
+                if file_name.endswith("/"): # a directory entry
+                    continue
+                if _has_crc32(file_name, info.file_size, info.CRC):
+                    logging.debug("Skipping %s, it has not changed" %(file_name))
+                    continue
+                tmp_file_name = file_name + ".tmp"
+                member = archive_file.open(info)
+                try:
+                    with open(tmp_file_name, "wb") as f:
+                        shutil.copyfileobj(member, f, EXTRACT_CHUNK_SIZE)
+                finally:
+                    member.close()
+                os.rename(tmp_file_name, file_name)
+                logging.debug("Created %s" %(file_name))
+        finally:
+            archive_file.close()
+
+def _is_within(file_name, dir_name):
+    """
+    Checks if a relative file name, say of a file in an archive, stays within a directory:
+    it must not be absolute and must not climb out of the directory with `..`.
+    """
+    if os.path.isabs(file_name) or os.path.splitdrive(file_name)[0] or "\\" in file_name:
+        return False
+    root = os.path.realpath(dir_name)
+    path = os.path.realpath(os.path.join(root, file_name))
+    return path == root or path.startswith(root + os.sep)
+
+def _has_crc32(file_name, size, crc):
+    """
+    Checks if a file exists and has the given size and CRC32 checksum.
+    """
+    if not os.path.isfile(file_name) or os.path.getsize(file_name) != size:
+        return False
+    file_crc = 0
+    with open(file_name, "rb") as f:
+        for chunk in iter(lambda: f.read(EXTRACT_CHUNK_SIZE), b""):
+            file_crc = zlib.crc32(chunk, file_crc)
+    return (file_crc & 0xffffffff) == crc
+
+def _collect_secrets(env, secrets_file_ext):
+    """
+    Collects secrets from the files in the env directory with the given extension,
+    such as `env/dbpassword.secret`. Returns a dict of keys (file names without
+    extension) to secret records: the `path` of the file, the SHA-256 `digest` of its
+    content (without leading and trailing whitespace) and the `size` of its content
+    once base64-encoded. Files are read in chunks and their content isn't kept, see
+    `_secret_value` for getting it.
+    """
+    secrets = {}
+    logging.debug("Visiting %s" %env)
+    for _, _, file_names in os.walk(env):
+        for afile in file_names:
+            if afile.endswith(secrets_file_ext):
+                logging.debug("Got a secret input: %s" %(afile))
+                key = os.path.splitext(afile)[0]
+                logging.debug("Secret key: %s" %(key))
+                file_name = os.path.join(env, afile)
+                digest, size = hashlib.sha256(), 0
+                for chunk in _read_secret(file_name):
+                    digest.update(chunk)
+                    size += len(chunk)
+                secrets[key] = {"path": file_name, "digest": digest.hexdigest(), "size": (size + 2) / 3 * 4}
+                logging.debug("Secret digest: %s" %(secrets[key]["digest"]))
+    return secrets
+
+def _read_secret(file_name):
+    """
+    Yields the content of a secret file in chunks of about `SECRET_CHUNK_SIZE` bytes,
+    without leading and trailing whitespace.
+    """
+    with open(file_name, "rb") as sec_file:
+        pending = "" # whitespace that is only part of the content if something follows it
+        started = False
+        for chunk in iter(lambda: sec_file.read(SECRET_CHUNK_SIZE), b""):
+            if not started:
+                chunk = chunk.lstrip()
+                started = bool(chunk)
+            stripped = chunk.rstrip()
+            if stripped:
+                yield pending + stripped
+                pending = chunk[len(stripped):]
+            else:
+                pending += chunk
+
+def _secret_value(secret):
+    """
+    Returns the base64-encoded content of a secret record, see `_collect_secrets`,
+    encoding the file chunk by chunk.
+    """
+    encoded, rest = [], ""
+    for chunk in _read_secret(secret["path"]):
+        chunk = rest + chunk
+        cut = len(chunk) - len(chunk) % 3 # base64 encodes 3 bytes at a time
+        encoded.append(base64.b64encode(chunk[:cut]))
+        rest = chunk[cut:]
+    encoded.append(base64.b64encode(rest))
+    return "".join(encoded)
+
+def _secret_name(shard):
+    """
+    Returns the name of a shard of the app's secrets: `kploy-secrets` for the first,
+    `kploy-secrets-1`, `kploy-secrets-2` and so on for the others.
+    """
+    return SECRETS_NAME if shard == 0 else "%s-%d" %(SECRETS_NAME, shard)
+
+def _is_secret_name(res_name):
+    """
+    Checks if a Secret is a shard of the app's secrets, see `_secret_name`.
+    """
+    prefix = SECRETS_NAME + "-"
+    return res_name == SECRETS_NAME or (res_name.startswith(prefix) and res_name[len(prefix):].isdigit())
+
+def _secret_shard(res_name):
+    """
+    Returns the shard number of a Secret named by `_secret_name`.
+    """
+    return 0 if res_name == SECRETS_NAME else int(res_name[len(SECRETS_NAME) + 1:])
+
+def _shard_secrets(secrets, placements=None):
+    """
+    Splits secret records, see `_collect_secrets`, into shards, each of which becomes
+    one Secret whose data must stay within `SECRET_SHARD_SIZE` and whose digests annotation
+    within `SECRET_ANNOTATION_SIZE` bytes. `placements` maps keys to the shards they
+    are in now: such a key stays in its shard as long as it fits, so adding or removing
+    a secret doesn't move the others around. In order of their keys, the other secrets
+    go into the first shard with room, or a new one.
+    Returns a list of dicts of keys to secret records; there's always at least one shard.
+    Raises a `DeploymentError` if a single secret is too big for a Secret.
+    """
+    placements = placements or {}
+    shards, sizes = [], [] # sizes: shard -> [data size, annotation size]
+    def fits(shard, key_sizes):
+        while len(shards) <= shard:
+            shards.append({})
+            sizes.append([0, 0])
+        return not shards[shard] or (sizes[shard][0] + key_sizes[0] <= SECRET_SHARD_SIZE and sizes[shard][1] + key_sizes[1] <= SECRET_ANNOTATION_SIZE)
+    def put(shard, key, key_sizes):
+        shards[shard][key] = secrets[key]
+        sizes[shard][0] += key_sizes[0]
+        sizes[shard][1] += key_sizes[1]
+    unplaced = []
+    for key in sorted(secrets.keys()):
+        secret = secrets[key]
+        key_sizes = (len(key) + secret["size"], len(json.dumps({key: secret["digest"]})))
+        if key_sizes[0] > SECRET_SHARD_SIZE:
+            raise DeploymentError([(secret["path"], "is too big for a Secret: %d bytes base64-encoded, at most %d bytes are possible" %(secret["size"], SECRET_SHARD_SIZE))])
+        if key in placements and fits(placements[key], key_sizes):
+            put(placements[key], key, key_sizes)
+        else:
+            unplaced.append((key, key_sizes))
+    for key, key_sizes in unplaced:
+        shard = 0
+        while not fits(shard, key_sizes):
+            shard += 1
+        put(shard, key, key_sizes)
+    while len(shards) > 1 and not shards[-1]: # shards left empty at the end are no longer needed
+        shards.pop()
+    return shards or [{}]
+
+def _sync_secrets(pyk_client, namespace, secrets, verbose, workers=1):
+    """
+    Makes the app's Secrets hold the secret records, see `_collect_secrets`, which are
+    sharded across as many Secrets as needed, see `_shard_secrets`; a secret stays in the
+    Secret it is in already. Each Secret carries the digests of its keys in the
+    `kploy.net/secret-digests` annotation: a Secret whose
+    digests match is left alone, one that differs gets a merge patch with only the keys
+    that changed (and `null` for the ones that are gone) and a missing one is created,
+    so only changed secrets are read, encoded and sent. Secrets of shards that are no
+    longer needed are deleted. Uses a single list operation to find the live Secrets and
+    up to `workers` concurrent workers. Returns a list of `(action, name)` pairs, where
+    the action is `create`, `update`, `unchanged` or `delete`.
+    """
+    from pyk import toolkit
+    from pyk import util
+    def sync_one(step):
+        res_name, shard = step
+        live = live_index.get(res_name)
+        res_path = "".join([secrets_path, "/", res_name])
+        if shard is None:
+            if verbose: logging.info("Deleting secret %s, it's no longer needed" %(res_name))
+            errors = []
+            _delete_resource(pyk_client, res_path, verbose, errors)
+            if errors:
+                raise toolkit.ResourceCRUDException("Sorry, can not delete the secret %s: %s" %errors[0])
+            logging.info("I deleted the secret %s" %(res_name))
+            return ("delete", res_name)
+        digests = dict([(key, secret["digest"]) for key, secret in shard.iteritems()])
+        if live is None:
+            secret = {
+                "kind": "Secret",
+                "apiVersion": "v1",
+                "metadata": {
+                    "name": res_name,
+                    "labels": {"guard": "pyk"},
+                    "annotations": {SECRET_DIGESTS_ANNOTATION: json.dumps(digests, sort_keys=True)}
+                },
+                "type": "Opaque",
+                "data": dict([(key, _secret_value(secret)) for key, secret in shard.iteritems()])
+            }
+            if verbose: logging.info("Creating secret %s with keys %s" %(res_name, sorted(shard.keys())))
+            res = pyk_client.execute_operation(method="POST", ops_path=secrets_path, payload=util.serialize_tojson(secret))
+            if res.status_code != 201:
+                raise toolkit.ResourceCRUDException("Sorry, can not create the secret %s: %d %s" %(res_name, res.status_code, res.reason))
+            logging.info("I created the secret %s with %d key(s)" %(res_name, len(shard)))
+            return ("create", res_name)
+        try:
+            live_digests = json.loads((live["metadata"].get("annotations") or {}).get(SECRET_DIGESTS_ANNOTATION) or "{}")
+        except ValueError:
+            live_digests = {}
+        live_keys = set((live.get("data") or {}).keys())
+        changed = [key for key in shard if live_digests.get(key) != digests[key] or key not in live_keys]
+        gone = [key for key in live_keys if key not in shard]
+        if not changed and not gone:
+            return ("unchanged", res_name)
+        if verbose: logging.info("Updating secret %s, changed keys %s, removed keys %s" %(res_name, sorted(changed), sorted(gone)))
+        data = dict([(key, _secret_value(shard[key])) for key in changed] + [(key, None) for key in gone])
+        patch = {"metadata": {"annotations": {SECRET_DIGESTS_ANNOTATION: json.dumps(digests, sort_keys=True)}}, "data": data}
+        res = _patch_resource(pyk_client, res_path, patch)
+        if res.status_code != 200:
+            raise toolkit.ResourceCRUDException("Sorry, can not update the secret %s: %d %s" %(res_name, res.status_code, res.reason))
+        logging.info("I updated %d and removed %d key(s) of the secret %s" %(len(changed), len(gone), res_name))
+        return ("update", res_name)
     secrets_path = "".join(["/api/v1/namespaces/", namespace, "/secrets"])
-    pyk_client.execute_operation(method='POST', ops_path=secrets_path, payload=util.serialize_tojson(secret))
+    live_index = dict([(res_name, item) for res_name, item in _list_guarded(pyk_client, namespace, "secrets").iteritems() if _is_secret_name(res_name)])
+    placements = {}
+    for res_name in sorted(live_index.keys(), key=_secret_shard, reverse=True): # a key found twice stays in the first shard
+        placements.update(dict.fromkeys((live_index[res_name].get("data") or {}).keys(), _secret_shard(res_name)))
+    shards = _shard_secrets(secrets, placements)
+    steps = [(_secret_name(i), shard) for i, shard in enumerate(shards)]
+    steps += [(res_name, None) for res_name in sorted(live_index.keys()) if res_name not in dict(steps)]
+    return _pmap(sync_one, steps, workers)
 
 def _push_app_archive(workspace, local_app_archive, registry_endpoint, verbose):
     """
     Uploads the local app archive into a workspace at a remote registry.
+    The archive is streamed, so memory use does not depend on the archive size.
     """
     operation_path_URL = "".join([registry_endpoint, "/app", "?workspace=", workspace])
     logging.debug("OPERATION URL:\n%s" %(operation_path_URL))
     with open(local_app_archive, "rb") as laa:
-        archive_content = laa.read()
-        res = requests.request("POST", operation_path_URL, data=archive_content)
+        # stream the archive in chunks rather than reading it into memory:
+        res = _http_session().request("POST", operation_path_URL, data=_read_in_chunks(laa), timeout=HTTP_TIMEOUT_IN_SEC)
         logging.debug("RESPONSE:\n%s" %(res.json()))
     return res
 
+def _read_in_chunks(afile, chunk_size=UPLOAD_CHUNK_SIZE):
+    """
+    Reads a file chunk by chunk; used to upload files with chunked transfer encoding.
+    """
+    while True:
+        chunk = afile.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
 def _list_apps(workspace, registry_endpoint, verbose):
     """
     Lists app in a workspace at a remote registry.
     """
     operation_path_URL = "".join([registry_endpoint, "/app", "?workspace=", workspace])
     logging.debug("OPERATION URL:\n%s" %(operation_path_URL))
-    res = requests.request("GET", operation_path_URL)
+    res = _http_session().request("GET", operation_path_URL, timeout=HTTP_TIMEOUT_IN_SEC)
     logging.debug("RESPONSE:\n%s" %(res.json()))
     return res
 
-def _download_app(workspace, app_id, local_app_archive, registry_endpoint, verbose):
+def _download_app(workspace, app_id, local_app_archive, registry_endpoint, verbose, workers=None):
     """
     Downloads app via ID from a workspace at a remote registry and stores it in local app archive.
+    The archive is streamed into a partial file next to the local app archive. If the transfer is
+    interrupted, it is resumed with a range request, also in a later pull of the same app. Once
+    the size and, if the registry reports it, the MD5 digest check out, the partial file is renamed.
+    Archives bigger than `DOWNLOAD_SEGMENT_SIZE` are downloaded in segments instead, using up to
+    `workers` concurrent range requests, see `_download_segments`.
     """
+    import requests
     operation_path_URL = "".join([registry_endpoint, "/app/", app_id, "?workspace=", workspace])
     logging.debug("OPERATION URL:\n%s" %(operation_path_URL))
-    res = requests.request("GET", operation_path_URL)
-    if res.status_code == 200:
-        with open(local_app_archive, "w") as laa:
-            laa.write(res.content)
-            logging.debug("Written the following content to %s:\n\n%s" %(local_app_archive, res.content))
+    part_file_name = "".join([local_app_archive, ".", app_id, ".part"])
+    try: # ask for the first byte, to learn if the registry does ranges and how big the archive is
+        res = _http_session().get(operation_path_URL, headers={"Accept-Encoding": "identity", "Range": "bytes=0-0"}, stream=True, timeout=HTTP_TIMEOUT_IN_SEC)
+        res.close()
+        if res.status_code == 206 and res.headers.get("Content-Range", "").startswith("bytes 0-0/"):
+            size = int(res.headers["Content-Range"].split("/")[-1])
+            if size > DOWNLOAD_SEGMENT_SIZE:
+                _download_segments(operation_path_URL, part_file_name, size, res.headers, app_id, verbose, workers or _workers(DOWNLOAD_WORKERS))
+                os.rename(part_file_name, local_app_archive)
+                logging.debug("Written %d bytes to %s" %(size, local_app_archive))
+                return True
+    except (requests.exceptions.RequestException, ValueError) as e: # the download below retries
+        logging.debug("Can't tell the size of app %s: %s" %(app_id, e))
+    for attempt in range(DOWNLOAD_RETRIES):
+        offset = os.path.getsize(part_file_name) if os.path.exists(part_file_name) else 0
+        headers = {"Accept-Encoding": "identity"} # so that sizes and ranges refer to the archive itself
+        if offset:
+            headers["Range"] = "bytes=%d-" %(offset)
+        try:
+            res = _http_session().get(operation_path_URL, headers=headers, stream=True, timeout=HTTP_TIMEOUT_IN_SEC)
+            if res.status_code == 206 and res.headers.get("Content-Range", "").startswith("bytes %d-" %(offset)):
+                if verbose: logging.info("Resuming download of app %s at byte %d" %(app_id, offset))
+                size = int(res.headers["Content-Range"].split("/")[-1])
+                mode = "ab"
+            elif res.status_code == 200:
+                size = int(res.headers.get("Content-Length", -1))
+                mode = "wb"
+            elif res.status_code in (206, 416): # not the range we asked for or the partial file is no good, start over
+                logging.debug("Got a %s HTTP status code for range %s, restarting download" %(res.status_code, res.headers.get("Content-Range")))
+                res.close()
+                if os.path.exists(part_file_name):
+                    os.remove(part_file_name)
+                continue
+            else:
+                logging.debug("Got a %s HTTP status code, app archive does not exist" %(res.status_code))
+                return False
+            with open(part_file_name, mode) as part_file:
+                for chunk in res.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    part_file.write(chunk)
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError, requests.exceptions.Timeout) as e:
+            logging.info("Download of app %s interrupted (%s), retrying" %(app_id, e))
+            with _span("backoff"):
+                sleep(PATCH_BACKOFF_IN_SEC * 2**attempt)
+            continue
+        received = os.path.getsize(part_file_name)
+        if size >= 0 and received < size:
+            logging.info("Download of app %s incomplete (%d of %d bytes), retrying" %(app_id, received, size))
+            continue
+        if (size >= 0 and received != size) or not _has_digest(part_file_name, res.status_code, res.headers):
+            logging.info("Downloaded app %s is corrupt, starting over" %(app_id))
+            os.remove(part_file_name)
+            continue
+        os.rename(part_file_name, local_app_archive)
+        logging.debug("Written %d bytes to %s" %(received, local_app_archive))
         return True
-    else:
-        logging.debug("Got a %s HTTP status code, app archive does not exist" %(res.status_code))
-        return False
+    raise IOError("Can't download app %s, giving up after %d attempts" %(app_id, DOWNLOAD_RETRIES))
+
+def _download_segments(url, part_file_name, size, headers, app_id, verbose, workers):
+    """
+    Downloads a file of `size` bytes in segments of `DOWNLOAD_SEGMENT_SIZE`, each with its own
+    range request into its own partial file, up to `workers` of them concurrently. Then joins the
+    segments into the partial file and checks it against the size and the whole-object digest in
+    `headers`, if any, see `_has_digest`. An interrupted segment is resumed, also in a later pull.
+    """
+    segments = [(start, min(start + DOWNLOAD_SEGMENT_SIZE, size) - 1) for start in range(0, size, DOWNLOAD_SEGMENT_SIZE)]
+    segment_file_names = ["%s%d" %(part_file_name, i) for i in range(len(segments))]
+    def download_one(i):
+        first, last = segments[i]
+        _download_range(url, segment_file_names[i], first, last, app_id)
+    if verbose: logging.info("Downloading app %s in %d segments" %(app_id, len(segments)))
+    _pmap(download_one, range(len(segments)), workers)
+    with open(part_file_name, "wb") as part_file:
+        for segment_file_name in segment_file_names:
+            with open(segment_file_name, "rb") as segment_file:
+                shutil.copyfileobj(segment_file, part_file, DOWNLOAD_CHUNK_SIZE)
+    for segment_file_name in segment_file_names:
+        os.remove(segment_file_name)
+    if os.path.getsize(part_file_name) != size or not _has_digest(part_file_name, 206, headers):
+        os.remove(part_file_name)
+        raise IOError("Downloaded app %s is corrupt, please pull it again" %(app_id))
+
+def _download_range(url, segment_file_name, first, last, app_id):
+    """
+    Downloads the bytes `first` to `last` (inclusive) of a file into a partial file, resuming
+    from what the partial file has already, with up to `DOWNLOAD_RETRIES` attempts.
+    """
+    import requests
+    for attempt in range(DOWNLOAD_RETRIES):
+        offset = first + (os.path.getsize(segment_file_name) if os.path.exists(segment_file_name) else 0)
+        if offset > last:
+            return
+        try:
+            res = _http_session().get(url, headers={"Accept-Encoding": "identity", "Range": "bytes=%d-%d" %(offset, last)}, stream=True, timeout=HTTP_TIMEOUT_IN_SEC)
+            if res.status_code != 206 or not res.headers.get("Content-Range", "").startswith("bytes %d-" %(offset)):
+                res.close()
+                if res.status_code in (206, 416): # not the range we asked for or the partial file is no good, start over
+                    logging.debug("Got a %s HTTP status code for range %s, restarting segment" %(res.status_code, res.headers.get("Content-Range")))
+                    if os.path.exists(segment_file_name):
+                        os.remove(segment_file_name)
+                    continue
+                raise IOError("Can't download bytes %d-%d of app %s: %d %s" %(offset, last, app_id, res.status_code, res.reason))
+            with open(segment_file_name, "ab") as segment_file:
+                for chunk in res.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    segment_file.write(chunk)
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError, requests.exceptions.Timeout) as e:
+            logging.info("Download of app %s interrupted (%s), retrying" %(app_id, e))
+            with _span("backoff"):
+                sleep(PATCH_BACKOFF_IN_SEC * 2**attempt)
+    if first + (os.path.getsize(segment_file_name) if os.path.exists(segment_file_name) else 0) <= last:
+        raise IOError("Can't download app %s, giving up after %d attempts" %(app_id, DOWNLOAD_RETRIES))
+
+def _has_digest(file_name, status_code, headers):
+    """
+    Checks a file against the MD5 digest in the `X-Goog-Hash` or `Content-MD5` response headers.
+    `X-Goog-Hash` is about the whole object, while `Content-MD5` is only about the body of the
+    response, so it only counts for a full (200) response rather than a range (206). If there
+    is no such header, there's nothing to check against and the file is fine.
+    """
+    expected = headers.get("Content-MD5") if status_code == 200 else None
+    for h in headers.get("X-Goog-Hash", "").split(","):
+        if h.strip().startswith("md5="):
+            expected = h.strip()[4:]
+    if not expected:
+        return True
+    md5 = hashlib.md5()
+    with open(file_name, "rb") as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+            md5.update(chunk)
+    return base64.b64encode(md5.digest()) == expected
@@ -0,0 +1,513 @@
+#!/usr/bin/env python
+
+"""
+An in-process fake of the Kubernetes API server, good enough to drive kploy
+commands without a cluster. It keeps namespaces, services, RCs, pods, secrets
+and nodes in memory, runs a (synchronous) replication controller, supports
+list, watch, merge/JSON patch and the scale subresource and counts requests
+and bytes transferred. Used by `kploybench.py`; can also be run standalone:
+
+    $ python kployfake.py 8080
+
+@since: 2026-10-18
+@status: beta
+"""
+
+import copy
+import json
+import logging
+import os
+import random
+import string
+import sys
+import threading
+import time
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+
+def _rand_suffix():
+    """
+    Creates a short random suffix, as used for generated pod names.
+    """
+    return "".join(random.choice(string.ascii_lowercase + string.digits) for _ in range(5))
+
+def _match_selector(labels, selector):
+    """
+    Checks if a dict of labels satisfies an equality-based selector dict.
+    """
+    labels = labels or {}
+    for k, v in selector.items():
+        if v is None:
+            if k not in labels:
+                return False
+        elif labels.get(k) != v:
+            return False
+    return True
+
+def _parse_selector(sel):
+    """
+    Parses `a=b,c=d` (also `a==b`) into a dict.
+    """
+    res = {}
+    if not sel:
+        return res
+    for term in sel.split(","):
+        term = term.strip()
+        if not term:
+            continue
+        if "==" in term:
+            k, v = term.split("==", 1)
+        elif "=" in term:
+            k, v = term.split("=", 1)
+        else:
+            k, v = term, None
+        res[k.strip()] = v.strip() if v is not None else None
+    return res
+
+def _merge_patch(target, patch):
+    """
+    Applies a JSON merge patch (RFC 7386).
+    """
+    if not isinstance(patch, dict):
+        return copy.deepcopy(patch)
+    if not isinstance(target, dict):
+        target = {}
+    for k, v in patch.items():
+        if v is None:
+            target.pop(k, None)
+        else:
+            target[k] = _merge_patch(target.get(k), v)
+    return target
+
+def _json_patch(target, ops):
+    """
+    Applies a (subset of) JSON patch (RFC 6902): add, replace, remove.
+    """
+    for op in ops:
+        parts = [p.replace("~1", "/").replace("~0", "~") for p in op["path"].split("/")[1:]]
+        parent = target
+        for p in parts[:-1]:
+            parent = parent[int(p)] if isinstance(parent, list) else parent.setdefault(p, {})
+        last = parts[-1]
+        if op["op"] in ("add", "replace"):
+            parent[last] = op["value"]
+        elif op["op"] == "remove":
+            if last not in parent:
+                raise KeyError(op["path"])
+            del parent[last]
+    return target
+
+
+class FakeCluster(object):
+    """
+    The state of the fake cluster: namespaces, services, RCs, pods, secrets and nodes.
+    The `latency` (in seconds) is added to every request, `pod_delay` (in seconds)
+    is how long the replication controller waits before it creates pods.
+    """
+
+    KINDS = {
+        "services": "Service",
+        "replicationcontrollers": "ReplicationController",
+        "pods": "Pod",
+        "secrets": "Secret",
+    }
+
+    def __init__(self, node_count=3, latency=0.0, pod_delay=0.0):
+        self.pod_delay = pod_delay
+        self.lock = threading.Condition()
+        self.latency = latency
+        self.resource_version = 1
+        self.namespaces = {"default": self._stamp({"kind": "Namespace", "apiVersion": "v1", "metadata": {"name": "default"}}, "/api/v1/namespaces/default")}
+        self.objects = {} # (ns, kind) -> {name: obj}
+        self.events = [] # (rv, ns, kind, type, obj)
+        self.nodes = {}
+        for i in range(node_count):
+            name = "10.0.%d.%d" %(i / 250, i % 250 + 1)
+            self.nodes[name] = self._stamp({
+                "kind": "Node",
+                "apiVersion": "v1",
+                "metadata": {"name": name},
+                "status": {
+                    "addresses": [{"type": "InternalIP", "address": name}],
+                    "capacity": {"pods": "40", "cpu": "4", "memory": "13891Mi"},
+                    "nodeInfo": {"osImage": "CoreOS 835.8.0", "containerRuntimeVersion": "docker://1.8.3"},
+                },
+            }, "/api/v1/nodes/" + name)
+        self._reconciling = False
+        self._delayed = False
+        self.reset_stats()
+
+    def reset_stats(self):
+        """
+        Resets the request and traffic counters.
+        """
+        self.requests = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def _stamp(self, obj, self_link):
+        self.resource_version += 1
+        md = obj.setdefault("metadata", {})
+        md["selfLink"] = self_link
+        md["resourceVersion"] = str(self.resource_version)
+        md.setdefault("uid", _rand_suffix() + _rand_suffix())
+        md.setdefault("creationTimestamp", time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()))
+        return obj
+
+    def _emit(self, ns, kind, etype, obj):
+        self.events.append((int(obj["metadata"]["resourceVersion"]), ns, kind, etype, copy.deepcopy(obj)))
+        self.lock.notify_all()
+
+    def store(self, ns, kind):
+        return self.objects.setdefault((ns, kind), {})
+
+    def put(self, ns, kind, obj, etype):
+        name = obj["metadata"]["name"]
+        obj["metadata"]["namespace"] = ns
+        self._stamp(obj, "/api/v1/namespaces/%s/%s/%s" %(ns, kind, name))
+        self.store(ns, kind)[name] = obj
+        self._emit(ns, kind, etype, obj)
+        if kind == "replicationcontrollers":
+            self._reconcile(ns, obj)
+        elif kind == "pods":
+            self._reconcile_all(ns)
+        return obj
+
+    def remove(self, ns, kind, name):
+        obj = self.store(ns, kind).pop(name)
+        self.resource_version += 1
+        obj["metadata"]["resourceVersion"] = str(self.resource_version)
+        self._emit(ns, kind, "DELETED", obj)
+        if kind == "pods":
+            self._reconcile_all(ns)
+        return obj
+
+    def _reconcile_all(self, ns):
+        if self._reconciling:
+            return
+        for rc in list(self.store(ns, "replicationcontrollers").values()):
+            self._reconcile(ns, rc)
+
+    def _reconcile(self, ns, rc):
+        """
+        The (synchronous) replication controller: makes the number of pods
+        matching the RC's selector equal to `spec.replicas`.
+        """
+        self._reconciling = True
+        try:
+            self._do_reconcile(ns, rc)
+        finally:
+            self._reconciling = False
+
+    def _do_reconcile(self, ns, rc):
+        selector = rc["spec"].get("selector") or rc["spec"]["template"]["metadata"]["labels"]
+        pods = [p for p in self.store(ns, "pods").values() if _match_selector(p["metadata"].get("labels"), selector)]
+        want = rc["spec"].get("replicas", 1)
+        node_names = sorted(self.nodes.keys())
+        if self.pod_delay and len(pods) < want and not self._delayed:
+            def later():
+                with self.lock:
+                    self._delayed = True
+                    try:
+                        current = self.store(ns, "replicationcontrollers").get(rc["metadata"]["name"])
+                        if current is not None:
+                            self._reconcile(ns, current)
+                    finally:
+                        self._delayed = False
+            t = threading.Timer(self.pod_delay, later)
+            t.daemon = True
+            t.start()
+            return
+        while len(pods) < want:
+            pod = {
+                "kind": "Pod",
+                "apiVersion": "v1",
+                "metadata": {
+                    "name": "%s-%s" %(rc["metadata"]["name"], _rand_suffix()),
+                    "generateName": "%s-" %(rc["metadata"]["name"]),
+                    "labels": copy.deepcopy(rc["spec"]["template"]["metadata"].get("labels", {})),
+                    "ownerReferences": [{"kind": "ReplicationController", "name": rc["metadata"]["name"], "uid": rc["metadata"]["uid"]}],
+                },
+                "spec": copy.deepcopy(rc["spec"]["template"].get("spec", {})),
+                "status": {"phase": "Running"},
+            }
+            node = random.choice(node_names)
+            pod["spec"]["nodeName"] = node
+            pod["status"]["hostIP"] = node
+            self.put(ns, "pods", pod, "ADDED")
+            pods.append(pod)
+        for pod in pods[want:]:
+            self.remove(ns, "pods", pod["metadata"]["name"])
+        rc.setdefault("status", {})["replicas"] = want
+        rc["status"]["readyReplicas"] = want
+
+
+def _status(code, reason, message):
+    """
+    Creates a Kubernetes Status object for an error response.
+    """
+    return code, {"kind": "Status", "apiVersion": "v1", "status": "Failure", "reason": reason, "message": message, "code": code}
+
+
+class FakeAPIHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves the Kubernetes API subset kploy uses.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logging.debug(format %args)
+
+    def _body(self):
+        length = int(self.headers.getheader("content-length") or 0)
+        if length:
+            data = self.rfile.read(length)
+        elif self.headers.getheader("transfer-encoding", "").lower() == "chunked":
+            data = ""
+            while True:
+                size = int(self.rfile.readline().strip().split(";")[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                data += self.rfile.read(size)
+                self.rfile.readline()
+        else:
+            data = ""
+        self.server.cluster.bytes_in += len(data)
+        return data
+
+    def _reply(self, code, obj):
+        data = json.dumps(obj)
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        self.server.cluster.bytes_out += len(data)
+
+    def _handle(self, method):
+        cluster = self.server.cluster
+        cluster.requests += 1
+        if cluster.latency:
+            time.sleep(cluster.latency)
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        parts = [p for p in url.path.split("/") if p]
+        body = self._body() if method in ("POST", "PUT", "PATCH") else ""
+        watch = query.get("watch") in ("true", "1")
+        if parts[:3] == ["api", "v1", "watch"]:
+            watch = True
+            parts = parts[:2] + parts[3:]
+        if watch:
+            return self._watch(parts, query)
+        with cluster.lock:
+            try:
+                code, obj = self._dispatch(method, parts, query, body)
+            except (KeyError, ValueError, TypeError, IndexError) as e:
+                code, obj = _status(400, "BadRequest", repr(e))
+        self._reply(code, obj)
+
+    def _dispatch(self, method, parts, query, body):
+        cluster = self.server.cluster
+        if parts[:2] != ["api", "v1"]:
+            return _status(404, "NotFound", "no such path")
+        rest = parts[2:]
+        if not rest:
+            return 200, {"kind": "APIResourceList", "groupVersion": "v1", "resources": []}
+        if rest[0] == "nodes":
+            if len(rest) == 1:
+                items = sorted(cluster.nodes.values(), key=lambda n: n["metadata"]["name"])
+                sel = query.get("fieldSelector", "")
+                if sel.startswith("metadata.name="):
+                    items = [n for n in items if n["metadata"]["name"] == sel.split("=", 1)[1]]
+                return 200, {"kind": "NodeList", "apiVersion": "v1", "metadata": {"resourceVersion": str(cluster.resource_version)}, "items": items}
+            if rest[1] in cluster.nodes:
+                return 200, cluster.nodes[rest[1]]
+            return _status(404, "NotFound", "node %s not found" %(rest[1]))
+        if rest[0] != "namespaces":
+            return _status(404, "NotFound", "no such path")
+        if len(rest) == 1:
+            if method == "GET":
+                return 200, {"kind": "NamespaceList", "apiVersion": "v1", "items": cluster.namespaces.values()}
+            if method == "POST":
+                ns = json.loads(body)
+                name = ns["metadata"]["name"]
+                if name in cluster.namespaces:
+                    return _status(409, "AlreadyExists", "namespace %s already exists" %(name))
+                cluster.namespaces[name] = cluster._stamp(ns, "/api/v1/namespaces/" + name)
+                return 201, ns
+        ns_name = rest[1]
+        if len(rest) == 2:
+            if ns_name not in cluster.namespaces:
+                return _status(404, "NotFound", "namespace %s not found" %(ns_name))
+            if method == "GET":
+                return 200, cluster.namespaces[ns_name]
+            if method == "DELETE":
+                ns = cluster.namespaces.pop(ns_name)
+                for key in [k for k in cluster.objects if k[0] == ns_name]:
+                    for name in list(cluster.objects[key].keys()):
+                        cluster.remove(ns_name, key[1], name)
+                return 200, ns
+            return _status(405, "MethodNotAllowed", method)
+        kind = rest[2]
+        if kind not in FakeCluster.KINDS:
+            return _status(404, "NotFound", "no such kind %s" %(kind))
+        if ns_name not in cluster.namespaces:
+            return _status(404, "NotFound", "namespace %s not found" %(ns_name))
+        store = cluster.store(ns_name, kind)
+        if len(rest) == 3:
+            if method == "GET":
+                sel = _parse_selector(query.get("labelSelector"))
+                items = [o for o in store.values() if _match_selector(o["metadata"].get("labels"), sel)]
+                fsel = query.get("fieldSelector", "")
+                if fsel.startswith("metadata.name="):
+                    items = [o for o in items if o["metadata"]["name"] == fsel.split("=", 1)[1]]
+                items.sort(key=lambda o: o["metadata"]["name"])
+                return 200, {"kind": FakeCluster.KINDS[kind] + "List", "apiVersion": "v1", "metadata": {"resourceVersion": str(cluster.resource_version)}, "items": items}
+            if method == "POST":
+                obj = json.loads(body)
+                name = obj["metadata"]["name"]
+                if name in store:
+                    return _status(409, "AlreadyExists", "%s %s already exists" %(kind, name))
+                return 201, cluster.put(ns_name, kind, obj, "ADDED")
+            return _status(405, "MethodNotAllowed", method)
+        name = rest[3]
+        if name not in store:
+            return _status(404, "NotFound", "%s %s not found" %(kind, name))
+        current = store[name]
+        if len(rest) == 5 and rest[4] == "scale" and kind == "replicationcontrollers":
+            selector = current["spec"]["selector"]
+            if self.server.scale_version == "autoscaling/v1": # the selector in its string form, extensions/v1beta1 has it as a map
+                selector = ",".join("%s=%s" %(k, v) for k, v in sorted(selector.items()))
+            scale = {
+                "kind": "Scale",
+                "apiVersion": self.server.scale_version,
+                "metadata": {"name": name, "namespace": ns_name},
+                "spec": {"replicas": current["spec"].get("replicas", 1)},
+                "status": {"replicas": current.get("status", {}).get("replicas", 0), "selector": selector},
+            }
+            if method == "GET":
+                return 200, scale
+            if method in ("PUT", "PATCH"):
+                update = json.loads(body)
+                obj = copy.deepcopy(current)
+                obj["spec"]["replicas"] = update["spec"]["replicas"]
+                cluster.put(ns_name, kind, obj, "MODIFIED")
+                scale["spec"]["replicas"] = obj["spec"]["replicas"]
+                scale["status"]["replicas"] = obj["status"]["replicas"]
+                return 200, scale
+            return _status(405, "MethodNotAllowed", method)
+        if method == "GET":
+            return 200, current
+        if method == "DELETE":
+            return 200, cluster.remove(ns_name, kind, name)
+        if method == "PUT":
+            obj = json.loads(body)
+            rv = obj.get("metadata", {}).get("resourceVersion")
+            if rv and rv != current["metadata"]["resourceVersion"]:
+                return _status(409, "Conflict", "the object has been modified")
+            return 200, cluster.put(ns_name, kind, obj, "MODIFIED")
+        if method == "PATCH":
+            ctype = self.headers.getheader("content-type", "")
+            patch = json.loads(body)
+            obj = copy.deepcopy(current)
+            if ctype.startswith("application/json-patch+json"):
+                obj = _json_patch(obj, patch)
+            elif ctype.startswith("application/merge-patch+json") or ctype.startswith("application/strategic-merge-patch+json"):
+                obj = _merge_patch(obj, patch)
+            else:
+                return _status(415, "UnsupportedMediaType", ctype)
+            return 200, cluster.put(ns_name, kind, obj, "MODIFIED")
+        return _status(405, "MethodNotAllowed", method)
+
+    def _watch(self, parts, query):
+        cluster = self.server.cluster
+        rest = parts[2:]
+        if rest == ["nodes"]: # nodes don't change, so the watch stays quiet
+            ns_name, kind = None, "nodes"
+        elif len(rest) < 3 or rest[0] != "namespaces" or rest[2] not in FakeCluster.KINDS:
+            return self._reply(*_status(404, "NotFound", "no such watch"))
+        else:
+            ns_name, kind = rest[1], rest[2]
+        sel = _parse_selector(query.get("labelSelector"))
+        since = int(query.get("resourceVersion") or cluster.resource_version)
+        deadline = time.time() + float(query.get("timeoutSeconds") or self.server.watch_timeout)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            while time.time() < deadline and not self.server.stopped:
+                out = []
+                with cluster.lock:
+                    pending = [e for e in cluster.events if e[0] > since and e[1] == ns_name and e[2] == kind]
+                    if not pending:
+                        cluster.lock.wait(min(0.2, max(0.0, deadline - time.time())))
+                        continue
+                    since = pending[-1][0]
+                    for _, _, _, etype, obj in pending:
+                        if _match_selector(obj["metadata"].get("labels"), sel):
+                            out.append(json.dumps({"type": etype, "object": obj}) + "\n")
+                for line in out:
+                    self.wfile.write("%x\r\n%s\r\n" %(len(line), line))
+                    cluster.bytes_out += len(line)
+                self.wfile.flush()
+            self.wfile.write("0\r\n\r\n")
+        except IOError:
+            pass
+        self.close_connection = 1
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+    def do_PATCH(self):
+        self._handle("PATCH")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+
+class FakeAPIServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Threaded HTTP server hosting a FakeCluster.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, node_count=3, latency=0.0, watch_timeout=30, pod_delay=0.0, scale_version="autoscaling/v1"):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", port), FakeAPIHandler)
+        self.cluster = FakeCluster(node_count=node_count, latency=latency, pod_delay=pod_delay)
+        self.watch_timeout = watch_timeout
+        self.stopped = False # ends the watches still open when the server stops
+        self.scale_version = scale_version # the API version of the scale subresource, `autoscaling/v1` or `extensions/v1beta1`
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d" %(self.server_address[1])
+
+    def start(self):
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+        return self
+
+    def stop(self):
+        self.stopped = True
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+    server = FakeAPIServer(port=port, node_count=int(os.environ.get("FAKE_NODES", "3")), latency=float(os.environ.get("FAKE_LATENCY", "0")), pod_delay=float(os.environ.get("FAKE_POD_DELAY", "0")), scale_version=os.environ.get("FAKE_SCALE_VERSION", "autoscaling/v1"))
+    print("Fake Kubernetes API server at %s" %(server.url))
+    server.serve_forever()
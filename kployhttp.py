@@ -0,0 +1,100 @@
+"""
+The kploy HTTP layer: the Pyk client and the HTTP session all requests go through.
+Only imported once kploy talks to a cluster, a registry or a remote, so that commands
+such as `init` and `explain` don't pay for loading the network libraries.
+
+@since: 2026-10-18
+@status: beta
+"""
+
+import logging
+import threading
+import urlparse
+from time import time
+
+import requests
+from pyk import toolkit
+
+import kploycommon
+
+class KployHTTPClient(toolkit.KubeHTTPClient):
+    """
+    A Pyk client that sends all its requests over the HTTP session shared by kploy,
+    see `kploycommon._http_session`, so that connections to the API server are kept alive.
+    """
+
+    def execute_operation(self, method="GET", ops_path="", payload="", headers=None, stream=False, timeout=None):
+        """
+        Executes a Kubernetes operation using the specified method against a path.
+        Other than in Pyk, it also takes additional request `headers`, can `stream`
+        the response and has a `timeout` (defaults to `HTTP_TIMEOUT_IN_SEC`).
+        """
+        operation_path_URL = "".join([self.api_server, ops_path])
+        logging.debug("%s %s" %(method, operation_path_URL))
+        if payload:
+            logging.debug("PAYLOAD:\n%s" %(payload))
+        try:
+            res = kploycommon._http_session().request(method, operation_path_URL, data=payload or None, headers=headers,
+                                                      stream=stream, timeout=timeout or kploycommon.HTTP_TIMEOUT_IN_SEC)
+        except requests.exceptions.ConnectionError as e:
+            logging.debug(e)
+            raise kploycommon.ClusterConnectionError("Can't connect to the Kubernetes cluster at %s\nCheck the `apiserver` setting in your Kployfile, your Internet connection or maybe it's a VPN issue?" %(self.api_server))
+        if not stream:
+            logging.debug("RESPONSE:\n%s" %(res.text))
+        return res
+
+class KploySession(requests.Session):
+    """
+    A requests session that has at most `HTTP_HOST_CONCURRENCY` requests in flight per
+    host (a streamed response counts until its headers are in, so watches don't block
+    other requests) and, while profiling (see `kploycommon._start_profile`), records every
+    request it sends: method, path, status, latency, bytes sent and received and the phase
+    of the command that made it.
+    """
+
+    def __init__(self):
+        requests.Session.__init__(self)
+        self._host_slots = {} # host -> semaphore
+        self._host_slots_lock = threading.Lock()
+
+    def request(self, method, url, **kwargs):
+        host = urlparse.urlparse(url).netloc
+        with self._host_slots_lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(kploycommon.HTTP_HOST_CONCURRENCY)
+            slots = self._host_slots[host]
+        with slots:
+            return self._request(method, url, **kwargs)
+
+    def _request(self, method, url, **kwargs):
+        if kploycommon._trace is None:
+            return requests.Session.request(self, method, url, **kwargs)
+        phase = kploycommon._current_phase()
+        sent = [0]
+        data = kwargs.get("data")
+        if isinstance(data, basestring):
+            sent[0] = len(data)
+        elif data is not None and hasattr(data, "next"): # a generator, as used for chunked uploads
+            kwargs["data"] = kploycommon._count_chunks(data, sent)
+        res = None
+        start = time()
+        try:
+            res = requests.Session.request(self, method, url, **kwargs)
+            return res
+        finally:
+            received = 0
+            if res is not None:
+                if kwargs.get("stream"):
+                    received = int(res.headers.get("Content-Length") or 0)
+                else:
+                    received = len(res.content)
+            parsed_url = urlparse.urlparse(url)
+            path = parsed_url.path + ("?" + parsed_url.query if parsed_url.query else "")
+            kploycommon._record("%s %s" %(method, path), "http", start, time(), {
+                "phase": phase,
+                "method": method,
+                "path": path,
+                "status": res.status_code if res is not None else None,
+                "sent": sent[0],
+                "received": received
+            })
@@ -30,9 +30,12 @@ setup(
         ],
     },
     zip_safe=False,
-    py_modules=["kploy", "kploycommon"],
+    py_modules=["kploy", "kploycommon", "kployagent", "kployhttp"],
     install_requires=[
         "pyk",
         "tabulate"
     ],
+    extras_require={
+        "gevent": ["gevent"]
+    },
 )
@@ -0,0 +1,710 @@
+"""
+Tests for kploycommon. Run them with `python -m unittest discover`.
+
+@since: 2026-10-18
+@status: beta
+"""
+
+import base64
+import contextlib
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import zipfile
+import BaseHTTPServer
+from collections import OrderedDict
+
+import kployagent
+import kploycommon
+import kployfake
+
+def _rc(name, labels=None, selector=None):
+    """
+    Creates an RC manifest whose pods have the given labels.
+    """
+    labels = labels if labels is not None else {"app": name}
+    return {
+        "apiVersion": "v1",
+        "kind": "ReplicationController",
+        "metadata": {"name": name},
+        "spec": {
+            "replicas": 1,
+            "selector": selector if selector is not None else labels,
+            "template": {
+                "metadata": {"labels": labels},
+                "spec": {"containers": [{"name": "web", "image": "nginx:1.9"}]}
+            }
+        }
+    }
+
+def _svc(name, selector=None):
+    """
+    Creates a service manifest.
+    """
+    return {
+        "apiVersion": "v1",
+        "kind": "Service",
+        "metadata": {"name": name},
+        "spec": {"selector": selector or {}, "ports": [{"port": 80}]}
+    }
+
+def _record(path, manifest):
+    """
+    Creates a manifest record, like `_visit` does.
+    """
+    return {"path": path, "file": os.path.basename(path), "name": manifest["metadata"]["name"], "manifest": manifest, "digest": "digest-of-" + path}
+
+class FakeClusterTest(unittest.TestCase):
+    """
+    Runs against a fresh fake API server, see `kployfake.py`.
+    """
+    namespace = "kploy-test"
+    server_options = {}
+
+    def setUp(self):
+        self.server = kployfake.FakeAPIServer(**self.server_options).start()
+        self.pyk_client = kploycommon._connect(api_server=self.server.url, debug=False)
+        logging.getLogger().setLevel(logging.WARNING) # the pyk client logs at INFO level
+
+    def tearDown(self):
+        kploycommon._http_session().close()
+        self.server.stop()
+
+    def live(self, kind):
+        return self.server.cluster.store(self.namespace, kind)
+
+class RemoteHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves a remote manifest with an ETag and answers conditional requests for it.
+    """
+    content = "kind: Service\n"
+    requests = []
+
+    def do_GET(self):
+        etag = '"%d"' %(hash(RemoteHandler.content))
+        RemoteHandler.requests.append(self.headers.get("If-None-Match"))
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(RemoteHandler.content)))
+        self.end_headers()
+        self.wfile.write(RemoteHandler.content)
+
+    def log_message(self, *args):
+        pass
+
+class RemoteFetchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), RemoteHandler)
+        threading.Thread(target=self.server.serve_forever).start()
+        RemoteHandler.requests = []
+        self.app_dir = tempfile.mkdtemp()
+        self.rcs = os.path.join(self.app_dir, "rcs")
+        os.mkdir(self.rcs)
+        self.ref_file_name = os.path.join(self.rcs, "web.yaml.url")
+        with open(self.ref_file_name, "w") as ref_file:
+            ref_file.write("http://127.0.0.1:%d/web.yaml\n" %(self.server.server_port))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        kploycommon._http_session().close()
+        shutil.rmtree(self.app_dir)
+
+    def fetch(self, cache_remotes):
+        file_names = kploycommon._fetch_remotes(self.rcs, [self.ref_file_name], cache_remotes)
+        self.assertEqual(file_names, [os.path.join(self.rcs, "web.yaml")])
+        with open(file_names[0]) as f:
+            return f.read()
+
+    def test_conditional_fetch(self):
+        RemoteHandler.content = "kind: Service\n"
+        self.assertEqual(self.fetch(False), "kind: Service\n")
+        self.assertEqual(RemoteHandler.requests, [None])
+        # revalidated with the ETag, the remote hasn't changed:
+        self.assertEqual(self.fetch(False), "kind: Service\n")
+        self.assertEqual(len(RemoteHandler.requests), 2)
+        self.assertTrue(RemoteHandler.requests[1])
+        # cached forever, no request at all:
+        self.assertEqual(self.fetch(True), "kind: Service\n")
+        self.assertEqual(len(RemoteHandler.requests), 2)
+        # the remote has changed:
+        RemoteHandler.content = "kind: ReplicationController\n"
+        self.assertEqual(self.fetch(False), "kind: ReplicationController\n")
+        self.assertEqual(len(RemoteHandler.requests), 3)
+
+class ArchiveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves an app archive like KAR does, with range requests and an MD5 digest; the body
+    of the first `cut` responses of more than a byte breaks off halfway.
+    """
+    content = ""
+    digest = None
+    cut = 0
+    ranges = []
+
+    def do_GET(self):
+        content, first = ArchiveHandler.content, 0
+        ArchiveHandler.ranges.append(self.headers.get("Range"))
+        if self.headers.get("Range"):
+            first, _, last = self.headers["Range"][len("bytes="):].partition("-")
+            first, last = int(first), int(last or len(content) - 1)
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" %(first, last, len(content)))
+            content = content[first:last + 1]
+        else:
+            self.send_response(200)
+        if ArchiveHandler.digest:
+            self.send_header("X-Goog-Hash", "crc32c=AAAAAA==,md5=" + ArchiveHandler.digest)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        if ArchiveHandler.cut and len(content) > 1:
+            ArchiveHandler.cut -= 1
+            content = content[:len(content) / 2]
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+class DownloadAppTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), ArchiveHandler)
+        threading.Thread(target=self.server.serve_forever).start()
+        self.env = tempfile.mkdtemp()
+        self.archive = os.path.join(self.env, "app.zip")
+        self.settings = kploycommon.DOWNLOAD_SEGMENT_SIZE, kploycommon.PATCH_BACKOFF_IN_SEC
+        kploycommon.PATCH_BACKOFF_IN_SEC = 0
+        self.serve("".join(chr(i % 251) for i in range(10000)))
+
+    def tearDown(self):
+        kploycommon.DOWNLOAD_SEGMENT_SIZE, kploycommon.PATCH_BACKOFF_IN_SEC = self.settings
+        self.server.shutdown()
+        self.server.server_close()
+        kploycommon._http_session().close()
+        shutil.rmtree(self.env)
+
+    def serve(self, content, digest=None, cut=0):
+        ArchiveHandler.content, ArchiveHandler.cut, ArchiveHandler.ranges = content, cut, []
+        ArchiveHandler.digest = digest or base64.b64encode(hashlib.md5(content).digest())
+
+    def download(self):
+        return kploycommon._download_app("ws", "42", self.archive, "http://127.0.0.1:%d" %(self.server.server_port), False)
+
+    def downloaded(self):
+        with open(self.archive, "rb") as f:
+            return f.read()
+
+    def test_download(self):
+        self.assertTrue(self.download())
+        self.assertEqual(self.downloaded(), ArchiveHandler.content)
+        self.assertEqual(ArchiveHandler.ranges, ["bytes=0-0", None])
+        self.assertEqual(os.listdir(self.env), ["app.zip"])
+
+    def test_resume(self):
+        with open(self.archive + ".42.part", "wb") as f:
+            f.write(ArchiveHandler.content[:4000])
+        self.assertTrue(self.download())
+        self.assertEqual(self.downloaded(), ArchiveHandler.content)
+        self.assertEqual(ArchiveHandler.ranges, ["bytes=0-0", "bytes=4000-"])
+
+    def test_resume_interrupted(self):
+        self.serve(ArchiveHandler.content, cut=1)
+        self.assertTrue(self.download())
+        self.assertEqual(self.downloaded(), ArchiveHandler.content)
+        self.assertEqual(ArchiveHandler.ranges, ["bytes=0-0", None, "bytes=5000-"])
+
+    def test_corrupt(self):
+        self.serve(ArchiveHandler.content, digest=base64.b64encode(hashlib.md5("something else").digest()))
+        self.assertRaises(IOError, self.download)
+        self.assertEqual(len(ArchiveHandler.ranges), 1 + kploycommon.DOWNLOAD_RETRIES)
+        self.assertEqual(os.listdir(self.env), [])
+
+    def test_segments(self):
+        kploycommon.DOWNLOAD_SEGMENT_SIZE = 3000
+        self.serve(ArchiveHandler.content, cut=1)
+        self.assertTrue(self.download())
+        self.assertEqual(self.downloaded(), ArchiveHandler.content)
+        self.assertEqual(os.listdir(self.env), ["app.zip"])
+        ranges = ArchiveHandler.ranges[1:]
+        self.assertTrue(set(["bytes=0-2999", "bytes=3000-5999", "bytes=6000-8999", "bytes=9000-9999"]) <= set(ranges))
+        self.assertEqual(len(ranges), 5) # one segment resumed halfway through
+
+    def test_segments_corrupt(self):
+        kploycommon.DOWNLOAD_SEGMENT_SIZE = 3000
+        self.serve(ArchiveHandler.content, digest=base64.b64encode(hashlib.md5("something else").digest()))
+        self.assertRaises(IOError, self.download)
+        self.assertEqual(os.listdir(self.env), [])
+
+class WriteAtomicallyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.env = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.env)
+
+    def test_concurrent_writes(self):
+        file_name = os.path.join(self.env, "cache", "index.json")
+        contents, errors = [str(i) * 10000 for i in range(10)], []
+        def write(content):
+            try:
+                for _ in range(20):
+                    kploycommon._write_atomically(file_name, content)
+            except (Exception) as e:
+                errors.append(e)
+        threads = [threading.Thread(target=write, args=(content,)) for content in contents]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        with open(file_name, "rb") as f:
+            self.assertIn(f.read(), contents)
+        self.assertEqual(os.listdir(os.path.dirname(file_name)), ["index.json"])
+
+class PlanTest(unittest.TestCase):
+
+    def test_plan(self):
+        live_index = {
+            "same": {"metadata": {"name": "same", "annotations": {kploycommon.DIGEST_ANNOTATION: "digest-of-same.yaml"}}},
+            "changed": {"metadata": {"name": "changed", "annotations": {kploycommon.DIGEST_ANNOTATION: "outdated"}}},
+            "unstamped": {"metadata": {"name": "unstamped"}},
+            "gone": {"metadata": {"name": "gone", "labels": {kploycommon.APP_LABEL: "shop"}}},
+            "other-app": {"metadata": {"name": "other-app", "labels": {kploycommon.APP_LABEL: "blog"}}},
+            "no-app": {"metadata": {"name": "no-app"}}
+        }
+        alist = [_record(name + ".yaml", _rc(name)) for name in ["new", "same", "changed", "unstamped"]]
+        plan = kploycommon._plan(live_index, alist, "shop")
+        self.assertEqual([(action, res_name) for action, res_name, _ in plan], [
+            ("create", "new"),
+            ("unchanged", "same"),
+            ("update", "changed"),
+            ("update", "unstamped"),
+            ("prune", "gone")
+        ])
+        self.assertIs(plan[0][2], alist[0])
+        self.assertIs(plan[-1][2], live_index["gone"])
+
+    def test_app_label(self):
+        self.assertEqual(kploycommon._app_label("CHANGE_ME"), "CHANGE_ME")
+        label = kploycommon._app_label("my shop")
+        self.assertTrue(kploycommon.LABEL_VALUE.match(label))
+        self.assertNotEqual(label, kploycommon._app_label("my blog"))
+
+    def test_three_way_patch(self):
+        old = _record("web.yaml", _rc("web", labels={"app": "web", "tier": "x"}))
+        live = kploycommon._stamp_manifest(old, "RC")
+        live["spec"]["template"]["spec"]["dnsPolicy"] = "ClusterFirst" # filled in by the API server
+        new = _record("web.yaml", _rc("web"))
+        new["digest"] = "new-digest"
+        patch = kploycommon._three_way_patch(live, kploycommon._stamp_manifest(new, "RC"))
+        self.assertEqual(patch["spec"]["template"]["metadata"]["labels"], {"tier": None})
+        self.assertEqual(patch["spec"]["selector"], {"tier": None})
+        self.assertEqual(patch["metadata"]["annotations"][kploycommon.DIGEST_ANNOTATION], "new-digest")
+        self.assertNotIn("spec", patch["spec"]["template"]) # leaves the dnsPolicy alone
+
+class ArchiveTest(unittest.TestCase):
+
+    def test_is_within(self):
+        for file_name in ["Kployfile", "rcs/web.yaml", "rcs/../services/web.yaml"]:
+            self.assertTrue(kploycommon._is_within(file_name, "."))
+        for file_name in ["../web.yaml", "rcs/../../web.yaml", "/etc/passwd", "..\\web.yaml"]:
+            self.assertFalse(kploycommon._is_within(file_name, "."))
+
+    def test_leveled_zip_file(self):
+        env = tempfile.mkdtemp()
+        try:
+            contents = {"empty": "", "small.yaml": "kind: Service\n", "big.bin": "".join(chr(i % 7) for i in range(3 * kploycommon.UPLOAD_CHUNK_SIZE + 5))}
+            for afile, content in contents.iteritems():
+                with open(os.path.join(env, afile), "wb") as f:
+                    f.write(content)
+            sizes = []
+            for level in [1, 9]:
+                archive = os.path.join(env, "app-%d.zip" %(level))
+                with contextlib.closing(kploycommon._LeveledZipFile(archive, level)) as z:
+                    for afile in sorted(contents):
+                        z.write(os.path.join(env, afile), afile)
+                with contextlib.closing(zipfile.ZipFile(archive)) as z:
+                    self.assertIsNone(z.testzip())
+                    self.assertEqual(dict([(afile, z.read(afile)) for afile in z.namelist()]), contents)
+                sizes.append(os.path.getsize(archive))
+            self.assertTrue(sizes[1] < sizes[0])
+        finally:
+            shutil.rmtree(env)
+
+class ScheduleTest(unittest.TestCase):
+
+    def run_tasks(self, graph, failing=()):
+        done = []
+        def task(name):
+            def run():
+                if name in failing:
+                    raise Exception("%s broke" %(name))
+                done.append(name)
+            return run
+        tasks = OrderedDict([(name, (task(name), dependencies, after)) for name, dependencies, after in graph])
+        errors = kploycommon._schedule(tasks, workers=4)
+        return done, dict([(name, str(error)) for name, error in errors])
+
+    def test_runs_in_dependency_order(self):
+        done, errors = self.run_tasks([
+            ("namespace", [], []),
+            ("secrets", ["namespace"], []),
+            ("svc", ["namespace"], []),
+            ("rc", ["namespace", "secrets"], ["svc"])])
+        self.assertEqual(errors, {})
+        self.assertEqual(done[0], "namespace")
+        self.assertEqual(done[-1], "rc")
+
+    def test_skips_dependents_of_failed_tasks(self):
+        done, errors = self.run_tasks([
+            ("namespace", [], []),
+            ("db", ["namespace"], []),
+            ("api", ["db"], []),
+            ("web", ["api"], []),
+            ("other", ["namespace"], [])], failing=["db"])
+        self.assertEqual(sorted(done), ["namespace", "other"])
+        self.assertEqual(errors, {
+            "db": "db broke",
+            "api": "skipped, because db failed",
+            "web": "skipped, because db failed"
+        })
+
+    def test_runs_tasks_after_failed_ones(self):
+        done, errors = self.run_tasks([
+            ("namespace", [], []),
+            ("svc1", ["namespace"], []),
+            ("svc2", ["namespace"], []),
+            ("rc", ["namespace"], ["svc1", "svc2"])], failing=["svc1"])
+        self.assertEqual(done[-1], "rc")
+        self.assertEqual(errors, {"svc1": "svc1 broke"})
+
+    def test_runs_tasks_after_skipped_ones(self):
+        done, errors = self.run_tasks([
+            ("db", [], []),
+            ("api", ["db"], []),
+            ("rc", [], ["api"])], failing=["db"])
+        self.assertEqual(done, ["rc"])
+        self.assertEqual(errors, {"db": "db broke", "api": "skipped, because db failed"})
+
+    def test_reports_a_task_skipped_by_several_failures_once(self):
+        done, errors = self.run_tasks([
+            ("a", [], []),
+            ("b", [], []),
+            ("c", ["a", "b"], [])], failing=["a", "b"])
+        self.assertEqual(done, [])
+        self.assertEqual(sorted(errors.keys()), ["a", "b", "c"])
+
+    def test_task_named_twice_runs_once(self):
+        done = []
+        tasks = OrderedDict([("a", (lambda: done.append("a"), [], [])), ("b", (lambda: done.append("b"), ["a", "a"], ["a"]))])
+        self.assertEqual(kploycommon._schedule(tasks, workers=4), [])
+        self.assertEqual(done, ["a", "b"])
+
+    def test_rejects_cycles_and_unknown_tasks(self):
+        self.assertRaises(kploycommon.DeploymentError, self.run_tasks, [("a", ["b"], []), ("b", [], ["a"])])
+        self.assertRaises(kploycommon.DeploymentError, self.run_tasks, [("a", ["nope"], [])])
+
+class DeployTest(FakeClusterTest):
+
+    def depends_on(self, litem, hints):
+        litem["manifest"]["metadata"]["annotations"] = {kploycommon.DEPENDS_ON_ANNOTATION: hints}
+        return litem
+
+    def test_depends_on(self):
+        svc_list = [_record("services/web.yaml", _svc("web", {"app": "web"}))]
+        rc_list = [
+            self.depends_on(_record("rcs/web.yaml", _rc("web")), "web, web, secrets"), # its service, not itself
+            self.depends_on(_record("rcs/api.yaml", _rc("api")), "web,api,namespace")]
+        errors = kploycommon._deploy(self.pyk_client, self.namespace, {}, svc_list, rc_list, False, workers=4)
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(self.live("services").keys()), ["web"])
+        self.assertEqual(sorted(self.live("replicationcontrollers").keys()), ["api", "web"])
+
+    def test_failed_services_only_skip_what_depends_on_them(self):
+        svc_list = [_record("services/web.yaml", _svc("web")), _record("services/web-again.yaml", _svc("web"))]
+        rc_list = [
+            _record("rcs/api.yaml", _rc("api")),
+            self.depends_on(_record("rcs/front.yaml", _rc("front")), "web")]
+        errors = dict(kploycommon._deploy(self.pyk_client, self.namespace, {}, svc_list, rc_list, False, workers=4))
+        self.assertEqual(len(errors), 2) # one of the services and the RC that depends on it
+        self.assertTrue(str(errors["rcs/front.yaml"]).startswith("skipped, because services/web"))
+        self.assertEqual(sorted(self.live("replicationcontrollers").keys()), ["api"])
+
+    def test_prune_only_resources_of_the_app(self):
+        for app, name in [("shop", "cart"), ("shop", "checkout"), ("blog", "posts")]:
+            self.assertEqual(kploycommon._deploy(self.pyk_client, self.namespace, {}, [], [_record("rcs/%s.yaml" %(name), _rc(name))], False, workers=4, app=app), [])
+        live_index = kploycommon._list_guarded(self.pyk_client, self.namespace, "replicationcontrollers")
+        plan = kploycommon._plan(live_index, [_record("rcs/cart.yaml", _rc("cart"))], "shop")
+        self.assertEqual([(action, res_name) for action, res_name, _ in plan], [("unchanged", "cart"), ("prune", "checkout")])
+        self.assertEqual(kploycommon._apply(self.pyk_client, self.namespace, plan, "RC", False, workers=4, prune=True, live_index=live_index, app="shop"), [])
+        self.assertEqual(sorted(self.live("replicationcontrollers").keys()), ["cart", "posts"])
+
+class DestroyTest(FakeClusterTest):
+
+    def test_destroy(self):
+        svc_list = [_record("services/web.yaml", _svc("web", {"app": "web"}))]
+        rc = _rc("web")
+        rc["spec"]["replicas"] = 3
+        rc_list = [_record("rcs/web.yaml", rc)]
+        self.assertEqual(kploycommon._deploy(self.pyk_client, self.namespace, {}, svc_list, rc_list, False, workers=4), [])
+        self.assertEqual(len(self.live("pods")), 3)
+        kploycommon._destroy(self.pyk_client, self.namespace, svc_list, rc_list + [_record("rcs/never-deployed.yaml", _rc("never-deployed"))], False)
+        self.assertNotIn(self.namespace, self.server.cluster.namespaces)
+        for kind in ["services", "replicationcontrollers", "pods", "secrets"]:
+            self.assertEqual(self.live(kind), {})
+        kploycommon._destroy(self.pyk_client, self.namespace, svc_list, rc_list, False) # nothing left to destroy
+
+class OwnPodsTest(FakeClusterTest):
+    server_options = {"pod_delay": 0.3} # the pods show up while kploy watches
+
+    def test_own_pods_as_they_show_up(self):
+        kploycommon._create_ns(self.pyk_client, self.namespace, False)
+        rc = _rc("web")
+        rc["spec"]["replicas"] = 3
+        kploycommon._create_resource(self.pyk_client, self.namespace, rc, "RC") # its pods are not guarded
+        self.assertEqual(self.live("pods"), {})
+        rc_path = kploycommon._resource_path(self.namespace, "RC", "web")
+        kploycommon._own_pods(self.pyk_client, self.namespace, {"app": "web"}, 3, rc_path, False)
+        pods = self.live("pods").values()
+        self.assertEqual(len(pods), 3)
+        self.assertEqual([pod["metadata"]["labels"]["guard"] for pod in pods], ["pyk"] * 3)
+
+class ScaleTest(FakeClusterTest):
+
+    def test_scale_owns_pods(self):
+        kploycommon._create_ns(self.pyk_client, self.namespace, False)
+        kploycommon._create_resource(self.pyk_client, self.namespace, _rc("web"), "RC") # its pods are not guarded
+        kploycommon._scale(self.pyk_client, self.namespace, [("web", 3)], False)
+        self.assertEqual(self.live("replicationcontrollers")["web"]["spec"]["replicas"], 3)
+        pods = self.live("pods").values()
+        self.assertEqual(len(pods), 3)
+        self.assertEqual([pod["metadata"]["labels"]["guard"] for pod in pods], ["pyk"] * 3)
+
+class ExtensionsScaleTest(ScaleTest):
+    """
+    The extensions/v1beta1 scale subresource has the selector as a map rather than a string.
+    """
+    server_options = {"scale_version": "extensions/v1beta1"}
+
+class AgentTest(FakeClusterTest):
+
+    def setUp(self):
+        FakeClusterTest.setUp(self)
+        self.watch_timeout = kploycommon.WATCH_TIMEOUT_IN_SEC
+        kploycommon.WATCH_TIMEOUT_IN_SEC = 1 # so that the informers notice soon that they are stopped
+        kploycommon._create_ns(self.pyk_client, self.namespace, False)
+        rc = _rc("web")
+        rc["spec"]["replicas"] = 2
+        self.assertEqual(kploycommon._deploy(self.pyk_client, self.namespace, {}, [], [_record("rcs/web.yaml", rc)], False), [])
+        self.app_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.app_dir, ".kploy"))
+        self.agent_server = kployagent.AgentServer(os.path.join(self.app_dir, kployagent.AGENT_SOCKET), self.pyk_client, self.server.url, self.namespace)
+        self.agent_server.start_informers()
+        threading.Thread(target=self.agent_server.serve_forever).start()
+        self.target = {"apiserver": self.server.url, "namespace": self.namespace}
+
+    def tearDown(self):
+        self.agent_server.shutdown()
+        self.agent_server.server_close()
+        self.agent_server.stop_informers()
+        for informer in self.agent_server.informers.values():
+            informer.join()
+        kploycommon.WATCH_TIMEOUT_IN_SEC = self.watch_timeout
+        shutil.rmtree(self.app_dir)
+        FakeClusterTest.tearDown(self)
+
+    def ask_api_server(self):
+        raise AssertionError("asked the API server")
+
+    def test_query(self):
+        agent = kployagent.connect(self.app_dir, self.target)
+        self.assertIsNotNone(agent)
+        pods = kployagent.query_or(agent, "pods", self.ask_api_server)
+        self.assertEqual(sorted(pod["metadata"]["name"] for pod in pods), sorted(self.live("pods").keys()))
+        self.assertEqual(len(pods), 2)
+        pod_name = pods[0]["metadata"]["name"]
+        self.assertEqual(kployagent.query_or(agent, "pods", self.ask_api_server, "name", pod_name), [pods[0]])
+        self.assertEqual(kployagent._owner_keys(pods[0]), ["web"])
+        nodes = kployagent.query_or(agent, "nodes", self.ask_api_server, "address", "10.0.0.2")
+        self.assertEqual([node["metadata"]["name"] for node in nodes], ["10.0.0.2"])
+        self.assertEqual(kployagent.query_or(agent, "nodes", self.ask_api_server, "address", "10.9.9.9"), [])
+
+    def test_fallback(self):
+        self.assertIsNone(kployagent.connect(self.app_dir, {"apiserver": self.server.url, "namespace": "other"}))
+        self.assertIsNone(kployagent.connect(tempfile.gettempdir(), self.target))
+        self.assertEqual(kployagent.query_or(None, "pods", lambda: "api server"), "api server")
+        agent = kployagent.connect(self.app_dir, self.target)
+        self.assertEqual(kployagent.query_or(agent, "pods", lambda: "api server", "host", "10.0.0.2"), "api server") # no such index
+        self.assertEqual(kployagent.query_or(agent, "events", lambda: "api server"), "api server")
+
+class SyncSecretsTest(FakeClusterTest):
+
+    def setUp(self):
+        FakeClusterTest.setUp(self)
+        self.env = tempfile.mkdtemp()
+        self.shard_size = kploycommon.SECRET_SHARD_SIZE
+        kploycommon.SECRET_SHARD_SIZE = 20 # one secret per shard
+        kploycommon._create_ns(self.pyk_client, self.namespace, False)
+
+    def tearDown(self):
+        kploycommon.SECRET_SHARD_SIZE = self.shard_size
+        shutil.rmtree(self.env)
+        FakeClusterTest.tearDown(self)
+
+    def sync(self, **contents):
+        for key, content in contents.iteritems():
+            file_name = os.path.join(self.env, key + ".secret")
+            if content is None:
+                os.remove(file_name)
+            else:
+                with open(file_name, "wb") as f:
+                    f.write(content)
+        secrets = kploycommon._collect_secrets(self.env, ".secret")
+        return sorted(kploycommon._sync_secrets(self.pyk_client, self.namespace, secrets, False, workers=4))
+
+    def data(self):
+        return dict([(res_name, sorted((secret.get("data") or {}).keys())) for res_name, secret in self.live("secrets").iteritems()])
+
+    def test_sync(self):
+        self.assertEqual(self.sync(b="x" * 9, c="x" * 9, d="x" * 9), [("create", "kploy-secrets"), ("create", "kploy-secrets-1"), ("create", "kploy-secrets-2")])
+        self.assertEqual(self.data(), {"kploy-secrets": ["b"], "kploy-secrets-1": ["c"], "kploy-secrets-2": ["d"]})
+        self.assertEqual(self.sync(a="x" * 9, c="y" * 9), [("create", "kploy-secrets-3"), ("unchanged", "kploy-secrets"), ("unchanged", "kploy-secrets-2"), ("update", "kploy-secrets-1")])
+        self.assertEqual(self.data(), {"kploy-secrets": ["b"], "kploy-secrets-1": ["c"], "kploy-secrets-2": ["d"], "kploy-secrets-3": ["a"]})
+        self.assertEqual(self.live("secrets")["kploy-secrets-1"]["data"]["c"], "eXl5eXl5eXl5")
+        self.assertEqual(self.sync(a=None), [("delete", "kploy-secrets-3"), ("unchanged", "kploy-secrets"), ("unchanged", "kploy-secrets-1"), ("unchanged", "kploy-secrets-2")])
+        self.assertEqual(sorted(self.live("secrets").keys()), ["kploy-secrets", "kploy-secrets-1", "kploy-secrets-2"])
+
+class ParseScaleDefsTest(unittest.TestCase):
+
+    def test_pairs(self):
+        self.assertEqual(kploycommon._parse_scale_defs("web-rc=3, db-rc=0\tcache-rc=12"), [("web-rc", 3), ("db-rc", 0), ("cache-rc", 12)])
+
+    def test_file(self):
+        scale_file, scale_file_name = tempfile.mkstemp()
+        try:
+            os.write(scale_file, "# the frontend\nweb-rc=3\ndb-rc=1, cache-rc=2\n")
+            os.close(scale_file)
+            self.assertEqual(kploycommon._parse_scale_defs("@%s other-rc=5" %(scale_file_name)), [("web-rc", 3), ("db-rc", 1), ("cache-rc", 2), ("other-rc", 5)])
+        finally:
+            os.remove(scale_file_name)
+
+    def test_invalid(self):
+        for scale_defs in ["web-rc", "web-rc=", "=3", "web-rc=-1", "web-rc=three"]:
+            self.assertRaises(ValueError, kploycommon._parse_scale_defs, scale_defs)
+
+class SecretsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.env = tempfile.mkdtemp()
+        self.chunk_size = kploycommon.SECRET_CHUNK_SIZE
+
+    def tearDown(self):
+        kploycommon.SECRET_CHUNK_SIZE = self.chunk_size
+        shutil.rmtree(self.env)
+
+    def write(self, afile, content):
+        file_name = os.path.join(self.env, afile)
+        with open(file_name, "wb") as f:
+            f.write(content)
+        return file_name
+
+    def test_read_secret_strips_whitespace_across_chunks(self):
+        kploycommon.SECRET_CHUNK_SIZE = 3
+        for content, expected in [
+            ("  \n secret \t\n ", "secret"),
+            ("pass   word\n\n\n\n", "pass   word"),
+            ("a      b", "a      b"),
+            ("\n\n\n\n\n\n", ""),
+            ("", "")]:
+            file_name = self.write("s.secret", content)
+            self.assertEqual("".join(kploycommon._read_secret(file_name)), expected)
+
+    def test_collect_secrets(self):
+        self.write("dbpassword.secret", "  s3cr3t\n")
+        self.write("README", "not a secret")
+        secrets = kploycommon._collect_secrets(self.env, ".secret")
+        self.assertEqual(secrets.keys(), ["dbpassword"])
+        self.assertEqual(secrets["dbpassword"]["size"], len("czNjcjN0"))
+        self.assertEqual(kploycommon._secret_value(secrets["dbpassword"]), "czNjcjN0")
+
+    def test_shard_secrets(self):
+        size = kploycommon.SECRET_SHARD_SIZE / 3
+        secrets = dict([(key, {"path": key, "digest": "0" * 64, "size": size}) for key in ["a", "b", "c", "d", "e"]])
+        shards = kploycommon._shard_secrets(secrets)
+        self.assertEqual([sorted(shard.keys()) for shard in shards], [["a", "b"], ["c", "d"], ["e"]])
+        self.assertEqual(kploycommon._shard_secrets({}), [{}])
+
+    def test_shard_secrets_keeps_placements(self):
+        size = kploycommon.SECRET_SHARD_SIZE / 3
+        secrets = dict([(key, {"path": key, "digest": "0" * 64, "size": size}) for key in ["b", "c", "d", "e"]])
+        shards = kploycommon._shard_secrets(secrets)
+        placements = dict([(key, i) for i, shard in enumerate(shards) for key in shard])
+        secrets["aa"] = {"path": "aa", "digest": "0" * 64, "size": size}
+        del secrets["d"]
+        shards = kploycommon._shard_secrets(secrets, placements)
+        self.assertEqual([sorted(shard.keys()) for shard in shards], [["b", "c"], ["aa", "e"]])
+
+    def test_shard_secrets_by_annotation_size(self):
+        secrets = dict([("key%d" %(i), {"path": "key%d" %(i), "digest": "0" * 64, "size": 4}) for i in range(4000)])
+        shards = kploycommon._shard_secrets(secrets)
+        self.assertTrue(len(shards) > 1)
+        self.assertEqual(sum(len(shard) for shard in shards), 4000)
+
+    def test_shard_secrets_too_big(self):
+        secrets = {"huge": {"path": "huge", "digest": "0" * 64, "size": kploycommon.SECRET_SHARD_SIZE}}
+        self.assertRaises(kploycommon.DeploymentError, kploycommon._shard_secrets, secrets)
+
+    def test_secret_names(self):
+        self.assertEqual([kploycommon._secret_name(shard) for shard in range(3)], ["kploy-secrets", "kploy-secrets-1", "kploy-secrets-2"])
+        self.assertTrue(kploycommon._is_secret_name("kploy-secrets-12"))
+        self.assertFalse(kploycommon._is_secret_name("kploy-secrets-x"))
+        self.assertFalse(kploycommon._is_secret_name("default-token"))
+
+class CheckTest(unittest.TestCase):
+
+    def test_valid_manifests(self):
+        self.assertEqual(kploycommon._check_manifest(_rc("web"), "RC"), [])
+        self.assertEqual(kploycommon._check_manifest(_svc("web", {"app": "web"}), "service"), [])
+
+    def test_invalid_rc(self):
+        rc = _rc("Web_RC", labels={"app": "web"}, selector={"app": "db"})
+        rc["kind"] = "Pod"
+        rc["spec"]["template"]["spec"]["containers"] = [{"name": "web"}]
+        problems = kploycommon._check_manifest(rc, "RC")
+        self.assertEqual(len(problems), 4)
+        self.assertTrue(problems[0].startswith("kind is Pod"))
+        self.assertTrue(problems[1].startswith("metadata.name Web_RC"))
+        self.assertTrue(problems[2].startswith("spec.selector app=db"))
+        self.assertTrue(problems[3].startswith("spec.template.spec.containers[0]"))
+
+    def test_invalid_service(self):
+        svc = _svc("web")
+        svc["apiVersion"] = "v2"
+        svc["spec"]["ports"] = [{"port": "http"}]
+        self.assertEqual(kploycommon._check_manifest(svc, "service"), ["apiVersion is v2, expected v1", "spec.ports[0] needs a port number"])
+        self.assertEqual(kploycommon._check_manifest({"kind": "Service", "apiVersion": "v1", "metadata": {"name": "web"}}, "service"), ["spec is missing"])
+
+    def test_app(self):
+        svc_list = [
+            _record("services/web.yaml", _svc("web", {"app": "web"})),
+            _record("services/web-again.yaml", _svc("web", {"app": "web"})),
+            _record("services/db.yaml", _svc("db", {"app": "db"})),
+            _record("services/external.yaml", _svc("external"))]
+        rc_list = [_record("rcs/web.yaml", _rc("web"))]
+        self.assertEqual(kploycommon._check_app(svc_list, rc_list), [
+            ("services/web-again.yaml", "the service name web is used by web.yaml already"),
+            ("services/db.yaml", "spec.selector app=db doesn't match the pods of any RC")
+        ])
+
+if __name__ == "__main__":
+    unittest.main()